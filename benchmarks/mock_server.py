@@ -0,0 +1,248 @@
+'''
+A local stand-in for an OpenAI-compatible chat completions API.
+
+Responses are generated at a configurable token rate, chunk size and
+latency, so the overhead of paipe can be measured without a provider.
+Streaming, non-streaming and JSON-schema responses are supported: a request
+with tools(as pydantic_ai makes for `--json`) is answered with a call of its
+first tool, and a `response_format` of `json_schema` with JSON content, both
+generated from the schema. Embeddings are hashed bags of words, so texts
+sharing words are close.
+
+    python benchmarks/mock_server.py [--port 8000] [--token-rate 0] [--chunk-size 1] [--latency 0] [--tokens 256] [--embedding-dim 64]
+'''
+import re
+import json
+import time
+import base64
+import struct
+import hashlib
+import argparse
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+
+
+@dataclass
+class MockSettings:
+    # Output tokens per second, 0 for as fast as possible
+    token_rate: float = 0
+    # Tokens per streamed chunk
+    chunk_size: int = 1
+    # Seconds before the first byte of a response
+    latency: float = 0
+    # Output tokens of a text response
+    tokens: int = 256
+    # Dimensions of an embedding, unless the request sets them
+    embedding_dim: int = 64
+
+
+def example_of(schema: dict, defs: dict | None = None):
+    '''
+    Return a minimal value valid against a JSON schema.
+    '''
+    defs = defs if defs is not None else schema.get('$defs', {})
+    if '$ref' in schema:
+        return example_of(defs[schema['$ref'].rsplit('/', 1)[-1]], defs)
+    for key in ('anyOf', 'oneOf', 'allOf'):
+        if schema.get(key):
+            return example_of(schema[key][0], defs)
+    if 'enum' in schema:
+        return schema['enum'][0]
+    if 'const' in schema:
+        return schema['const']
+    kind = schema.get('type', 'object')
+    if isinstance(kind, list):
+        kind = kind[0]
+    if kind == 'object':
+        return {name: example_of(prop, defs) for (name, prop) in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [example_of(schema.get('items', {}), defs)]
+    return {'string': 'lorem', 'integer': 1, 'number': 1.0, 'boolean': True, 'null': None}.get(kind)
+
+
+def completion_id() -> str:
+    return f'chatcmpl-mock-{time.monotonic_ns()}'
+
+
+def usage_of(request: dict, tokens: int) -> dict:
+    prompt_tokens = len(json.dumps(request.get('messages', []))) // 4
+    return {'prompt_tokens': prompt_tokens,
+            'completion_tokens': tokens,
+            'total_tokens': prompt_tokens + tokens}
+
+
+def embedding_of(text: str, dim: int) -> list[float]:
+    '''
+    Return a bag of the words of text, hashed into dim dimensions.
+    '''
+    vector = [0.0] * dim
+    for word in re.findall(r'\w+', text.lower()):
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'little') % dim] += 1.0 if digest[4] & 1 else -1.0
+    return vector
+
+
+def make_handler(settings: MockSettings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, body: dict):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_chunk(self, data: bytes):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path.rstrip('/').endswith('/embeddings'):
+                self.send_json(200, self.embeddings(request))
+                return
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+                return
+            if settings.latency:
+                time.sleep(settings.latency)
+            if request.get('stream'):
+                self.stream(request)
+            else:
+                self.send_json(200, self.completion(request))
+
+        def embeddings(self, request: dict) -> dict:
+            inputs = request.get('input', [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            dim = request.get('dimensions') or settings.embedding_dim
+            data = []
+            for (i, text) in enumerate(inputs):
+                vector = embedding_of(text, dim)
+                if request.get('encoding_format') == 'base64':
+                    vector = base64.b64encode(struct.pack(f'<{dim}f', *vector)).decode('ascii')
+                data.append({'object': 'embedding', 'index': i, 'embedding': vector})
+            tokens = sum(len(text) for text in inputs) // 4
+            return {'object': 'list', 'data': data, 'model': request.get('model', 'mock'),
+                    'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}}
+
+        def answer(self, request: dict) -> tuple[list[str], dict | None]:
+            '''
+            Return the content tokens, and the tool call if the request has tools.
+            '''
+            if request.get('tools'):
+                function = request['tools'][0]['function']
+                arguments = json.dumps(example_of(function.get('parameters', {})))
+                return [], {'name': function['name'], 'arguments': arguments}
+            response_format = request.get('response_format') or {}
+            if response_format.get('type') == 'json_schema':
+                return [json.dumps(example_of(response_format['json_schema'].get('schema', {})))], None
+            return [WORDS[i % len(WORDS)] + ' ' for i in range(settings.tokens)], None
+
+        def completion(self, request: dict) -> dict:
+            tokens, tool_call = self.answer(request)
+            if settings.token_rate:
+                time.sleep(max(len(tokens), 1) / settings.token_rate)
+            message = {'role': 'assistant', 'content': ''.join(tokens) if not tool_call else None}
+            if tool_call:
+                message['tool_calls'] = [{'id': 'call_mock', 'type': 'function', 'function': tool_call}]
+            return {
+                'id': completion_id(),
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model', 'mock'),
+                'choices': [{'index': 0, 'message': message,
+                             'finish_reason': 'tool_calls' if tool_call else 'stop'}],
+                'usage': usage_of(request, len(tokens) or 1),
+            }
+
+        def stream(self, request: dict):
+            tokens, tool_call = self.answer(request)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            base = {'id': completion_id(), 'object': 'chat.completion.chunk',
+                    'created': int(time.time()), 'model': request.get('model', 'mock')}
+
+            def event(delta: dict, finish_reason: str | None = None, usage: dict | None = None):
+                chunk = {**base, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+                if usage is not None:
+                    chunk = {**base, 'choices': [], 'usage': usage}
+                self.send_chunk(b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n')
+
+            event({'role': 'assistant', 'content': ''})
+            if tool_call:
+                event({'tool_calls': [{'index': 0, 'id': 'call_mock', 'type': 'function',
+                                       'function': tool_call}]})
+            start = time.perf_counter()
+            size = max(1, settings.chunk_size)
+            for i in range(0, len(tokens), size):
+                if settings.token_rate:
+                    # Pace against the start, so the sleeps do not drift
+                    delay = start + (i + size) / settings.token_rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                event({'content': ''.join(tokens[i:i + size])})
+            event({}, 'tool_calls' if tool_call else 'stop')
+            if (request.get('stream_options') or {}).get('include_usage'):
+                event({}, usage=usage_of(request, len(tokens) or 1))
+            self.send_chunk(b'data: [DONE]\n\n')
+            self.send_chunk(b'')
+            self.wfile.flush()
+
+    return Handler
+
+
+class MockServer:
+    '''
+    Run the mock server in a background thread, as a context manager.
+    '''
+    def __init__(self, settings: MockSettings | None = None, host: str = '127.0.0.1', port: int = 0):
+        self.settings = settings or MockSettings()
+        self.server = ThreadingHTTPServer((host, port), make_handler(self.settings))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--token-rate', type=float, default=0,
+                        help='Output tokens per second, 0 for as fast as possible')
+    parser.add_argument('--chunk-size', type=int, default=1, help='Tokens per streamed chunk')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds before the first byte')
+    parser.add_argument('--tokens', type=int, default=256, help='Output tokens of a text response')
+    parser.add_argument('--embedding-dim', type=int, default=64, help='Dimensions of an embedding')
+    args = parser.parse_args()
+    settings = MockSettings(args.token_rate, args.chunk_size, args.latency / 1000, args.tokens, args.embedding_dim)
+    with MockServer(settings, args.host, args.port) as server:
+        print(f'Serving at {server.base_url}')
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+'''
+Cold-start benchmark for the commands that do not call an LLM.
+
+Each command is run in a fresh interpreter with `python -X importtime`, and
+fails the benchmark when the median import time of paipe goes past the
+budget. Only the paipe modules and what they import are counted, the
+imports of the interpreter itself (site, encodings, runpy) are not. Import time is what lazy imports control, and is far less noisy
+than wall time, which is shown for reference. The slowest imports of a
+failing command are shown to find what to defer.
+
+    python benchmarks/startup.py [--budget MS] [--runs N]
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PAIPE_YAML = '''\
+default:
+    protocol: openai
+    api_key: 'sk-benchmark-00000000000000000000'
+    base_url: 'http://127.0.0.1:1/v1'
+    model: 'benchmark'
+child:
+    _from: default
+    model: 'benchmark-child'
+'''
+
+COMMANDS = {
+    'version': (['--version'], None),
+    'list': (['--list'], None),
+    'inspect': (['--inspect', 'child'], None),
+    'op archive': (['op', 'archive', '--stdin', 'content'], b'hello\n'),
+    'help': (['--help'], None),
+}
+
+
+def parse_importtime(stderr: str) -> list[tuple[int, str]]:
+    '''
+    Return (cumulative microseconds, module) of the top level imports, from
+    the import of the paipe package on.
+    '''
+    imports = []
+    started = False
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        __, cumulative, name = line[len('import time:'):].split('|', 2)
+        if name.startswith('  '):
+            continue
+        name = name.strip()
+        # The interpreter imports site, encodings and runpy before paipe
+        started = started or name == 'paipe' or name.startswith('paipe.')
+        if started:
+            imports.append((int(cumulative), name))
+    return sorted(imports, reverse=True)
+
+
+def run_command(args: list[str], stdin: bytes | None, cwd: str) -> tuple[float, str]:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(ROOT), env.get('PYTHONPATH')]))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'paipe.cli', *args],
+                          input=stdin or b'',
+                          capture_output=True,
+                          cwd=cwd,
+                          env=env)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f'paipe {" ".join(args)} exited with {proc.returncode}:\n'
+                           f'{proc.stderr.decode(errors="replace")[-2000:]}')
+    return elapsed, proc.stderr.decode(errors='replace')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget', type=float, default=100,
+                        help='The max median import time of a command in ms(default 100)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='The runs of each command(default 5)')
+    parser.add_argument('--top', type=int, default=8,
+                        help='The slowest imports to show for a command over budget')
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as cwd:
+        Path(cwd, 'paipe.yaml').write_text(PAIPE_YAML, encoding='utf-8')
+        # Warm the bytecode and filesystem caches, not the interpreter
+        for (cmd_args, stdin) in COMMANDS.values():
+            run_command(cmd_args, stdin, cwd)
+        print(f'{"command":<12} {"imports":>10} {"wall":>10}')
+        for name, (cmd_args, stdin) in COMMANDS.items():
+            runs = []
+            for __ in range(args.runs):
+                elapsed, stderr = run_command(cmd_args, stdin, cwd)
+                import_time = sum(cumulative for (cumulative, __) in parse_importtime(stderr))
+                runs.append((import_time / 1000, elapsed * 1000, stderr))
+            runs.sort(key=lambda run: run[0])
+            import_time, __, stderr = runs[len(runs) // 2]
+            wall = statistics.median(run[1] for run in runs)
+            status = 'ok' if import_time <= args.budget else 'OVER BUDGET'
+            print(f'{name:<12} {import_time:7.1f} ms {wall:7.1f} ms  {status}')
+            if import_time > args.budget:
+                failed.append(name)
+                for (cumulative, module) in parse_importtime(stderr)[:args.top]:
+                    print(f'    {cumulative / 1000:8.1f} ms  {module}')
+    if failed:
+        print(f'Over the {args.budget:g} ms budget: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
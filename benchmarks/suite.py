@@ -0,0 +1,276 @@
+'''
+Offline benchmark suite of paipe against the local mock server.
+
+- cold start: wall time and peak RSS of `paipe` calls in a fresh interpreter,
+  streamed, not streamed and with `--json`, through `cli.main`.
+- stream overhead: the time `run_agent` adds per delta over consuming the same
+  stream with the openai client, through `providers/openai.OpenAIModel`.
+- archive: throughput and peak RSS of `paipe op archive` over generated files.
+
+Results are written as JSON, to `benchmarks/results/<commit>.json` unless
+specified, and `--compare` shows the change against a previous result.
+
+    python benchmarks/suite.py [--runs N] [--output FILE] [--compare FILE]
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from mock_server import MockServer, MockSettings
+
+ROOT = Path(__file__).resolve().parent.parent
+
+API_KEY = 'sk-benchmark-00000000000000000000'
+
+PAIPE_YAML = '''\
+default:
+    protocol: openai
+    api_key: '{api_key}'
+    base_url: '{base_url}'
+    model: 'benchmark'
+'''
+
+JSON_SCHEMA = json.dumps({
+    'type': 'object',
+    'properties': {'name': {'type': 'string'}, 'count': {'type': 'integer'}},
+    'required': ['name', 'count'],
+})
+
+COLD_START_CALLS = {
+    'stream': ['hi'],
+    'no_stream': ['--no-stream', 'hi'],
+    'json': ['--json', JSON_SCHEMA, 'hi'],
+}
+
+
+def get_env() -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(ROOT), env.get('PYTHONPATH')]))
+    # Measure the in-process path, not a daemon which may be up
+    env['PAIPE_NO_DAEMON'] = '1'
+    return env
+
+
+def run_measured(args: list[str], stdin: bytes | None = None, cwd: str | None = None) -> dict:
+    '''
+    Run a command and return its wall time, peak RSS and output.
+    '''
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr,
+                                cwd=cwd, env=get_env())
+        proc.stdin.write(stdin or b'')
+        proc.stdin.close()
+        # wait4 reports the resource usage of this child alone
+        __, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stdout.seek(0)
+        stderr.seek(0)
+        output, errors = stdout.read(), stderr.read()
+    if proc.returncode != 0:
+        raise RuntimeError(f'{" ".join(args)} exited with {proc.returncode}:\n'
+                           f'{errors.decode(errors="replace")[-2000:]}')
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    max_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'wall': elapsed, 'max_rss': max_rss, 'stdout': output}
+
+
+def median_of(runs: list[dict], key: str) -> float:
+    return statistics.median(run[key] for run in runs)
+
+
+def bench_cold_start(runs: int) -> dict:
+    results = {}
+    with MockServer(MockSettings(tokens=64)) as server, tempfile.TemporaryDirectory() as cwd:
+        Path(cwd, 'paipe.yaml').write_text(
+            PAIPE_YAML.format(api_key=API_KEY, base_url=server.base_url), encoding='utf-8')
+        for name, args in COLD_START_CALLS.items():
+            command = [sys.executable, '-m', 'paipe.cli', *args]
+            # Warm the bytecode and filesystem caches, not the interpreter
+            run_measured(command, cwd=cwd)
+            measured = [run_measured(command, cwd=cwd) for __ in range(runs)]
+            results[name] = {
+                'wall_ms': round(median_of(measured, 'wall') * 1000, 3),
+                'max_rss_mb': round(median_of(measured, 'max_rss') / 2**20, 3),
+            }
+    return results
+
+
+async def measure_stream(base_url: str, runs: int) -> dict:
+    '''
+    Run in a child process, see `bench_stream_overhead`.
+    '''
+    sys.path.insert(0, str(ROOT))
+    from openai import AsyncOpenAI
+    from paipe.models import PaipeContext
+    from paipe.main import build_agent, run_agent
+
+    class NullWriter:
+        def __init__(self):
+            self.writes = 0
+
+        def write(self, text: str) -> int:
+            self.writes += 1
+            return len(text)
+
+        def flush(self):
+            pass
+
+    profile = {'protocol': 'openai', 'api_key': API_KEY, 'base_url': base_url, 'model': 'benchmark'}
+    context = PaipeContext(prompt='hi')
+    agent = build_agent(context, profile)
+    client = AsyncOpenAI(api_key=API_KEY, base_url=base_url)
+
+    async def run_paipe():
+        writer = NullWriter()
+        await run_agent(context.model_copy(), agent=agent, profile=profile, stdout=writer, stderr=writer)
+
+    async def run_raw():
+        stream = await client.chat.completions.create(model='benchmark',
+                                                      messages=[{'role': 'user', 'content': 'hi'}],
+                                                      stream=True)
+        deltas = 0
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                deltas += 1
+        return deltas
+
+    deltas = await run_raw()
+    await run_paipe()
+    timings = {'paipe': [], 'raw': []}
+    for __ in range(runs):
+        for name, run in (('paipe', run_paipe), ('raw', run_raw)):
+            start = time.perf_counter()
+            await run()
+            timings[name].append(time.perf_counter() - start)
+    paipe = statistics.median(timings['paipe'])
+    raw = statistics.median(timings['raw'])
+    return {
+        'deltas': deltas,
+        'paipe_ms': round(paipe * 1000, 3),
+        'raw_ms': round(raw * 1000, 3),
+        'per_delta_us': round((paipe - raw) / deltas * 1e6, 3),
+    }
+
+
+def bench_stream_overhead(runs: int, deltas: int) -> dict:
+    with MockServer(MockSettings(tokens=deltas, chunk_size=1)) as server:
+        measured = run_measured([sys.executable, __file__, '--child-stream', server.base_url,
+                                 '--runs', str(runs)])
+    return {**json.loads(measured['stdout']), 'max_rss_mb': round(measured['max_rss'] / 2**20, 3)}
+
+
+def generate_files(directory: Path, total_mb: int, file_mb: int = 1) -> list[str]:
+    line = 'The quick brown fox jumps over the lazy dog, 敏捷的棕色狐狸跳过了懒狗。\n'
+    content = line * (file_mb * 2**20 // len(line.encode('utf-8')))
+    paths = []
+    for i in range(max(1, total_mb // file_mb)):
+        path = directory / f'file-{i}.txt'
+        path.write_text(content, encoding='utf-8')
+        paths.append(str(path))
+    return paths
+
+
+def bench_archive(runs: int, total_mb: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = generate_files(Path(directory), total_mb)
+        size = sum(os.path.getsize(path) for path in paths)
+        for wrap in ('html', 'markdown'):
+            command = [sys.executable, '-m', 'paipe.cli', 'op', 'archive', '--wrap', wrap, *paths]
+            run_measured(command, cwd=directory)
+            measured = [run_measured(command, cwd=directory) for __ in range(runs)]
+            wall = median_of(measured, 'wall')
+            results[wrap] = {
+                'input_mb': round(size / 2**20, 3),
+                'wall_ms': round(wall * 1000, 3),
+                'mb_per_s': round(size / 2**20 / wall, 3),
+                'max_rss_mb': round(median_of(measured, 'max_rss') / 2**20, 3),
+            }
+    return results
+
+
+def get_commit() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return f'{commit}-dirty' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(previous: dict, current: dict):
+    print(f'Compared to {previous.get("commit")}:')
+    old = flatten(previous['results'])
+    for key, value in flatten(current['results']).items():
+        if key not in old:
+            continue
+        change = f'{(value - old[key]) / old[key] * 100:+.1f}%' if old[key] else ''
+        print(f'    {key:<40} {old[key]:>12g} -> {value:>12g} {change}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='The runs of each measurement(default 5)')
+    parser.add_argument('--deltas', type=int, default=2000,
+                        help='The deltas of the streamed response to measure the overhead over(default 2000)')
+    parser.add_argument('--archive-mb', type=int, default=32,
+                        help='The size of the files to archive in MB(default 32)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='The file to write the results, benchmarks/results/<commit>.json by default')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='A previous result file to compare with')
+    parser.add_argument('--child-stream', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_stream:
+        print(json.dumps(asyncio.run(measure_stream(args.child_stream, args.runs))))
+        return
+
+    commit = get_commit()
+    results = {}
+    for name, bench in (('cold_start', lambda: bench_cold_start(args.runs)),
+                        ('stream_overhead', lambda: bench_stream_overhead(args.runs, args.deltas)),
+                        ('archive', lambda: bench_archive(args.runs, args.archive_mb))):
+        print(f'Running {name}...', file=sys.stderr)
+        results[name] = bench()
+        print(json.dumps(results[name], indent=4))
+    report = {
+        'commit': commit,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'runs': args.runs, 'deltas': args.deltas, 'archive_mb': args.archive_mb},
+        'results': results,
+    }
+    output = Path(args.output) if args.output else ROOT / 'benchmarks' / 'results' / f'{commit}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=4), encoding='utf-8')
+    print(f'Results written to {output}', file=sys.stderr)
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text(encoding='utf-8')), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
-
-import importlib.metadata
-
-try:
-    __version__ = importlib.metadata.version("paipe")
-except importlib.metadata.PackageNotFoundError:
-    __version__ = "0.0.0"
\ No newline at end of file
+def __getattr__(name):
+    # Resolve the version on demand, importlib.metadata is slow to import
+    if name == '__version__':
+        import importlib.metadata
+        try:
+            return importlib.metadata.version("paipe")
+        except importlib.metadata.PackageNotFoundError:
+            return "0.0.0"
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
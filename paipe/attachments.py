@@ -0,0 +1,190 @@
+'''
+Preprocess attachments before upload.
+
+Images are downscaled and re-encoded, and videos are sampled into a few
+keyframes, as configured by the `attachments` section of a profile:
+
+    attachments:
+        max_image_dimension: 1568
+        image_quality: 85
+        video_frames: 8
+
+Identical attachments are sent once, and processed outputs are cached by the
+hash of the input and the settings, so an asset is never re-encoded.
+Downscaling requires Pillow, and sampling videos requires ffmpeg.
+'''
+import io
+import base64
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from pathlib import Path
+from .cache import DiskCache
+from .util import logger, get_cache_dir
+
+SETTING_KEYS = ('max_image_dimension', 'image_quality', 'video_frames')
+
+DEFAULT_IMAGE_QUALITY = 85
+CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+
+def dedupe_attachments(attachments: list) -> list:
+    seen = set()
+    result = []
+    for (media_type, data) in attachments:
+        digest = hashlib.sha256(data).digest()
+        if digest in seen:
+            logger.debug(f'[attachments] skip duplicated {media_type} attachment')
+            continue
+        seen.add(digest)
+        result.append((media_type, data))
+    return result
+
+
+def process_image(media_type: str, data: bytes, settings: dict) -> list:
+    max_dimension = settings.get('max_image_dimension')
+    quality = settings.get('image_quality')
+    if not max_dimension and not quality:
+        return [(media_type, data)]
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.warning('Install Pillow to downscale image attachments')
+        return None
+    try:
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, 'is_animated', False):
+            return [(media_type, data)]
+        image = ImageOps.exif_transpose(image)
+        resized = bool(max_dimension) and max(image.size) > max_dimension
+        if resized:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        has_alpha = image.mode in ('RGBA', 'LA') or \
+            (image.mode == 'P' and 'transparency' in image.info)
+        output = io.BytesIO()
+        if has_alpha:
+            image.save(output, 'PNG', optimize=True)
+            output_type = 'image/png'
+        else:
+            image.convert('RGB').save(output, 'JPEG',
+                                      quality=quality or DEFAULT_IMAGE_QUALITY,
+                                      optimize=True)
+            output_type = 'image/jpeg'
+    except Exception as e:
+        logger.warning(f'Failed to process image attachment: {e}')
+        return None
+    if not resized and output.tell() >= len(data):
+        return [(media_type, data)]
+    logger.debug(f'[attachments] image {len(data)} -> {output.tell()} bytes')
+    return [(output_type, output.getvalue())]
+
+
+def probe_duration(path: str) -> float | None:
+    if not shutil.which('ffprobe'):
+        return None
+    proc = subprocess.run(['ffprobe', '-v', 'error',
+                           '-show_entries', 'format=duration',
+                           '-of', 'csv=p=0', path],
+                          capture_output=True, text=True)
+    try:
+        return float(proc.stdout.strip())
+    except ValueError:
+        return None
+
+
+def process_video(media_type: str, data: bytes, settings: dict) -> list:
+    frames = settings.get('video_frames')
+    if not frames:
+        return [(media_type, data)]
+    if not shutil.which('ffmpeg'):
+        logger.warning('Install ffmpeg to sample video attachments into frames')
+        return None
+    max_dimension = settings.get('max_image_dimension')
+    quality = settings.get('image_quality') or DEFAULT_IMAGE_QUALITY
+    # Map the JPEG quality of 1-100 to the qscale of ffmpeg, 31(worst)-2(best)
+    qscale = str(round(2 + (100 - quality) * 29 / 99))
+    scale = []
+    if max_dimension:
+        scale = ['-vf', f"scale='if(gt(iw,ih),min({max_dimension},iw),-2)'"
+                        f":'if(gt(iw,ih),-2,min({max_dimension},ih))'"]
+    result = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = str(Path(tmp_dir) / 'video')
+        Path(video_path).write_bytes(data)
+        duration = probe_duration(video_path)
+        if not duration:
+            logger.warning('Failed to probe the duration of a video attachment')
+            return None
+        for i in range(frames):
+            frame_path = Path(tmp_dir) / f'frame-{i}.jpg'
+            # Seek before the input and decode keyframes only, to skip decoding the whole video
+            proc = subprocess.run(['ffmpeg', '-v', 'error', '-y',
+                                   '-skip_frame', 'nokey',
+                                   '-ss', f'{duration * (i + 0.5) / frames:.3f}',
+                                   '-i', video_path,
+                                   '-frames:v', '1', *scale,
+                                   '-q:v', qscale, str(frame_path)],
+                                  capture_output=True)
+            if proc.returncode == 0 and frame_path.exists():
+                result.append(('image/jpeg', frame_path.read_bytes()))
+    if not result:
+        logger.warning('Failed to sample frames of a video attachment')
+        return None
+    logger.debug(f'[attachments] video {len(data)} bytes -> {len(result)} frames')
+    return dedupe_attachments(result)
+
+
+def process_attachment(media_type: str, data: bytes, settings: dict) -> list | None:
+    '''
+    Return the processed attachments, None if it failed to be processed.
+    '''
+    if media_type.startswith('image/') and media_type != 'image/svg+xml':
+        return process_image(media_type, data, settings)
+    elif media_type.startswith('video/'):
+        return process_video(media_type, data, settings)
+    return [(media_type, data)]
+
+
+def attachment_key(media_type: str, data: bytes, settings: dict) -> str:
+    digest = hashlib.sha256(data)
+    digest.update(repr((media_type, sorted(settings.items()))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def preprocess_attachments(attachments: list, settings: dict | None = None) -> list:
+    '''
+    Return the attachments deduped, and processed with the settings of a profile.
+    '''
+    attachments = dedupe_attachments(attachments)
+    settings = {key: value for (key, value) in (settings or {}).items()
+                if key in SETTING_KEYS and value}
+    if not settings:
+        return attachments
+    cache = DiskCache(get_cache_dir('attachments'), max_size=CACHE_MAX_SIZE)
+    result = []
+    for (media_type, data) in attachments:
+        if not media_type.startswith(('image/', 'video/')):
+            result.append((media_type, data))
+            continue
+        key = attachment_key(media_type, data, settings)
+        if entry := cache.get(key):
+            if entry['outputs'] is None:
+                result.append((media_type, data))
+            else:
+                result.extend((output_type, base64.b64decode(output))
+                              for (output_type, output) in entry['outputs'])
+            continue
+        outputs = process_attachment(media_type, data, settings)
+        if outputs is None:
+            # Not cached, to be processed again once the tool is available
+            result.append((media_type, data))
+            continue
+        if outputs == [(media_type, data)]:
+            # Already within the settings, cache that without a copy of the data
+            cache.put(key, {'outputs': None})
+        else:
+            cache.put(key, {'outputs': [(output_type, base64.b64encode(output).decode('ascii'))
+                                        for (output_type, output) in outputs]})
+        result.extend(outputs)
+    return dedupe_attachments(result)
@@ -0,0 +1,179 @@
+'''
+Run a JSONL file of prompts through shared agents with bounded concurrency.
+
+Each input line is a JSON object with any of the fields in `RECORD_FIELDS`,
+and an optional `id` echoed back in the result. Each output line is a JSON
+object with `index`, `id`, `output`, `usage` and `error`.
+'''
+import json
+import asyncio
+from typing import IO, Any, AsyncIterator, Awaitable, Callable
+import pydantic
+import pydantic_ai.result
+from .models import PaipeContext
+from .main import AgentPool, run_context, format_result_data
+from .util import logger, usage_to_dict
+
+RECORD_FIELDS = [
+    'prompt',
+    'input_text',
+    'profile',
+    'system_prompt',
+    'json_schema',
+    'model',
+]
+
+
+def load_finished(output_path: str) -> set[int]:
+    '''
+    Return the indexes of the records finished without error in a previous run.
+    '''
+    finished = set()
+    try:
+        with open(output_path, 'r', encoding='utf-8') as fd:
+            for line in fd:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut short by an interrupted run
+                    continue
+                if isinstance(result, dict) and result.get('error') is None:
+                    finished.add(result.get('index'))
+    except FileNotFoundError:
+        pass
+    return finished
+
+
+def ensure_trailing_newline(output_path: str):
+    '''
+    Terminate a partially written last line before appending to it.
+    '''
+    try:
+        with open(output_path, 'rb+') as fd:
+            fd.seek(0, 2)
+            if fd.tell() == 0:
+                return
+            fd.seek(-1, 2)
+            if fd.read(1) != b'\n':
+                fd.write(b'\n')
+    except FileNotFoundError:
+        pass
+
+
+def to_context(record: dict, defaults: dict) -> PaipeContext:
+    context_dict = {k: v for k, v in defaults.items() if v is not None}
+    for key in RECORD_FIELDS:
+        if record.get(key) is not None:
+            context_dict[key] = record[key]
+    if isinstance(context_dict.get('json_schema'), dict):
+        context_dict['json_schema'] = json.dumps(context_dict['json_schema'])
+    context_dict['stream'] = False
+    return PaipeContext.model_validate(context_dict)
+
+
+async def run_record(pool: AgentPool, index: int, line: str, defaults: dict) -> dict:
+    result = {'index': index, 'id': None, 'output': None, 'usage': None, 'error': None}
+    try:
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError('Record is not a JSON object')
+        result['id'] = record.get('id')
+        context = to_context(record, defaults)
+        run_result = await run_context(context, pool.get_agent(context))
+        if isinstance(run_result.data, pydantic.BaseModel):
+            result['output'] = run_result.data.model_dump(mode='json')
+        else:
+            result['output'] = format_result_data(context, run_result.data)
+        result['usage'] = usage_to_dict(run_result.usage())
+    except Exception as e:
+        logger.debug(f'[batch] record {index} failed', exc_info=True)
+        result['error'] = f'{type(e).__name__}: {e}'
+    return result
+
+
+async def map_bounded(items: AsyncIterator,
+                      run: Callable[[Any], Awaitable[Any]],
+                      emit: Callable[[Any], None],
+                      concurrency: int = 8,
+                      ordered: bool = True):
+    '''
+    Await `run(item)` for each item with at most `concurrency` in flight, and
+    call `emit(result)` in input order, or in order of completion.
+
+    Items are read only as fast as results are emitted, so memory stays
+    bounded on unbounded input, even when a slow item holds up an ordered run.
+    '''
+    concurrency = max(1, concurrency)
+    queue = asyncio.Queue(maxsize=concurrency)
+    window = asyncio.Semaphore(concurrency * 4)
+    pending = {}
+    next_seq = 0
+
+    def done(seq: int, result):
+        nonlocal next_seq
+        if not ordered:
+            emit(result)
+            window.release()
+            return
+        pending[seq] = result
+        while next_seq in pending:
+            emit(pending.pop(next_seq))
+            window.release()
+            next_seq += 1
+
+    async def read():
+        seq = 0
+        async for item in items:
+            await window.acquire()
+            await queue.put((seq, item))
+            seq += 1
+        for __ in range(concurrency):
+            await queue.put(None)
+
+    async def work():
+        while (entry := await queue.get()) is not None:
+            seq, item = entry
+            done(seq, await run(item))
+
+    await asyncio.gather(read(), *[work() for __ in range(concurrency)])
+
+
+async def run_batch(input_fd: IO,
+                    output_fd: IO,
+                    defaults: dict | None = None,
+                    concurrency: int = 8,
+                    ordered: bool = True,
+                    skip: set[int] | None = None):
+    '''
+    Run each record from input_fd and write the results to output_fd.
+
+    With `ordered`, results are written in input order, otherwise in order of
+    completion. Records whose index is in `skip` are not run again.
+    Returns the total usage of the records run.
+    '''
+    defaults = defaults or {}
+    skip = skip or set()
+    pool = AgentPool()
+    total_usage = pydantic_ai.result.Usage()
+
+    async def read():
+        index = 0
+        while line := await asyncio.to_thread(input_fd.readline):
+            if not line.strip():
+                continue
+            if index not in skip:
+                yield (index, line)
+            index += 1
+
+    async def run(item):
+        return await run_record(pool, *item, defaults)
+
+    def write(result: dict):
+        nonlocal total_usage
+        output_fd.write(json.dumps(result, ensure_ascii=False) + '\n')
+        output_fd.flush()
+        if result['usage']:
+            total_usage = total_usage + pydantic_ai.result.Usage(**result['usage'])
+
+    await map_bounded(read(), run, write, concurrency=concurrency, ordered=ordered)
+    return total_usage
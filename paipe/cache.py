@@ -0,0 +1,141 @@
+'''
+Content-addressed on-disk caches, of LLM responses and of fetched pages.
+
+Each entry is a JSON file named by the hash of everything that determines its
+content. The mtime of an entry is its last access time, which drives the LRU
+eviction when the cache grows past its size cap. The size of the cache is
+measured once, then tracked as entries are stored, so the directory is only
+scanned again when the cap is passed.
+'''
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+from .util import logger, get_cache_dir
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+
+def cache_key(profile: dict,
+              model_name: str | None,
+              system_prompt: str | None,
+              prompt: str,
+              json_schema: str | None,
+              attachments: list | None = None) -> str:
+    '''
+    Hash the inputs of a request into a cache key.
+    '''
+    payload = {
+        'profile': profile,
+        'model': model_name,
+        'system_prompt': system_prompt,
+        'prompt': prompt,
+        'json_schema': json_schema,
+        'attachments': [
+            (media_type, hashlib.sha256(data).hexdigest())
+            for (media_type, data) in attachments or []
+        ],
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    '''
+    Store JSON entries by key in a directory, one file per entry.
+    '''
+    def __init__(self,
+                 directory: Path,
+                 ttl: float | None = None,
+                 max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+        # Approximate size of the entries, None until measured
+        self._size = None
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}.json'
+
+    def get(self, key: str) -> dict | None:
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as fd:
+                entry = json.load(fd)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.debug(f'[cache] drop unreadable entry {path}: {e}')
+            path.unlink(missing_ok=True)
+            return None
+        if self.ttl and time.time() - entry.get('created', 0) > self.ttl:
+            logger.debug(f'[cache] expired {key}')
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        logger.debug(f'[cache] hit {key}')
+        return entry
+
+    def put(self, key: str, entry: dict):
+        entry = {'created': time.time(), **entry}
+        path = self._path(key)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fd:
+            json.dump(entry, fd, ensure_ascii=False)
+            size = fd.tell()
+        if self._size is None:
+            self.evict()
+        try:
+            self._size -= path.stat().st_size
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        self._size += size
+        logger.debug(f'[cache] stored {key}')
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits its size cap.
+        '''
+        entries = []
+        total = 0
+        for path in self.directory.glob('*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total > self.max_size:
+            entries.sort()
+            for (__, size, path) in entries:
+                if total <= self.max_size:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                logger.debug(f'[cache] evicted {path.name}')
+        self._size = total
+
+
+class ResponseCache(DiskCache):
+    '''
+    Store responses as `{"deltas": [...], "usage": {...}}` entries.
+
+    A streamed response keeps its deltas so a hit can be replayed with the
+    same output shape, a non-stream response is stored as a single delta.
+    '''
+    def __init__(self,
+                 directory: Path | None = None,
+                 ttl: float | None = DEFAULT_TTL,
+                 max_size: int = DEFAULT_MAX_SIZE):
+        super().__init__(directory or get_cache_dir('responses'), ttl, max_size)
+
+    def put(self, key: str, deltas: list[str], usage: dict | None = None):
+        super().put(key, {'deltas': deltas, 'usage': usage})
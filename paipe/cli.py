@@ -1,15 +1,12 @@
 '''
 The command line interface (CLI).
 '''
+import os
 import sys
+import time
 import argparse
-import asyncio
 from . import util
-from .models import PaipeContext
 from .profiles import list_profiles, inspect_profile
-from .main import run_agent
-
-util.patch_video_mimetype()
 
 GLOBAL_ACTION_ARGS = [
     '-h', '--help',
@@ -20,9 +17,13 @@ GLOBAL_ARGS = GLOBAL_ACTION_ARGS + [
     '--version'
 ]
 
+START_TIME = time.perf_counter()
+
 SUB_COMMANDS = [
     'call',
-    'op'
+    'op',
+    'batch',
+    'serve'
 ]
 
 def build_call_parser(parser):
@@ -40,11 +41,28 @@ def build_call_parser(parser):
     parser.set_defaults(stream=True)
     parser.add_argument('-P', '--profile',
                         type=str,
-                        help='Specify the profile to use')
+                        help='Specify the profile to use, or several separated by commas with --race or --hedge-after')
+    parser.add_argument('--race',
+                        action='store_true',
+                        help='Start the call on all the profiles of -P at once, and keep the first to output')
+    parser.add_argument('--hedge-after',
+                        type=float,
+                        default=None,
+                        metavar='MS',
+                        help='Start the call on the next profile of -P when no output came within MS milliseconds')
     parser.add_argument('--json',
                         type=str,
                         default=None,
-                        help='The JSON Schema for the result, implies --no-stream')
+                        help='The JSON Schema for the result, implies --no-stream unless --json-stream')
+    parser.add_argument('--json-stream',
+                        type=str,
+                        default=None,
+                        choices=['snapshot', 'items'],
+                        help='Stream the --json result as NDJSON, snapshots of the partial object, or each item of an array field once complete')
+    parser.add_argument('--json-items',
+                        type=str,
+                        default=None,
+                        help='The array field of --json-stream items, the first array field by default')
     parser.add_argument('--file',
                        type=str,
                        help='Read text from a file and append to the prompt')
@@ -70,7 +88,11 @@ def build_call_parser(parser):
                         type=str,
                         default=None,
                         const=True,
-                        help='Extract last code block matched from the resposne, with optional language specified, implies --no-stream')
+                        help='Extract last code block matched from the resposne, with optional language specified')
+    parser.add_argument('--first-block',
+                        dest='first_code_block',
+                        action='store_true',
+                        help='With -e, stream the first code block matched instead, and stop the response once it is closed')
     parser.add_argument('-o', '--operation',
                         type=str,
                         action=util.DeprecatedAction,
@@ -79,6 +101,93 @@ def build_call_parser(parser):
     parser.add_argument('--usage',
                         action='store_true',
                         help='Show usage information in stderr.')
+    parser.add_argument('--stable-prefix',
+                        dest='stable_prefix',
+                        action='store_true',
+                        default=None,
+                        help='Put the input and attachments ahead of the prompt, so providers can cache them as a prefix(default for large inputs)')
+    parser.add_argument('--no-stable-prefix',
+                        dest='stable_prefix',
+                        action='store_false',
+                        help='Put the prompt ahead of the input')
+    parser.add_argument('--cache',
+                        action='store_true',
+                        help='Serve repeated requests from the on-disk response cache')
+    parser.add_argument('--cache-ttl',
+                        type=float,
+                        default=7 * 24 * 3600,
+                        help='Seconds before a cached response expires, 0 for never(default 7 days)')
+    parser.add_argument('--cache-max-size',
+                        type=int,
+                        default=256,
+                        help='Max size of the response cache in MB, least recently used entries are evicted(default 256)')
+    parser.add_argument('--map-reduce',
+                        action='store_true',
+                        help='Run the prompt over chunks of an input too large for one request, then combine the results')
+    parser.add_argument('--chunk-tokens',
+                        type=int,
+                        default=8000,
+                        help='Max estimated tokens of an input chunk in --map-reduce mode(default 8000)')
+    parser.add_argument('--map-concurrency',
+                        type=int,
+                        default=4,
+                        help='Max concurrent requests in --map-reduce mode(default 4)')
+    parser.add_argument('--reduce-prompt',
+                        type=str,
+                        default=None,
+                        help='The prompt combining the partial results in --map-reduce mode')
+    parser.add_argument('--each-line',
+                        dest='each_record',
+                        action='store_const',
+                        const='line',
+                        help='Run the prompt over each line of stdin as its own input')
+    parser.add_argument('--each-record',
+                        dest='each_record',
+                        type=str,
+                        choices=['line', 'nul', 'jsonl'],
+                        help='Run the prompt over each record of stdin as its own input, records are lines, NUL-delimited or JSONL objects')
+    parser.add_argument('-j', '--concurrency',
+                        type=int,
+                        default=8,
+                        help='Max concurrent requests in --each-line/--each-record mode(default 8)')
+    parser.add_argument('--keep-order',
+                        action='store_true',
+                        help='Write the outputs of --each-line/--each-record in input order, instead of as each one finishes')
+    parser.add_argument('--context-index',
+                        type=str,
+                        default=None,
+                        metavar='DIR',
+                        help='Send the chunks of an index of `paipe op index` matching the prompt best as the input')
+    parser.add_argument('--semantic-context',
+                        action='store_true',
+                        help='Retrieve the chunks closest to the prompt by embeddings, from the index of --context-index(default .paipe-index) built with --embed')
+    parser.add_argument('--top-k',
+                        type=int,
+                        default=8,
+                        help='Number of chunks retrieved with --context-index or --semantic-context(default 8)')
+    parser.add_argument('--session',
+                        type=str,
+                        default=None,
+                        metavar='NAME',
+                        help='Continue the conversation of a named session, stored locally')
+    parser.add_argument('--session-budget',
+                        type=int,
+                        default=16000,
+                        help='Max estimated tokens of the session history resent with a call(default 16000)')
+    parser.add_argument('--session-compact',
+                        choices=['drop', 'summarize'],
+                        default='drop',
+                        help='How turns past the session budget are compacted: dropped, or summarized by the model(default drop)')
+    parser.add_argument('--metrics',
+                        action='store_true',
+                        help='Show latency and throughput metrics in stderr, and append them to the metrics log')
+    parser.add_argument('--metrics-file',
+                        type=str,
+                        default=None,
+                        help='Append the metrics to a file instead of stderr, implies --metrics')
+    parser.add_argument('--no-daemon',
+                        action='store_true',
+                        help='Run in-process even if a daemon of `paipe serve` is up')
     parser.add_argument('prompt',
                        nargs='*',
                        type=str,
@@ -86,6 +195,56 @@ def build_call_parser(parser):
                        help='The prompt to process')
 
 
+def build_batch_parser(parser):
+    parser.add_argument('input',
+                        nargs='?',
+                        type=str,
+                        default=None,
+                        help='The JSONL file of records to run, read from stdin if omitted')
+    parser.add_argument('--output',
+                        type=str,
+                        default=None,
+                        help='Write the JSONL results to a file instead of stdout')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Skip records already finished in --output and append the rest')
+    parser.add_argument('-j', '--concurrency',
+                        type=int,
+                        default=8,
+                        help='The number of records to run concurrently')
+    parser.add_argument('--order',
+                        type=str, default='input', choices=['input', 'completion'],
+                        help='Write results in input order, or as soon as each one completes')
+    parser.add_argument('-P', '--profile',
+                        type=str,
+                        help='The default profile for records without one')
+    parser.add_argument('-S', '--system-prompt',
+                        type=str,
+                        help='The default system prompt for records without one')
+    parser.add_argument('--json',
+                        type=str,
+                        default=None,
+                        help='The default JSON Schema for records without one')
+    parser.add_argument('--model',
+                        type=str,
+                        default=None,
+                        help='The default model for records without one(Overrides the profile)')
+    parser.add_argument('--usage',
+                        action='store_true',
+                        help='Show total usage information in stderr.')
+
+
+def build_serve_parser(parser):
+    parser.add_argument('--socket',
+                        type=str,
+                        default=None,
+                        help='The path of the Unix socket, $PAIPE_SOCKET or paipe.sock in $XDG_RUNTIME_DIR by default')
+    parser.add_argument('-P', '--profile',
+                        type=str,
+                        action='append',
+                        help='Build the agent of a profile at startup, can be repeated')
+
+
 def build_parser(with_sub_parser: bool, default_call_parser: bool) -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(prog='paipe',
                                      description='A CLI tool for accessing the LLM API in the terminal.')
@@ -100,6 +259,10 @@ def build_parser(with_sub_parser: bool, default_call_parser: bool) -> argparse.A
         command_parser = sub_parsers.add_parser('op', help='Perform a specific operation')
         from .operations.subcli import build_command_parser
         build_command_parser(command_parser)
+        batch_parser = sub_parsers.add_parser('batch', help='Run a JSONL file of prompts concurrently.')
+        build_batch_parser(batch_parser)
+        serve_parser = sub_parsers.add_parser('serve', help='Run a daemon keeping profiles and agents warm for calls.')
+        build_serve_parser(serve_parser)
 
     # Bind sub parser 'call' as root parser 
     if default_call_parser:
@@ -151,13 +314,45 @@ def handle_call(args):
     context_dict = {
         'stream': args.stream,
         'prompt': ' '.join(args.prompt),
+        'stable_prefix': args.stable_prefix,
         'json_schema': args.json,
+        'json_stream': args.json_stream,
+        'json_items': args.json_items,
         'extract_code_block': args.extract_code_block,
+        'first_code_block': args.first_code_block,
         'model': args.model,
         'attachments': [],
         'usage': args.usage,
+        'cache': args.cache,
+        'cache_ttl': args.cache_ttl or None,
+        'cache_max_size': args.cache_max_size * 1024 * 1024,
+        'map_reduce': args.map_reduce,
+        'chunk_tokens': args.chunk_tokens,
+        'map_concurrency': args.map_concurrency,
+        'reduce_prompt': args.reduce_prompt,
+        'each_record': args.each_record,
+        'concurrency': args.concurrency,
+        'keep_order': args.keep_order,
+        'session': args.session,
+        'session_budget': args.session_budget,
+        'session_compact': args.session_compact,
+        'metrics': args.metrics or bool(args.metrics_file),
+        'metrics_file': os.path.abspath(args.metrics_file) if args.metrics_file else None,
     }
-    if args.file:
+    if args.json_stream and not args.json:
+        print('--json-stream requires a JSON schema with --json')
+        sys.exit(1)
+    if args.json_stream == 'items' and not args.json_items:
+        from .structured import find_items_field
+        if find_items_field(args.json) is None:
+            print('--json-stream items requires an array field in the JSON schema, or --json-items')
+            sys.exit(1)
+    if args.each_record:
+        # Records are read from the stream as the calls go
+        if not args.file and sys.stdin.isatty():
+            print('No input via stdin or a file with --file provided to read records from')
+            sys.exit(1)
+    elif args.file:
         with open(args.file, 'r') as f:
             context_dict['input_text'] = f.read()
     elif not sys.stdin.isatty():
@@ -168,22 +363,132 @@ def handle_call(args):
             sys.exit(1)        
 
     if args.profile:
-        context_dict['profile'] = args.profile
+        context_dict['profile'], *context_dict['fallback_profiles'] = \
+            [name.strip() for name in args.profile.split(',') if name.strip()] or ['default']
+        context_dict['race'] = args.race
+        context_dict['hedge_after'] = args.hedge_after
+        if context_dict['fallback_profiles'] and not (args.race or args.hedge_after is not None):
+            print('Several profiles require --race or --hedge-after')
+            sys.exit(1)
+        if context_dict['fallback_profiles'] and (args.map_reduce or args.each_record):
+            print('Several profiles are not supported with --map-reduce or --each-record')
+            sys.exit(1)
+    if args.session and (context_dict.get('fallback_profiles') or args.map_reduce or args.each_record):
+        print('--session is not supported with several profiles, --map-reduce or --each-record')
+        sys.exit(1)
+    if (args.context_index or args.semantic_context) and args.each_record:
+        print('--context-index and --semantic-context are not supported with --each-record')
+        sys.exit(1)
+    if (args.metrics or args.metrics_file) and (args.map_reduce or args.each_record):
+        print('--metrics is not supported with --map-reduce or --each-record')
+        sys.exit(1)
 
     if args.system_prompt:
         context_dict['system_prompt'] = args.system_prompt
     else:
         context_dict['system_prompt'] = None
 
+    if args.context_index or args.semantic_context:
+        if not context_dict['prompt']:
+            print('--context-index and --semantic-context require a prompt to retrieve the chunks for')
+            sys.exit(1)
+        from .operations.index import DEFAULT_INDEX_DIR, retrieve_context
+        index_dir = args.context_index or DEFAULT_INDEX_DIR
+        retrieve_start = time.perf_counter()
+        try:
+            if args.semantic_context:
+                import asyncio
+                from .profiles import get_profile
+                from .embeddings import Embedder
+                from .operations.vectors import retrieve_semantic_context
+                profile_name = context_dict.get('profile', 'default')
+                profile = get_profile(profile_name)
+                if profile is None:
+                    print(f"Profile {profile_name} is not available in the profile.")
+                    sys.exit(1)
+                retrieved = asyncio.run(retrieve_semantic_context(index_dir, Embedder(profile),
+                                                                  context_dict['prompt'], args.top_k))
+            else:
+                retrieved = retrieve_context(index_dir, context_dict['prompt'], args.top_k)
+        except (FileNotFoundError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        util.logger.debug(f'[index] retrieved in {(time.perf_counter() - retrieve_start) * 1000:.1f} ms')
+        context_dict['input_text'] = retrieved + context_dict.get('input_text', '')
+
     if args.attach:
         context_dict['attachments'].extend(util.to_attachment_pairs(args.attach))
+        util.patch_video_mimetype()
 
     if args.operation:
         from .operations import handle_operation
         handle_operation(args.operation, context_dict)
     else:
+        if not args.each_record and not args.no_daemon:
+            from .client import forward_call
+            code = forward_call(context_dict)
+            if code is not None:
+                sys.exit(code)
+        from .metrics import Metrics
+        metrics = Metrics(start=START_TIME)
+        # Import the LLM stack only when a call is actually made
+        with metrics.phase('import'):
+            from .models import PaipeContext
+            from .main import AgentPool, run_agent
+            import asyncio
         context = PaipeContext.model_validate(context_dict)
-        asyncio.run(run_agent(context))
+        with metrics.phase('config_load'):
+            pool = AgentPool()
+            for name in [context.profile, *context.fallback_profiles]:
+                if pool.get_profile(name) is None:
+                    print(f"Profile {name} is not available in the profile.", file=sys.stderr)
+                    sys.exit(1)
+        if context.each_record:
+            from .records import run_records
+            input_stream = open(args.file, 'rb') if args.file else sys.stdin.buffer
+            asyncio.run(run_records(context, input_stream, sys.stdout))
+        elif context.fallback_profiles:
+            from .race import run_race
+            asyncio.run(run_race(context, pool))
+        elif context.map_reduce:
+            from .mapreduce import run_map_reduce
+            asyncio.run(run_map_reduce(context, pool))
+        else:
+            asyncio.run(run_agent(context, profile=pool.get_profile(context.profile), metrics=metrics))
+
+
+def handle_batch(args):
+    import asyncio
+    from .batch import run_batch, load_finished, ensure_trailing_newline
+    if args.resume and not args.output:
+        print('--resume requires --output')
+        sys.exit(1)
+    defaults = {
+        'profile': args.profile,
+        'system_prompt': args.system_prompt,
+        'json_schema': args.json,
+        'model': args.model,
+    }
+    skip = set()
+    if args.resume:
+        skip = load_finished(args.output)
+        ensure_trailing_newline(args.output)
+    input_fd = open(args.input, 'r', encoding='utf-8') if args.input else sys.stdin
+    output_fd = open(args.output, 'a' if args.resume else 'w', encoding='utf-8') \
+        if args.output else sys.stdout
+    try:
+        usage = asyncio.run(run_batch(input_fd, output_fd,
+                                      defaults=defaults,
+                                      concurrency=args.concurrency,
+                                      ordered=args.order == 'input',
+                                      skip=skip))
+    finally:
+        if input_fd is not sys.stdin:
+            input_fd.close()
+        if output_fd is not sys.stdout:
+            output_fd.close()
+    if args.usage:
+        util.show_json_usage(usage)
 
 
 def main():
@@ -194,6 +499,11 @@ def main():
     elif args.command == 'op':
         from .operations.base import handle_operation
         handle_operation(args)
+    elif args.command == 'batch':
+        handle_batch(args)
+    elif args.command == 'serve':
+        from .server import handle_serve
+        handle_serve(args)
     else:
         print(f'Unknown command: {args.command}')
         sys.exit(1)
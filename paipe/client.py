@@ -0,0 +1,98 @@
+'''
+Forward calls to the daemon of `paipe serve` over its Unix socket.
+
+This module is imported on every call, so it only depends on the standard
+library: a forwarded call never imports the LLM stack in the client.
+
+Each message is a line of JSON. The client sends `{"context": {...}}`, and the
+daemon replies with `{"stdout": "..."}` and `{"stderr": "..."}` as the call
+writes its output, then `{"exit": code}`.
+'''
+import os
+import sys
+import json
+import base64
+import socket
+from pathlib import Path
+from .util import logger, get_cache_dir
+
+
+def get_socket_path() -> Path:
+    '''
+    Return the socket path, $PAIPE_SOCKET, or paipe.sock in $XDG_RUNTIME_DIR
+    or the cache directory.
+    '''
+    if os.environ.get('PAIPE_SOCKET'):
+        return Path(os.environ['PAIPE_SOCKET'])
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return Path(os.environ['XDG_RUNTIME_DIR']) / 'paipe.sock'
+    return get_cache_dir() / 'paipe.sock'
+
+
+def encode_message(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+def encode_context(context_dict: dict) -> dict:
+    return {
+        **context_dict,
+        'attachments': [(media_type, base64.b64encode(data).decode('ascii'))
+                        for (media_type, data) in context_dict.get('attachments') or []],
+    }
+
+
+def decode_context(context_dict: dict) -> dict:
+    return {
+        **context_dict,
+        'attachments': [(media_type, base64.b64decode(data))
+                        for (media_type, data) in context_dict.get('attachments') or []],
+    }
+
+
+def connect(path: Path | None = None) -> socket.socket | None:
+    '''
+    Return a socket connected to the daemon, None if no daemon is up.
+    '''
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    path = path or get_socket_path()
+    if not path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError as e:
+        logger.debug(f'[client] daemon not available at {path}: {e}')
+        sock.close()
+        return None
+    return sock
+
+
+def forward_call(context_dict: dict) -> int | None:
+    '''
+    Run the call on the daemon and return its exit code, None if no daemon is
+    up or the call should run in-process.
+    '''
+    if os.environ.get('PAIPE_NO_DAEMON'):
+        return None
+    # The daemon reads the profiles of the user and system configs, not those of the current directory
+    if Path('./paipe.yaml').exists():
+        return None
+    sock = connect()
+    if sock is None:
+        return None
+    logger.debug('[client] forward the call to the daemon')
+    with sock, sock.makefile('rb') as reader:
+        sock.sendall(encode_message({'context': encode_context(context_dict)}))
+        for line in reader:
+            message = json.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+                sys.stdout.flush()
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+    print('The daemon closed the connection before the call finished', file=sys.stderr)
+    return 1
@@ -0,0 +1,112 @@
+'''
+Embeddings of texts through the OpenAI-compatible embeddings API of a profile.
+
+The `embeddings` section of a profile sets the model, and how requests are
+batched during indexing:
+
+    default:
+        provider: openai
+        base_url: 'https://api.openai.com/v1'
+        api_key: <YOUR_API_KEY>
+        model: 'gpt-4o-mini'
+        embeddings:
+            model: 'text-embedding-3-small'
+            batch_size: 64
+            concurrency: 4
+'''
+import asyncio
+from typing import Callable, List
+from .util import logger
+from .ratelimit import DEFAULT_RETRIES, RETRY_STATUS_CODES, retry_delay
+
+DEFAULT_EMBEDDING_MODEL = 'text-embedding-3-small'
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_CONCURRENCY = 4
+# Texts are cut to this many characters, to stay within the input limit of the models
+MAX_EMBEDDING_CHARS = 16000
+
+
+class Embedder:
+    '''
+    Embed texts with the embeddings settings of a resolved profile.
+    '''
+    def __init__(self, profile: dict, model: str | None = None):
+        settings = profile.get('embeddings') or {}
+        self.model = model or settings.get('model') or DEFAULT_EMBEDDING_MODEL
+        self.dimensions = settings.get('dimensions')
+        self.batch_size = settings.get('batch_size') or DEFAULT_BATCH_SIZE
+        self.concurrency = settings.get('concurrency') or DEFAULT_CONCURRENCY
+        self.retries = settings.get('retries', DEFAULT_RETRIES)
+        self.client = get_embeddings_client(profile)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        # The connections belong to the event loop they were opened in
+        await self.client.close()
+
+    @property
+    def key(self) -> str:
+        '''
+        The model and dimensions, vectors of different keys are not comparable.
+        '''
+        return f'{self.model}:{self.dimensions}' if self.dimensions else self.model
+
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        import openai
+        params = {'model': self.model, 'input': [text[:MAX_EMBEDDING_CHARS] or ' ' for text in texts]}
+        if self.dimensions:
+            params['dimensions'] = self.dimensions
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.embeddings.create(**params)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except (openai.APIStatusError, openai.APIConnectionError) as e:
+                status = getattr(e, 'status_code', None)
+                if attempt >= self.retries or (status is not None and status not in RETRY_STATUS_CODES):
+                    raise
+                delay = retry_delay(getattr(getattr(e, 'response', None), 'headers', None), attempt)
+                logger.debug(f'[embeddings] retry in {delay:.2f}s after {type(e).__name__}')
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def embed(self,
+                    texts: List[str],
+                    on_batch: Callable[[int, List[List[float]]], None] | None = None) -> List[List[float]]:
+        '''
+        Embed texts in batches, concurrently, on_batch(start, vectors) is called as each batch is done.
+        '''
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_batch(start: int):
+            async with semaphore:
+                vectors = await self.embed_batch(texts[start:start + self.batch_size])
+            if on_batch:
+                on_batch(start, vectors)
+            return vectors
+
+        results = await asyncio.gather(*(run_batch(start) for start in range(0, len(texts), self.batch_size)))
+        return [vector for vectors in results for vector in vectors]
+
+
+def get_embeddings_client(profile: dict):
+    '''
+    Return an AsyncOpenAI client of a profile, built as for its agent model,
+    with connections of its own, not the ones shared with the agents. Its
+    retries are left to Embedder.
+    '''
+    from .main import get_agent_provider
+    params = {key: value for (key, value) in profile.items()
+              if key not in ('model', 'system_prompt', 'model_settings', 'attachments', 'embeddings', 'rate_limit')}
+    protocol = params.pop('protocol', None) or params.pop('provider', None) or 'openai'
+    provider = params.pop('provider', None) or 'openai'
+    if protocol != 'openai':
+        raise ValueError(f'Embeddings are only supported by the openai protocol, not {protocol}')
+    provider_instance = get_agent_provider(provider, params)
+    import openai
+    if provider_instance is not None and hasattr(provider_instance, 'client'):
+        return provider_instance.client.with_options(http_client=openai.DefaultAsyncHttpxClient(),
+                                                     max_retries=0)
+    return openai.AsyncOpenAI(base_url=profile.get('base_url'), api_key=profile.get('api_key'), max_retries=0)
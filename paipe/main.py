@@ -1,20 +1,27 @@
-import sys
 import json
 from pathlib import Path
 import pydantic
-import dydantic
 import pydantic_ai.models
 from pydantic_ai import Agent
 from pydantic_ai.messages import BinaryContent
 from .models import PaipeContext
+from .metrics import Metrics, report_metrics
+from .structured import get_schema_model, new_structured_stream, stream_structured_result
 from .util import (
     logger,
     import_module,
     extract_markdown_code_blocks,
-    show_json_usage
+    CodeBlockStream,
+    drain_output,
+    show_json_usage,
+    usage_to_dict,
+    estimate_tokens
 )
 from . profiles import get_profile
 
+# The least prompt tokens providers cache as a prefix
+STABLE_PREFIX_MIN_TOKENS = 1024
+
 
 def import_model_module(name: str):
     module = import_module('paipe.providers', name)
@@ -43,9 +50,11 @@ def get_agent_provider_cls(module):
     return None
 
 
-def get_agent_model(model_name: str, protocol: str, provider: str, **profile):
-    model_params = {}
-    model_cls = get_agent_model_cls(import_model_module(protocol))
+def get_agent_provider(provider: str, profile: dict):
+    '''
+    Return the provider instance of a profile, None if not supported, the
+    settings taken by the provider are popped from profile.
+    '''
     provider_module = import_provider_module(provider)
     if provider_module:
         provider_cls = get_agent_provider_cls(provider_module)
@@ -56,86 +65,323 @@ def get_agent_model(model_name: str, protocol: str, provider: str, **profile):
                     continue
                 if key in profile:
                     provider_params[key] = profile.pop(key)
-            provider_instance = provider_cls(**provider_params)
-            model_params['provider'] = provider_instance
+            return provider_cls(**provider_params)
+    return None
+
+
+def get_agent_model(model_name: str, protocol: str, provider: str, **profile):
+    model_params = {}
+    model_cls = get_agent_model_cls(import_model_module(protocol))
+    provider_instance = get_agent_provider(provider, profile)
+    if provider_instance:
+        model_params['provider'] = provider_instance
     model_params.update(profile)
     return model_cls(model_name, **model_params)
 
 
-def process_prompt(full_prompt: str, attachments: list | None = None) -> str | list:
-    if not attachments:
-        result = full_prompt
-    else:
-        result = [
-            full_prompt
-        ]
-        for (media_type, data) in attachments:
-            content = BinaryContent(
-                data=data,
-                media_type=media_type
-            )
-            result.append(content)
-        else:
-            pass
+def process_prompt(full_prompt: str,
+                   attachments: list | None = None,
+                   instruction: str = '') -> str | list:
+    '''
+    Return the user prompt, of the text, then the attachments, then the instruction if any.
+    '''
+    result = [full_prompt] if full_prompt else []
+    for (media_type, data) in attachments or []:
+        content = BinaryContent(
+            data=data,
+            media_type=media_type
+        )
+        result.append(content)
+    if instruction:
+        result.append(instruction)
+    if not result:
+        return full_prompt
+    if len(result) == 1 and isinstance(result[0], str):
+        return result[0]
     return result
 
 
-async def run_agent(context: PaipeContext):
-    profile = get_profile(context.profile)
-    if profile is None:
-        print(f"Profile {context.profile} is not available in the profile.")
-        sys.exit(1)
+def prepare_attachments(context: PaipeContext, profile: dict) -> list:
+    '''
+    Dedupe and preprocess the attachments with the settings of the profile.
+    '''
+    if not context.attachments:
+        return []
+    from .attachments import preprocess_attachments
+    return preprocess_attachments(context.attachments, profile.get('attachments'))
+
 
+def build_agent(context: PaipeContext, profile: dict) -> Agent:
+    '''
+    Build an agent for the context from a resolved profile.
+    '''
+    profile = dict(profile)
     protocol = profile.pop('protocol', None) or profile.pop('provider', None) or 'openai'
     provider = profile.pop('provider', None) or 'openai'
     model = profile.pop('model', None) or ''
     profile_system_prompt = profile.pop('system_prompt', None)
     model_settings =  profile.pop('model_settings', None)
+    profile.pop('attachments', None)
+    profile.pop('embeddings', None)
+    rate_limit = profile.pop('rate_limit', None)
 
     agent_params = {
         "system_prompt": context.system_prompt or profile_system_prompt or (),
         "model_settings": model_settings
     }
     if context.json_schema:
-        agent_params['result_type'] = dydantic.create_model_from_schema(
-                json.loads(context.json_schema))
-        context.stream = False
-    elif context.extract_code_block:
-        context.stream = False
+        agent_params['result_type'] = get_schema_model(context.json_schema)
     logger.debug(f'[model to use] {context.model or model}')
 
-    agent = Agent(get_agent_model(context.model or model, protocol, provider, **profile),
-                  **agent_params)
+    agent_model = get_agent_model(context.model or model, protocol, provider, **profile)
+    if rate_limit:
+        if hasattr(agent_model, 'set_rate_limit'):
+            agent_model.set_rate_limit(rate_limit,
+                                       profile.get('base_url'), profile.get('api_key'), context.model or model)
+        else:
+            logger.warning(f'rate_limit is not supported by the {protocol} protocol')
+    return Agent(agent_model, **agent_params)
+
+
+class AgentPool:
+    '''
+    Share resolved profiles and agents between contexts in one process.
+
+    Agents are keyed by everything `build_agent` reads from the context, so
+    contexts with the same profile, model, system prompt and schema reuse one
+    agent (and the HTTP client of its model). With revalidate, profiles are
+    looked up again on each use, and an edited profile gets a new agent,
+    replacing the agent of its previous version.
+    '''
+    def __init__(self, revalidate: bool = False):
+        self.revalidate = revalidate
+        self._profiles = {}
+        self._agents = {}
+
+    def get_profile(self, profile_name: str) -> dict | None:
+        if self.revalidate or profile_name not in self._profiles:
+            self._profiles[profile_name] = get_profile(profile_name)
+        return self._profiles[profile_name]
+
+    def get_agent(self, context: PaipeContext) -> Agent:
+        profile = self.get_profile(context.profile)
+        if profile is None:
+            raise ValueError(f"Profile {context.profile} is not available in the profile.")
+        key = (context.profile, context.model, context.system_prompt, context.json_schema)
+        version = json.dumps(profile, sort_keys=True, default=str)
+        if key not in self._agents or self._agents[key][0] != version:
+            self._agents[key] = (version, build_agent(context, profile))
+        return self._agents[key][1]
+
+
+def build_full_prompt(context: PaipeContext) -> str:
     full_prompt  = ''
     if context.prompt:
         full_prompt += f'{context.prompt}\n'
     if context.input_text:
         full_prompt += f'{context.input_text}\n'
+    return full_prompt
+
+
+def use_stable_prefix(context: PaipeContext) -> bool:
+    '''
+    Whether to put the input text ahead of the prompt, by default once the
+    input is large enough for providers to cache it as a prompt prefix.
+    '''
+    if context.stable_prefix is not None:
+        return context.stable_prefix
+    return estimate_tokens(context.input_text) >= STABLE_PREFIX_MIN_TOKENS
+
+
+def build_prompt_parts(context: PaipeContext) -> tuple[str, str]:
+    '''
+    Return the text sent ahead of the attachments, and the instruction sent after them.
+
+    With a stable prefix, the input text comes first and the prompt last, so
+    calls asking different questions about the same input share a prefix.
+    '''
+    if not use_stable_prefix(context):
+        return build_full_prompt(context), ''
+    prefix = f'{context.input_text}\n' if context.input_text else ''
+    instruction = f'{context.prompt}\n' if context.prompt else ''
+    return prefix, instruction
+
+
+def code_block_language(context: PaipeContext) -> str:
+    return '' if context.extract_code_block is True else context.extract_code_block
+
+
+def format_result_data(context: PaipeContext, data) -> str:
+    '''
+    Format the data of a non-stream result as the text to output.
+    '''
+    if context.json_schema and isinstance(data, pydantic.BaseModel):
+        return data.model_dump_json()
+    elif context.extract_code_block and isinstance(data, str):
+        language = code_block_language(context)
+        code_blocks = extract_markdown_code_blocks(
+            data,
+            language=language
+        )
+        if not code_blocks:
+            logger.warning(f"No {language} code block detected.")
+        if not code_blocks:
+            return ''
+        return code_blocks[0] if context.first_code_block else code_blocks[-1]
+    return data
+
+
+async def run_context(context: PaipeContext, agent: Agent):
+    '''
+    Run a context without streaming, return the result.
+    '''
+    prefix, instruction = build_prompt_parts(context)
+    processed_prompt = process_prompt(prefix,
+                                      attachments=context.attachments,
+                                      instruction=instruction)
+    return await agent.run(processed_prompt)
 
-    processed_prompt = process_prompt(full_prompt,
-                                      attachments=context.attachments)
 
-    if context.stream:
-        async with agent.run_stream(processed_prompt) as response:
-            async for delta in response.stream_text(delta=True):
-                print(delta, end='', flush=True)
-        print()
-        if context.usage:
-            show_json_usage(response.usage())
+def get_response_cache(context: PaipeContext, profile: dict, prompt: str):
+    '''
+    Return the response cache and the key of the context, or (None, None)
+    if the cache is not enabled.
+    '''
+    if not context.cache:
+        return None, None
+    from .cache import ResponseCache, cache_key
+    cache = ResponseCache(ttl=context.cache_ttl,
+                          max_size=context.cache_max_size)
+    key = cache_key(profile,
+                    context.model or profile.get('model'),
+                    context.system_prompt or profile.get('system_prompt'),
+                    prompt,
+                    context.json_schema,
+                    context.attachments)
+    return cache, key
+
+
+def replay_cached(context: PaipeContext, entry: dict, stdout=None, stderr=None):
+    if context.stream and context.json_schema:
+        stream = new_structured_stream(context, stdout)
+        text = ''.join(entry['deltas'])
+        stream.feed(text)
+        stream.close(get_schema_model(context.json_schema).model_validate_json(text))
+    elif context.stream and context.extract_code_block:
+        blocks = CodeBlockStream(code_block_language(context), first=context.first_code_block)
+        for delta in entry['deltas']:
+            print(blocks.feed(delta), end='', flush=True, file=stdout)
+        print(blocks.close(), file=stdout)
+    elif context.stream:
+        for delta in entry['deltas']:
+            print(delta, end='', flush=True, file=stdout)
+        print(file=stdout)
+    elif context.json_schema:
+        print(''.join(entry['deltas']), file=stdout)
+    else:
+        print(format_result_data(context, ''.join(entry['deltas'])), file=stdout)
+    if context.usage:
+        show_json_usage(entry.get('usage') or {}, file=stderr, cached=True)
+
+
+async def run_agent(context: PaipeContext,
+                    agent: Agent | None = None,
+                    profile: dict | None = None,
+                    stdout=None,
+                    stderr=None,
+                    metrics: Metrics | None = None):
+    '''
+    Run the context and print the result, to stdout and stderr unless specified.
+    '''
+    metrics = metrics or Metrics()
+    if profile is None:
+        with metrics.phase('config_load'):
+            profile = get_profile(context.profile)
+        if profile is None:
+            raise ValueError(f"Profile {context.profile} is not available in the profile.")
+    if context.json_schema and not context.json_stream:
+        context.stream = False
+
+    prefix, instruction = build_prompt_parts(context)
+    full_prompt = prefix + instruction
+    cache, cache_key = get_response_cache(context, profile, full_prompt)
+    session = None
+    if context.session:
+        from .session import Session
+        session = Session(context.session, context.session_budget, context.session_compact)
+        # The response to a prompt depends on the conversation before it
+        cache = None
+    if cache and (entry := cache.get(cache_key)):
+        replay_cached(context, entry, stdout, stderr)
+        if context.metrics:
+            report_metrics(metrics.summary(entry.get('usage'), cached=True),
+                           context.metrics_file, stderr)
+        return entry.get('usage')
+
+    if agent is None:
+        with metrics.phase('model_construction'):
+            agent = build_agent(context, profile)
+    processed_prompt = process_prompt(prefix,
+                                      attachments=prepare_attachments(context, profile),
+                                      instruction=instruction)
+    history = None
+    if session:
+        history = session.load(context.system_prompt or profile.get('system_prompt')) or None
+
+    metrics.start_request()
+    if context.stream and context.json_schema:
+        stream = new_structured_stream(context, stdout)
+        async with agent.run_stream(processed_prompt, message_history=history) as response:
+            metrics.mark_sent()
+            data = await stream_structured_result(response, stream, metrics)
+        metrics.end_request()
+        deltas = [data.model_dump_json()]
+        usage = response.usage()
+    elif context.stream:
+        deltas = []
+        blocks = None
+        if context.extract_code_block:
+            blocks = CodeBlockStream(code_block_language(context), first=context.first_code_block)
+        async with agent.run_stream(processed_prompt, message_history=history) as response:
+            metrics.mark_sent()
+            # Not debounced, the deltas are printed and timed as they arrive
+            async for delta in response.stream_text(delta=True, debounce_by=None):
+                metrics.add_delta(delta)
+                deltas.append(delta)
+                if blocks is None:
+                    print(delta, end='', flush=True, file=stdout)
+                    await drain_output(stdout)
+                    continue
+                print(blocks.feed(delta), end='', flush=True, file=stdout)
+                await drain_output(stdout)
+                if blocks.done and not session:
+                    # The first block is complete, cancel the rest of the response, unless kept in a session
+                    break
+        metrics.end_request()
+        print(blocks.close() if blocks else '', file=stdout)
+        usage = response.usage()
+        if blocks and blocks.done:
+            # A truncated response is not cached
+            cache = None
     else:
-        result = await agent.run(processed_prompt)
+        result = await agent.run(processed_prompt, message_history=history)
+        metrics.end_request()
         if context.json_schema and isinstance(result.data, pydantic.BaseModel):
-            print(result.data.model_dump_json())
-        elif context.extract_code_block and isinstance(result.data, str):
-            language = '' if context.extract_code_block is True else context.extract_code_block
-            code_blocks = extract_markdown_code_blocks(
-                result.data,
-                language=language
-            )
-            if not code_blocks:
-                logger.warning(f"No {language} code block detected.")
-            print(code_blocks[-1] if code_blocks else '')
+            deltas = [result.data.model_dump_json()]
         else:
-            print(result.data)
-        if context.usage:
-            show_json_usage(result.usage())
+            deltas = [result.data]
+        print(format_result_data(context, result.data), file=stdout)
+        usage = result.usage()
+    if session:
+        await session.save((response if context.stream else result).new_messages(), agent)
+    if cache:
+        cache.put(cache_key, deltas, usage_to_dict(usage))
+    if context.usage:
+        show_json_usage(usage, file=stderr)
+    if context.metrics:
+        report_metrics(metrics.summary(usage,
+                                       profile=context.profile,
+                                       model=context.model or profile.get('model'),
+                                       stream=context.stream),
+                       context.metrics_file, stderr)
+    return usage
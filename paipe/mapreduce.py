@@ -0,0 +1,172 @@
+'''
+Map-reduce over inputs larger than the context window.
+
+The input text is split into token-budgeted chunks, preferably on the file
+wrappers of `paipe op archive`, then on paragraphs and lines. The prompt is
+run over each chunk concurrently, and a reduce prompt combines the partial
+results into the final answer, which is streamed.
+'''
+import re
+import asyncio
+import pydantic_ai.result
+from .models import PaipeContext
+from .main import AgentPool, run_agent, run_context
+from .operations.archive import wrap_html_comment
+from .util import logger, estimate_tokens, show_json_usage
+
+DEFAULT_REDUCE_PROMPT = '''\
+The following are partial answers to the instruction below, each one given \
+over a different part of a larger input. Combine them into one final answer \
+to the instruction, as if it had been given over the whole input.
+
+Instruction: {prompt}
+'''
+
+# From the coarsest boundary to the finest, each piece ends after its match
+BOUNDARIES = [
+    # The file wrappers of archive(html and markdown) and of crawl
+    re.compile(r'<!-- end [^\n]* -->\n+|\[end [^\n]*\]: #\n+|^````\n+', re.MULTILINE),
+    # Paragraphs
+    re.compile(r'\n[ \t]*\n+'),
+    # Lines
+    re.compile(r'\n'),
+]
+
+
+def split_at(text: str, pattern: re.Pattern) -> list[str]:
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def split_units(text: str, max_tokens: int, level: int = 0) -> list[str]:
+    '''
+    Split text into pieces within max_tokens, on the coarsest boundary possible.
+    '''
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return [text]
+    if level == len(BOUNDARIES):
+        size = max(1, len(text) * max_tokens // tokens)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+    units = []
+    for piece in split_at(text, BOUNDARIES[level]):
+        units.extend(split_units(piece, max_tokens, level + 1))
+    return units
+
+
+def split_chunks(text: str, max_tokens: int) -> list[str]:
+    '''
+    Pack the pieces of text into as few chunks within max_tokens as possible.
+    '''
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for unit in split_units(text, max_tokens):
+        unit_tokens = estimate_tokens(unit)
+        if chunk and chunk_tokens + unit_tokens > max_tokens:
+            chunks.append(''.join(chunk))
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(unit)
+        chunk_tokens += unit_tokens
+    if chunk:
+        chunks.append(''.join(chunk))
+    return chunks
+
+
+def wrap_partials(partials: list[str]) -> str:
+    return ''.join(wrap_html_comment(f'part {i + 1}/{len(partials)}', partial)
+                   for (i, partial) in enumerate(partials))
+
+
+def split_chunks_of(partials: list[str], max_tokens: int) -> list[list[str]]:
+    '''
+    Group consecutive partial results into groups within max_tokens once wrapped.
+    '''
+    groups = []
+    group = []
+    group_tokens = 0
+    for partial in partials:
+        tokens = estimate_tokens(wrap_partials([partial]))
+        if group and group_tokens + tokens > max_tokens:
+            groups.append(group)
+            group = []
+            group_tokens = 0
+        group.append(partial)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+async def run_map_reduce(context: PaipeContext,
+                         pool: AgentPool | None = None,
+                         stdout=None,
+                         stderr=None):
+    pool = pool or AgentPool()
+    profile = pool.get_profile(context.profile)
+    if profile is None:
+        raise ValueError(f"Profile {context.profile} is not available in the profile.")
+    chunks = split_chunks(context.input_text, context.chunk_tokens)
+    if len(chunks) <= 1:
+        return await run_agent(context, agent=pool.get_agent(context), profile=profile,
+                               stdout=stdout, stderr=stderr)
+
+    # The partial results are plain text, the output options apply to the final answer
+    map_context = context.model_copy(update={
+        'json_schema': None,
+        'extract_code_block': None,
+        'attachments': [],
+        'stream': False,
+    })
+    limit = asyncio.Semaphore(max(1, context.map_concurrency))
+    total_usage = pydantic_ai.result.Usage()
+
+    async def run_chunk(chunk_context: PaipeContext) -> str:
+        nonlocal total_usage
+        async with limit:
+            result = await run_context(chunk_context, pool.get_agent(chunk_context))
+        total_usage = total_usage + result.usage()
+        return str(result.data)
+
+    logger.debug(f'[map-reduce] map over {len(chunks)} chunks')
+    partials = await asyncio.gather(*[
+        run_chunk(map_context.model_copy(update={'input_text': chunk}))
+        for chunk in chunks
+    ])
+
+    reduce_prompt = context.reduce_prompt or DEFAULT_REDUCE_PROMPT.format(prompt=context.prompt)
+    # Reduce in rounds while the partial results do not fit in one chunk
+    while estimate_tokens(wrap_partials(partials)) > context.chunk_tokens and len(partials) > 1:
+        groups = split_chunks_of(partials, context.chunk_tokens)
+        if len(groups) == len(partials):
+            break
+        logger.debug(f'[map-reduce] reduce {len(partials)} partial results into {len(groups)}')
+        partials = await asyncio.gather(*[
+            run_chunk(map_context.model_copy(update={
+                'prompt': reduce_prompt,
+                'input_text': wrap_partials(group),
+            }))
+            for group in groups
+        ])
+
+    reduce_context = context.model_copy(update={
+        'prompt': reduce_prompt,
+        'input_text': wrap_partials(partials),
+        'usage': False,
+        'cache': False,
+    })
+    usage = await run_agent(reduce_context, agent=pool.get_agent(reduce_context), profile=profile,
+                            stdout=stdout, stderr=stderr)
+    total_usage = total_usage + usage
+    if context.usage:
+        show_json_usage(total_usage, file=stderr, chunks=len(chunks))
+    return total_usage
+
@@ -0,0 +1,128 @@
+'''
+Latency and throughput metrics of a call.
+
+Phases are timed with `Metrics.phase`, and the stream loop records the arrival
+time of each delta, from which the time to first token, the inter-token
+latencies and the output tokens per second are derived. The report is written
+as JSON to stderr or a file, and appended to a local JSONL log to aggregate
+across runs.
+'''
+import os
+import sys
+import json
+import math
+import time
+from pathlib import Path
+from contextlib import contextmanager
+from .util import logger, get_cache_dir, usage_to_dict, estimate_tokens
+
+PERCENTILES = (50, 90, 99)
+
+
+def get_metrics_log_path() -> Path:
+    '''
+    Return the metrics log path, $PAIPE_METRICS_LOG or metrics.jsonl in the cache directory.
+    '''
+    if os.environ.get('PAIPE_METRICS_LOG'):
+        return Path(os.environ['PAIPE_METRICS_LOG'])
+    return get_cache_dir() / 'metrics.jsonl'
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    '''
+    Return the nearest-rank percentile of values, None if empty.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def ms(seconds: float | None) -> float | None:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class Metrics:
+    '''
+    Collect the timings of one call, in seconds of `time.perf_counter`.
+    '''
+    def __init__(self, start: float | None = None):
+        self.start = time.perf_counter() if start is None else start
+        self.phases = {}
+        self.request_start = None
+        self.request_sent = None
+        self.deltas = []
+        self.text = []
+        self.request_end = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def start_request(self):
+        self.request_start = time.perf_counter()
+
+    def mark_sent(self):
+        '''
+        Mark that the response started, as the stream is opened.
+        '''
+        self.request_sent = time.perf_counter()
+
+    def add_delta(self, delta: str):
+        self.deltas.append(time.perf_counter())
+        self.text.append(delta)
+
+    def end_request(self):
+        self.request_end = time.perf_counter()
+
+    def summary(self, usage=None, **extra) -> dict:
+        usage = usage_to_dict(usage) if usage is not None else {}
+        now = time.perf_counter()
+        result = {f'{name}_ms': ms(seconds) for (name, seconds) in self.phases.items()}
+        ttft = None
+        generation = None
+        if self.request_start is not None:
+            end = self.request_end or now
+            result['request_ms'] = ms(end - self.request_start)
+            if self.request_sent is not None:
+                result['request_send_ms'] = ms(self.request_sent - self.request_start)
+            if self.deltas:
+                ttft = self.deltas[0] - self.request_start
+                generation = self.deltas[-1] - self.deltas[0]
+            else:
+                # Not streamed, the whole response arrives at once
+                generation = end - self.request_start
+        result['ttft_ms'] = ms(ttft)
+        gaps = [b - a for (a, b) in zip(self.deltas, self.deltas[1:])]
+        for p in PERCENTILES:
+            result[f'inter_token_p{p}_ms'] = ms(percentile(gaps, p))
+        result['deltas'] = len(self.deltas)
+        output_tokens = usage.get('response_tokens')
+        if output_tokens is None and self.text:
+            output_tokens = estimate_tokens(''.join(self.text))
+        result['output_tokens'] = output_tokens
+        result['output_tokens_per_second'] = \
+            round(output_tokens / generation, 3) if output_tokens and generation else None
+        result['wall_ms'] = ms(now - self.start)
+        return {**extra, **result}
+
+
+def report_metrics(summary: dict, destination: str | None = None, stderr=None):
+    '''
+    Write the summary to the file at destination or stderr, and append it to the metrics log.
+    '''
+    line = json.dumps(summary, ensure_ascii=False)
+    if destination:
+        with open(destination, 'a', encoding='utf-8') as fd:
+            fd.write(line + '\n')
+    else:
+        print('Metrics:', line, file=stderr or sys.stderr)
+    try:
+        with open(get_metrics_log_path(), 'a', encoding='utf-8') as fd:
+            fd.write(json.dumps({'time': time.time(), **summary}, ensure_ascii=False) + '\n')
+    except OSError as e:
+        logger.warning(f'Failed to append to the metrics log: {e}')
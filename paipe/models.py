@@ -3,12 +3,34 @@ from pydantic import BaseModel, Field
 
 class PaipeContext(BaseModel):
     profile: str = Field(default='default', description='The profile name')
+    fallback_profiles: list[str] = Field(default=[], description='The profiles to race the call over after the first one')
+    race: bool = Field(default=False, description='Start the call on all the profiles at once')
+    hedge_after: float | None = Field(default=None, description='Milliseconds without output before hedging on the next profile')
     system_prompt: str | None = Field(default=None, description='The system prompt')
     stream: bool = Field(default=True, description='Enable stream mode')
     input_text: str = Field(default='', description='The input text')
+    stable_prefix: bool | None = Field(default=None, description='Put the input text and attachments ahead of the prompt, by default for large inputs')
     prompt: str = Field(default='', description='The prompt')
     json_schema: str | None = Field(default=None, description='The JSON schema for the result')
+    json_stream: str | None = Field(default=None, description='Stream the result of the JSON schema as NDJSON, of snapshot or items')
+    json_items: str | None = Field(default=None, description='The array field to stream the items of')
     extract_code_block: bool | str | None = Field(default=None, description='Extract code block')
+    first_code_block: bool = Field(default=False, description='Extract the first code block instead of the last, and stop the response once it is closed')
     model: str | None = Field(default=None, description='The model name')
     attachments: list = Field(default=[], description='The attachments')
-    usage: bool = Field(default=False, description='Show usage')
\ No newline at end of file
+    usage: bool = Field(default=False, description='Show usage')
+    cache: bool = Field(default=False, description='Enable the response cache')
+    cache_ttl: float | None = Field(default=7 * 24 * 3600, description='Seconds before a cached response expires')
+    cache_max_size: int = Field(default=256 * 1024 * 1024, description='Max bytes of the response cache')
+    map_reduce: bool = Field(default=False, description='Map the prompt over chunks of the input, then reduce')
+    chunk_tokens: int = Field(default=8000, description='Max estimated tokens of an input chunk in map-reduce mode')
+    map_concurrency: int = Field(default=4, description='Max concurrent requests in map-reduce mode')
+    reduce_prompt: str | None = Field(default=None, description='The prompt combining the partial results')
+    each_record: str | None = Field(default=None, description='Run the prompt over each record of the input, of line, nul or jsonl')
+    concurrency: int = Field(default=8, description='Max concurrent requests over records')
+    keep_order: bool = Field(default=False, description='Output the results of records in input order')
+    session: str | None = Field(default=None, description='The name of the session to continue')
+    session_budget: int = Field(default=16000, description='Max estimated tokens of the session history resent with a call')
+    session_compact: str = Field(default='drop', description='How turns past the session budget are compacted, of drop or summarize')
+    metrics: bool = Field(default=False, description='Report the latency and throughput metrics')
+    metrics_file: str | None = Field(default=None, description='Append the metrics to a file instead of stderr')
@@ -1,10 +1,15 @@
 '''
 Convert a list of files into a markdown of file contents.
 '''
+import io
 import os
-from typing import List, Tuple, Literal
+import stat
+import codecs
+import threading
+import collections
+import concurrent.futures
+from typing import IO, Any, Generator, Iterator, List, Tuple, Literal
 import logging
-import httpx
 
 logger = logging.getLogger('paipe')
 
@@ -47,76 +52,348 @@ def get_wrap_method(wrap: WrapType):
     else:
         return wrap_html_comment
 
-class MarkdownHtml:
-    def __init__(self):
-        self.method = None
-
-    def __call__(self, html_content: str) -> str:
-        if not self.method:
-            try:
-                import markitdown
-                logger.debug("Imported markitdown")
-                self.method = markitdown.markdown
-            except ImportError:
-                try:
-                    import markdownify
-                    logger.debug("Imported markdownify")
-                    self.method = markdownify.markdownify
-                except ImportError:
-                    raise Exception("No markdown converter found,"
-                                    "install markitdown or markdownify to enable markdown conversion")
-        return self.method(html_content)
+BLOCK_SIZE = 1024 * 1024
+# The first bytes of a file read to tell if it is text
+SNIFF_SIZE = 8192
+# Files up to this size are read whole ahead of their turn on the thread pool
+PREFETCH_MAX_SIZE = 256 * 1024
+DEFAULT_READ_WORKERS = 8
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
 
-markdown_html = MarkdownHtml()
 
+def split_wrap(wrap_method, filename) -> Tuple[str, str]:
+    '''
+    Split the wrapping of a file into the text before and after its content.
+    '''
+    marker = '\0paipe-content\0'
+    head, tail = wrap_method(filename, marker).split(marker)
+    return head, tail
 
-def archive_to_markdown(files: List[str],
-                        content_list: List[Tuple[str, str]],
-                        wrap_method=None
-    ):
-    wrap_method = wrap_method or wrap_none
-    markdown = ''
+
+def iter_wrapped(wrap_method, filename, blocks: Iterator[str]) -> Generator[str, None, None]:
+    '''
+    Wrap the content of a file given as blocks. The wrapping is yielded
+    along with the first block, so a file yielding no block is left out.
+    '''
+    head, tail = split_wrap(wrap_method, filename)
+    started = False
+    for block in blocks:
+        if not started:
+            started = True
+            yield head
+        if block:
+            yield block
+    if started:
+        yield tail
+
+
+# Invalid UTF-8 sequences replaced by the reading thread
+replaced_sequences = threading.local()
+
+
+def replace_invalid_utf8(error: UnicodeDecodeError):
+    replaced_sequences.count = getattr(replaced_sequences, 'count', 0) + 1
+    return ('\ufffd', error.end)
+
+
+codecs.register_error('paipe-replace', replace_invalid_utf8)
+
+
+def iter_text_file(filename: str, block_size: int = BLOCK_SIZE) -> Generator[str, None, None]:
+    '''
+    Read a UTF-8 file in blocks, with newlines translated as in text mode.
+    A file whose first SNIFF_SIZE bytes hold a NUL or are not UTF-8 is
+    skipped without reading further, invalid bytes after them are replaced,
+    with a warning.
+    '''
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    decoder = io.IncrementalNewlineDecoder(utf8_decoder, translate=True)
+    with open(filename, 'rb') as fd:
+        block = fd.read(SNIFF_SIZE)
+        if b'\0' in block:
+            logger.debug(f"Skip binary file {filename}")
+            return
+        try:
+            text = decoder.decode(block, final=len(block) < SNIFF_SIZE)
+        except UnicodeDecodeError:
+            logger.debug(f"Skip non UTF-8 file {filename}")
+            return
+        yield text
+        utf8_decoder.errors = 'paipe-replace'
+        replaced = 0
+
+        def decode(block: bytes, final: bool = False) -> str:
+            nonlocal replaced
+            before = getattr(replaced_sequences, 'count', 0)
+            text = decoder.decode(block, final=final)
+            replaced += getattr(replaced_sequences, 'count', 0) - before
+            return text
+
+        while block := fd.read(block_size):
+            yield decode(block)
+        yield decode(b'', final=True)
+        if replaced:
+            logger.warning(f"Replaced {replaced} invalid UTF-8 sequences in {filename}")
+
+
+def read_local_file(filename: str, max_size: int | None = None) -> List[str] | None:
+    '''
+    Return the blocks of a small text file, None for a file to be streamed
+    at its turn, and no block for a file left out.
+    '''
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return []
+    if not stat.S_ISREG(file_stat.st_mode):
+        return []
+    size = file_stat.st_size
+    if max_size and size > max_size:
+        logger.info(f"Skip {filename} of {size} bytes, larger than {max_size} bytes")
+        return []
+    if size > PREFETCH_MAX_SIZE:
+        return None
+    try:
+        return list(iter_text_file(filename))
+    except OSError as e:
+        logger.warning(f"Failed to read {filename}: {e}")
+        return []
+
+
+def iter_prefetched(items: Iterator, read, workers: int = DEFAULT_READ_WORKERS) -> Generator:
+    '''
+    Yield (item, read(*item)) in the order of items, read on a thread pool
+    at most a few times workers items ahead.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+        pending = collections.deque()
+        items = iter(items)
+        for item in items:
+            pending.append((item, executor.submit(read, *item)))
+            if len(pending) >= 4 * workers:
+                break
+        while pending:
+            item, future = pending.popleft()
+            if (next_item := next(items, None)) is not None:
+                pending.append((next_item, executor.submit(read, *next_item)))
+            yield item, future.result()
+
+
+def expand_paths(files: List[str], walk_options: dict | None = None) -> List[Tuple[str, int | None, str | None]]:
+    '''
+    Return the files with the directories among them walked into their
+    files, along with the size cap of each one, only capping walked files,
+    and the path of walked files relative to their directory, None for the
+    others.
+    '''
+    from .walk import walk_files
+    walk_options = dict(walk_options or {})
+    max_size = walk_options.pop('max_file_size', DEFAULT_MAX_FILE_SIZE)
+    expanded = []
     for filename in files:
-        if filename.startswith(('http://', 'https://')):
-            try:
-                response = httpx.get(filename, follow_redirects=True)
-                response.raise_for_status()
-            except httpx.RequestError:
-                continue
-            content_type = response.headers.get('content-type', '').split(';')[0]
-            if content_type == 'text/html':
-                converted = markdown_html(response.text)
+        if not filename.startswith(('http://', 'https://')) and os.path.isdir(filename):
+            expanded.extend((path, max_size, os.path.relpath(path, filename).replace(os.sep, '/'))
+                            for path in walk_files(filename, **walk_options))
+        else:
+            expanded.append((filename, None, None))
+    return expanded
+
+
+def iter_text_stream(stream: IO, block_size: int = BLOCK_SIZE) -> Generator[str, None, None]:
+    while block := stream.read(block_size):
+        yield block
+
+
+def iter_sources(files: List[Tuple[str, int | None, str | None]],
+                 content_list: List[Tuple[str, str | IO]],
+                 read_local=read_local_file,
+                 fetch_options: dict | None = None,
+                 use_http_cache: bool = True,
+                 read_workers: int = DEFAULT_READ_WORKERS,
+                 convert_options: dict | None = None
+    ) -> Generator[Tuple[str, Any, bool], None, None]:
+    '''
+    Yield (filename, data, is_local) in the order of files then content_list,
+    data being read_local(filename, max_size) of local files read ahead on a
+    thread pool, and the text blocks of URLs and contents. URLs are fetched
+    concurrently in the background meanwhile, HTML pages converted on a
+    process pool as soon as fetched, see convert.Converter, and revalidated
+    against the HTTP cache unless use_http_cache is False, failed ones are
+    left out.
+    '''
+    urls = [filename for (filename, __, __) in files
+            if filename.startswith(('http://', 'https://'))]
+    fetcher = None
+    converter = None
+    futures = {}
+    http_cache = None
+    cached = {}
+    if urls:
+        from .fetch import BackgroundFetcher
+        from .convert import Converter
+        converter = Converter(**(convert_options or {}))
+        if use_http_cache:
+            from .httpcache import HttpCache
+            http_cache = HttpCache()
+        fetcher = BackgroundFetcher(**(fetch_options or {}))
+        for url in dict.fromkeys(urls):
+            if http_cache:
+                key = http_cache.key(url, f'archive:{converter.options_key}')
+                cached[url] = (key, http_cache.get(key))
+            headers = http_cache.conditional_headers(cached[url][1]) if http_cache else None
+            futures[url] = converter.submit_response(fetcher.submit(url, headers=headers))
+    local_files = iter_prefetched(((filename, max_size) for (filename, max_size, __) in files
+                                   if filename not in futures),
+                                  read_local, read_workers)
+    try:
+        for (filename, __, __) in files:
+            if filename in futures:
+                try:
+                    (response, converted) = futures[filename].result()
+                except Exception as e:
+                    logger.warning(f"Failed to fetch {filename}: {e!r}")
+                    continue
+                if response.status_code == 304:
+                    logger.debug(f"Not modified {filename}")
+                    converted = cached[filename][1]['data']
+                else:
+                    if http_cache:
+                        http_cache.store(cached[filename][0], response, converted)
                 if converted:
-                    markdown += wrap_method(filename, converted)
-            elif content_type.startswith('text/') or content_type in ['application/json', 'application/jsonl']:
-                markdown += wrap_method(filename, response.text)
-        elif os.path.isfile(filename):
-            try:
-                with open(filename, 'r', encoding='utf-8') as fd:
-                    markdown += wrap_method(filename, fd.read())
-            except UnicodeDecodeError:
-                continue
+                    yield filename, [converted], False
+            else:
+                __, data = next(local_files)
+                yield filename, data, True
+    finally:
+        local_files.close()
+        if fetcher:
+            fetcher.close()
+        if converter:
+            converter.close()
     if content_list:
         for (filename, content) in content_list:
-            markdown += wrap_method(filename, content)
-    return markdown
+            blocks = [content] if isinstance(content, str) else iter_text_stream(content)
+            yield filename, blocks, False
 
 
-def archive(output,
-            filelist: list | None=None,
-            use_stdin_as: str='list',
-            wrap: Literal['html', 'markdown', 'none']=None
+def iter_archive_to_markdown(files: List[str],
+                             content_list: List[Tuple[str, str | IO]],
+                             wrap_method=None,
+                             fetch_options: dict | None = None,
+                             use_http_cache: bool = True,
+                             walk_options: dict | None = None,
+                             read_workers: int = DEFAULT_READ_WORKERS,
+                             max_tokens: int | None = None,
+                             prefer: List[str] | None = None,
+                             stats_file: IO | None = None,
+                             convert_options: dict | None = None
+    ) -> Generator[str, None, None]:
+    '''
+    Yield the archive in chunks, in the order of files, as soon as each file
+    is read. Directories are walked into their files, URLs are fetched
+    concurrently, and local files are read ahead on a thread pool.
+
+    With max_tokens, the archive is packed into the budget instead, see
+    pack.iter_packed_archive.
+    '''
+    wrap_method = wrap_method or wrap_none
+    sized_files = expand_paths(files, walk_options)
+    if max_tokens is not None:
+        from .pack import iter_packed_archive
+        yield from iter_packed_archive(sized_files, content_list, wrap_method, max_tokens,
+                                       prefer=prefer,
+                                       stats_file=stats_file,
+                                       fetch_options=fetch_options,
+                                       use_http_cache=use_http_cache,
+                                       read_workers=read_workers,
+                                       convert_options=convert_options)
+        return
+    for (filename, data, is_local) in iter_sources(sized_files, content_list,
+                                                   fetch_options=fetch_options,
+                                                   use_http_cache=use_http_cache,
+                                                   read_workers=read_workers,
+                                                   convert_options=convert_options):
+        if is_local and data is None:
+            # Too large to be read ahead, stream it
+            data = iter_text_file(filename)
+        yield from iter_wrapped(wrap_method, filename, data)
+
+
+def archive_to_markdown(files: List[str],
+                        content_list: List[Tuple[str, str]],
+                        wrap_method=None,
+                        fetch_options: dict | None = None,
+                        use_http_cache: bool = True
     ):
+    return ''.join(iter_archive_to_markdown(files, content_list,
+                                            wrap_method=wrap_method,
+                                            fetch_options=fetch_options,
+                                            use_http_cache=use_http_cache))
+
+
+def iter_archive(output: str | IO,
+                 filelist: list | None=None,
+                 use_stdin_as: str='list',
+                 wrap: Literal['html', 'markdown', 'none']=None,
+                 fetch_options: dict | None=None,
+                 use_http_cache: bool=True,
+                 walk_options: dict | None=None,
+                 read_workers: int=DEFAULT_READ_WORKERS,
+                 max_tokens: int | None=None,
+                 prefer: List[str] | None=None,
+                 stats_file: IO | None=None,
+                 convert_options: dict | None=None
+    ) -> Generator[str, None, None]:
     '''
-    Convert the filelist to content markdown.
+    Yield the content markdown of the filelist in chunks.
     '''
     if filelist is None:
         filelist = []
     content_list = []
     if use_stdin_as == 'list':
+        if not isinstance(output, str):
+            output = output.read()
         pipe_filelist = split_to_filelist(output)
         filelist.extend(pipe_filelist)
     else:
         content_list.append(('STDIN', output))
     wrap_method = get_wrap_method(wrap)
-    return archive_to_markdown(filelist, content_list, wrap_method=wrap_method)
\ No newline at end of file
+    return iter_archive_to_markdown(filelist, content_list,
+                                    wrap_method=wrap_method,
+                                    fetch_options=fetch_options,
+                                    use_http_cache=use_http_cache,
+                                    walk_options=walk_options,
+                                    read_workers=read_workers,
+                                    max_tokens=max_tokens,
+                                    prefer=prefer,
+                                    stats_file=stats_file,
+                                    convert_options=convert_options)
+
+
+def archive(output,
+            filelist: list | None=None,
+            use_stdin_as: str='list',
+            wrap: Literal['html', 'markdown', 'none']=None,
+            fetch_options: dict | None=None,
+            use_http_cache: bool=True,
+            walk_options: dict | None=None,
+            read_workers: int=DEFAULT_READ_WORKERS,
+            max_tokens: int | None=None,
+            prefer: List[str] | None=None,
+            stats_file: IO | None=None,
+            convert_options: dict | None=None
+    ):
+    '''
+    Convert the filelist to content markdown.
+    '''
+    return ''.join(iter_archive(output, filelist,
+                                use_stdin_as=use_stdin_as,
+                                wrap=wrap,
+                                fetch_options=fetch_options,
+                                use_http_cache=use_http_cache,
+                                walk_options=walk_options,
+                                read_workers=read_workers,
+                                max_tokens=max_tokens,
+                                prefer=prefer,
+                                stats_file=stats_file,
+                                convert_options=convert_options))
@@ -5,9 +5,96 @@ def get_stdio():
         return sys.stdin.read()
 
 
+def get_walk_options(args):
+    return {
+        'includes': args.include,
+        'excludes': args.exclude,
+        'use_gitignore': args.gitignore,
+        'max_file_size': args.max_file_size or None,
+    }
+
+
+def get_fetch_options(args):
+    return {
+        'concurrency': args.concurrency,
+        'per_host': args.per_host,
+        'timeout': args.timeout,
+        'retries': args.retries,
+    }
+
+
+def get_convert_options(args):
+    return {
+        'parser': args.parser,
+        'extract': args.extract,
+        'workers': args.convert_workers,
+        'stats_file': sys.stderr if args.convert_stats else None,
+    }
+
+
+async def write_async_chunks(chunks):
+    async for chunk in chunks:
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+
+
 def handle_operation(args):
     if args.operation in ['archive', 'a']:
-        from . archive import archive
-        print(
-            archive(get_stdio() or '', args.filelist, use_stdin_as=args.stdin)
-        )
+        from . archive import iter_archive
+        fetch_options = get_fetch_options(args)
+        # Read stdin content as a stream, so it is never held whole in memory
+        stdin = sys.stdin if not sys.stdin.isatty() else ''
+        if args.stdin == 'list':
+            stdin = get_stdio() or ''
+        for chunk in iter_archive(stdin, args.filelist,
+                                  use_stdin_as=args.stdin,
+                                  wrap=args.wrap,
+                                  fetch_options=fetch_options,
+                                  use_http_cache=args.http_cache,
+                                  walk_options=get_walk_options(args),
+                                  read_workers=args.read_workers,
+                                  max_tokens=args.max_tokens,
+                                  prefer=args.prefer,
+                                  stats_file=sys.stderr,
+                                  convert_options=get_convert_options(args)):
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+        sys.stdout.write('\n')
+    elif args.operation == 'index':
+        import time
+        from . index import IndexWriter
+        start = time.perf_counter()
+        counts = IndexWriter(args.index, args.chunk_lines).update(args.paths,
+                                                                  walk_options=get_walk_options(args),
+                                                                  read_workers=args.read_workers)
+        print(f"Indexed {counts['files']} files into {args.index} in {time.perf_counter() - start:.2f}s: "
+              f"{counts['changed']} changed, {counts['unchanged']} unchanged, {counts['removed']} removed, "
+              f"{counts['chunks']} chunks, {counts['terms']} terms", file=sys.stderr)
+        import os
+        if args.embed or os.path.exists(os.path.join(args.index, 'vectors.json')):
+            from . vectors import update_vectors
+            embedder = None
+            if args.embed:
+                from ..profiles import get_profile
+                from ..embeddings import Embedder
+                profile = get_profile(args.profile)
+                if profile is None:
+                    print(f"Profile {args.profile} is not available in the profile.", file=sys.stderr)
+                    sys.exit(1)
+                embedder = Embedder(profile)
+            start = time.perf_counter()
+            counts = update_vectors(args.index, embedder)
+            print(f"Embedded {counts['embedded']} of {counts['chunks']} chunks in "
+                  f"{time.perf_counter() - start:.2f}s, {counts['rows']} vectors stored"
+                  + (f", {counts['missing']} chunks not embedded, run with --embed" if counts['missing'] else ''),
+                  file=sys.stderr)
+    elif args.operation == 'crawl':
+        import asyncio
+        from . website import iter_crawl_archive
+        asyncio.run(write_async_chunks(
+            iter_crawl_archive(args.url, args.max_pages, args.root,
+                               use_http_cache=args.http_cache,
+                               convert_options=get_convert_options(args),
+                               **get_fetch_options(args))
+        ))
+        sys.stdout.write('\n')
@@ -0,0 +1,352 @@
+'''
+Convert HTML pages to Markdown on a process pool.
+
+Parsing and converting HTML is CPU bound, so pages are converted in worker
+processes while the fetches go on. With extraction, the main content of a
+page is found the way readability does: the blocks holding paragraphs are
+scored on their text, commas and class names, discounted by the share of
+their text in links, and the best one is converted along with its siblings
+scoring close to it. Scripts, navigation, footers, sidebars and the like
+are left out first.
+'''
+import io
+import os
+import re
+import sys
+import time
+import asyncio
+import logging
+import threading
+import functools
+import multiprocessing
+import concurrent.futures
+from dataclasses import dataclass
+from typing import IO, List
+from urllib.parse import urljoin
+
+logger = logging.getLogger('paipe')
+
+PARSERS = ['lxml', 'html.parser', 'html5lib']
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+DEFAULT_CONVERT_WORKERS = min(4, os.cpu_count() or 1)
+
+# Elements never part of the content of a page
+REMOVED_TAGS = ['script', 'style', 'noscript', 'template', 'iframe', 'object', 'embed',
+                'svg', 'canvas', 'form', 'button', 'select', 'input', 'textarea',
+                'nav', 'aside', 'footer', 'dialog']
+# Class and id names of boilerplate, and of content, as in readability
+UNLIKELY_NAMES = re.compile(
+    r'-ad-|ai2html|banner|breadcrumbs|combx|comment|community|cookie|cover-wrap|disqus|extra|'
+    r'footer|gdpr|header|legends|menu|related|remark|replies|rss|shoutbox|sidebar|skyscraper|'
+    r'social|sponsor|supplemental|ad-break|agegate|pagination|pager|popup|share|toc', re.I)
+MAYBE_NAMES = re.compile(r'and|article|body|column|content|main|shadow', re.I)
+POSITIVE_NAMES = re.compile(
+    r'article|body|content|entry|hentry|h-entry|main|page|post|text|blog|story', re.I)
+NEGATIVE_NAMES = re.compile(
+    r'-ad-|hidden|banner|combx|comment|com-|contact|foot|footer|footnote|gdpr|masthead|media|'
+    r'meta|outbrain|promo|related|scroll|share|shoutbox|sidebar|skyscraper|sponsor|shopping|'
+    r'tags|tool|widget', re.I)
+SCORED_TAGS = ['p', 'pre', 'td', 'blockquote', 'li']
+TAG_SCORES = {'div': 5, 'article': 10, 'main': 10, 'section': 3, 'pre': 3, 'td': 3, 'blockquote': 3,
+              'form': -3, 'ol': -3, 'ul': -3, 'dl': -3, 'th': -5,
+              'h1': -5, 'h2': -5, 'h3': -5, 'h4': -5, 'h5': -5, 'h6': -5}
+# Paragraphs shorter than this are not scored
+MIN_PARAGRAPH_CHARS = 25
+# Extracted content shorter than this falls back to the whole page
+MIN_CONTENT_CHARS = 250
+
+
+def get_html_parser(parser: str | None = None) -> str:
+    '''
+    Return the BeautifulSoup parser to use, lxml if installed unless specified.
+    '''
+    if parser:
+        return parser
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+
+@dataclass
+class Conversion:
+    url: str
+    title: str
+    markdown: str
+    links: list[str]
+    seconds: float
+    html_tokens: int = 0
+    markdown_tokens: int = 0
+
+
+@functools.lru_cache(maxsize=None)
+def get_count():
+    from .pack import get_token_counter
+    return get_token_counter()[0]
+
+
+def class_names(element) -> str:
+    names = element.get('class') or []
+    if isinstance(names, str):
+        names = [names]
+    return ' '.join([*names, element.get('id') or ''])
+
+
+def is_hidden(element) -> bool:
+    style = (element.get('style') or '').replace(' ', '').lower()
+    return (element.has_attr('hidden') or element.get('aria-hidden') == 'true'
+            or 'display:none' in style or 'visibility:hidden' in style)
+
+
+def text_length(element) -> int:
+    return len(' '.join(element.get_text(' ').split()))
+
+
+def link_density(element) -> float:
+    length = text_length(element)
+    if not length:
+        return 0.0
+    return sum(text_length(link) for link in element.find_all('a')) / length
+
+
+def remove_boilerplate(body):
+    '''
+    Remove the elements that are never content: scripts, navigation, hidden
+    elements, and the blocks whose class or id names boilerplate.
+    '''
+    for element in body.find_all(REMOVED_TAGS):
+        element.decompose()
+    for element in body.find_all(True):
+        if element.decomposed or element.name in ('html', 'body', 'article', 'main'):
+            continue
+        if element.name == 'header' and not element.find_parent(['article', 'main']):
+            element.decompose()
+            continue
+        names = class_names(element)
+        if is_hidden(element) or (UNLIKELY_NAMES.search(names) and not MAYBE_NAMES.search(names)
+                                  and element.get('role') != 'main'):
+            element.decompose()
+
+
+def extract_main_content(body) -> list:
+    '''
+    Return the elements holding the main content of body, cleaned of
+    boilerplate, body itself if no block stands out.
+    '''
+    remove_boilerplate(body)
+    scores = {}
+    candidates = {}
+
+    def candidate_score(element) -> float:
+        if id(element) not in scores:
+            candidates[id(element)] = element
+            names = class_names(element)
+            weight = (25 if POSITIVE_NAMES.search(names) else 0) - (25 if NEGATIVE_NAMES.search(names) else 0)
+            scores[id(element)] = TAG_SCORES.get(element.name, 0) + weight
+        return scores[id(element)]
+
+    for paragraph in body.find_all(SCORED_TAGS):
+        text = ' '.join(paragraph.get_text(' ').split())
+        if len(text) < MIN_PARAGRAPH_CHARS:
+            continue
+        score = 1 + text.count(',') + min(len(text) // 100, 3)
+        # The parent gets the score of its paragraphs, the grandparent half of it
+        for (level, ancestor) in enumerate(paragraph.find_parents(limit=2)):
+            if ancestor.name in (None, '[document]', 'html'):
+                break
+            candidate_score(ancestor)
+            scores[id(ancestor)] += score / (1 + level)
+    if not scores:
+        return [body]
+    for key in scores:
+        scores[key] *= 1 - link_density(candidates[key])
+    top_key = max(scores, key=scores.get)
+    top = candidates[top_key]
+    if top is body or text_length(top) < MIN_CONTENT_CHARS:
+        return [body]
+    # Siblings scoring close to the best block are part of the content too
+    threshold = max(10, scores[top_key] * 0.2)
+    elements = []
+    for sibling in (top.parent.find_all(True, recursive=False) if top.parent else [top]):
+        if sibling is top or scores.get(id(sibling), 0) >= threshold:
+            elements.append(sibling)
+        elif sibling.name == 'p':
+            length = text_length(sibling)
+            if length > 80 and link_density(sibling) < 0.25:
+                elements.append(sibling)
+    return elements
+
+
+def markdown_of(elements) -> str:
+    '''
+    Convert parsed elements to Markdown with markdownify, without parsing them again.
+    '''
+    from markdownify import MarkdownConverter, markdownify
+    converter = MarkdownConverter()
+    parts = []
+    for element in elements:
+        try:
+            if hasattr(converter, 'convert_soup'):
+                parts.append(converter.convert_soup(element))
+            else:
+                parts.append(markdownify(str(element)))
+        except RecursionError:
+            logger.debug('Too deeply nested to convert')
+    return re.sub(r'\n{3,}', '\n\n', '\n\n'.join(parts)).strip()
+
+
+def markitdown_of(html: str) -> str:
+    import markitdown
+    result = markitdown.MarkItDown().convert_stream(io.BytesIO(html.encode('utf-8')), file_extension='.html')
+    return result.text_content
+
+
+def convert_html(url: str,
+                 html: str,
+                 root_selector: str = '',
+                 parser: str = 'html.parser',
+                 extract: bool = False,
+                 count_tokens: bool = False) -> Conversion:
+    '''
+    Convert a page to Markdown with its title and links, parsing it once.
+    The element of root_selector is converted if found, otherwise the main
+    content with extract, otherwise the whole page. Runs in the workers.
+    '''
+    start = time.perf_counter()
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        # Without the web extra, markitdown converts the whole page, and its links are not extracted
+        title, links, markdown = url, [], markitdown_of(html)
+    else:
+        soup = BeautifulSoup(html, parser)
+        title_tag = soup.find('title')
+        title = title_tag.text.strip() if title_tag else url
+        links = [urljoin(url, link['href']) for link in soup.find_all('a', href=True)]
+        root_element = soup.select_one(root_selector) if root_selector else None
+        if root_element:
+            elements = [root_element]
+        elif extract:
+            elements = extract_main_content(soup.body or soup)
+        else:
+            elements = [soup]
+        markdown = markdown_of(elements)
+    conversion = Conversion(url, title, markdown, links, time.perf_counter() - start)
+    if count_tokens:
+        count = get_count()
+        conversion.html_tokens = count(html)
+        conversion.markdown_tokens = count(markdown)
+    return conversion
+
+
+class Converter:
+    '''
+    Convert pages on a pool of worker processes, a thread if workers is 0,
+    and report the time and tokens saved of each page to stats_file.
+    '''
+    def __init__(self,
+                 workers: int | None = None,
+                 parser: str | None = None,
+                 extract: bool = False,
+                 stats_file: IO | None = None):
+        self.workers = DEFAULT_CONVERT_WORKERS if workers is None else workers
+        self.parser = get_html_parser(parser)
+        self.extract = extract
+        self.stats_file = stats_file
+        self.stats = []
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def options_key(self) -> str:
+        '''
+        The options the Markdown depends on, to key cached conversions.
+        '''
+        return f'{self.parser}:{int(self.extract)}'
+
+    def submit(self, url: str, html: str, root_selector: str = '') -> concurrent.futures.Future:
+        # Pages are submitted from the fetching thread too
+        with self._lock:
+            if self._executor is None:
+                if self.workers > 0:
+                    # Spawned rather than forked, the fetches run on threads
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(1)
+            future = self._executor.submit(convert_html, url, html, root_selector, self.parser,
+                                           self.extract, self.stats_file is not None)
+            position = len(self.stats)
+            self.stats.append(None)
+
+        def record(future: concurrent.futures.Future):
+            if not future.cancelled() and future.exception() is None:
+                conversion = future.result()
+                self.stats[position] = (conversion.url, conversion.seconds,
+                                        conversion.html_tokens, conversion.markdown_tokens)
+                logger.debug(f'[convert] {conversion.url} in {conversion.seconds:.3f}s')
+
+        future.add_done_callback(record)
+        return future
+
+    def submit_response(self, fetched: concurrent.futures.Future) -> concurrent.futures.Future:
+        '''
+        Return a future of (response, text) of a fetch. HTML is converted on
+        the pool as soon as it is fetched, other text is taken as is, and the
+        text is None for a 304 or a content type that is not text.
+        '''
+        result = concurrent.futures.Future()
+
+        def on_converted(converted: concurrent.futures.Future, response):
+            try:
+                result.set_result((response, converted.result().markdown))
+            except Exception as e:
+                result.set_exception(e)
+
+        def on_fetched(fetched: concurrent.futures.Future):
+            try:
+                response = fetched.result()
+                content_type = response.headers.get('content-type', '').split(';')[0]
+                if response.status_code == 304:
+                    text = None
+                elif content_type in HTML_CONTENT_TYPES:
+                    converted = self.submit(str(response.url), response.text)
+                    converted.add_done_callback(functools.partial(on_converted, response=response))
+                    return
+                elif content_type.startswith('text/') or content_type in ['application/json', 'application/jsonl']:
+                    text = response.text
+                else:
+                    text = None
+                result.set_result((response, text))
+            except Exception as e:
+                result.set_exception(e)
+
+        fetched.add_done_callback(on_fetched)
+        return result
+
+    async def convert(self, url: str, html: str, root_selector: str = '') -> Conversion:
+        return await asyncio.wrap_future(self.submit(url, html, root_selector))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self.stats_file is not None:
+            show_stats([stat for stat in self.stats if stat], self.stats_file)
+        self.stats = []
+
+
+def show_stats(stats: List[tuple], file: IO = sys.stderr):
+    if not stats:
+        return
+    print('Conversion:', file=file)
+    for (url, seconds, html_tokens, markdown_tokens) in stats:
+        saved = 1 - markdown_tokens / html_tokens if html_tokens else 0
+        print(f'{seconds:>8.3f}s {html_tokens:>9} -> {markdown_tokens:>8} tokens {saved:>6.1%}  {url}', file=file)
+    seconds = sum(stat[1] for stat in stats)
+    html_tokens = sum(stat[2] for stat in stats)
+    markdown_tokens = sum(stat[3] for stat in stats)
+    saved = 1 - markdown_tokens / html_tokens if html_tokens else 0
+    print(f'{seconds:>8.3f}s {html_tokens:>9} -> {markdown_tokens:>8} tokens {saved:>6.1%}  '
+          f'total of {len(stats)} pages', file=file)
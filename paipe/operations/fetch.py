@@ -0,0 +1,142 @@
+'''
+Fetch URLs concurrently through one pooled HTTP client.
+'''
+import random
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from urllib.parse import urlparse
+
+logger = logging.getLogger('paipe')
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PER_HOST = 4
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_RETRIES = 2
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def retry_after(response, attempt: int) -> float:
+    '''
+    Seconds to wait before the next attempt, from Retry-After if numeric,
+    otherwise a jittered exponential backoff.
+    '''
+    if response is not None:
+        value = response.headers.get('retry-after', '')
+        try:
+            return min(float(value), 60.0)
+        except ValueError:
+            pass
+    return 0.5 * (2 ** attempt) * (1 + random.random())
+
+
+class Fetcher:
+    '''
+    Fetch URLs through a shared client, with a global and a per-host
+    concurrency limit and retries on transient failures.
+    '''
+    def __init__(self,
+                 client,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 per_host: int = DEFAULT_PER_HOST,
+                 retries: int = DEFAULT_RETRIES):
+        self.client = client
+        self.per_host = max(1, per_host)
+        self.retries = max(0, retries)
+        self._limit = asyncio.Semaphore(max(1, concurrency))
+        self._host_limits = {}
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self._host_limits[host]
+
+    async def fetch(self, url: str, headers: dict | None = None):
+        '''
+        Return the response of url, raise httpx.HTTPError once the retries
+        are used up.
+        '''
+        import httpx
+        attempt = 0
+        while True:
+            response = None
+            async with self._host_limit(url), self._limit:
+                try:
+                    response = await self.client.get(url, headers=headers)
+                    if response.status_code == 304:
+                        # Not Modified, answering conditional headers
+                        return response
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        response.raise_for_status()
+                        return response
+                    if attempt >= self.retries:
+                        response.raise_for_status()
+                except httpx.TransportError:
+                    if attempt >= self.retries:
+                        raise
+            delay = retry_after(response, attempt)
+            attempt += 1
+            logger.debug(f'[fetch] retry {url} in {delay:.1f}s ({attempt}/{self.retries})')
+            await asyncio.sleep(delay)
+
+
+def create_client(concurrency: int = DEFAULT_CONCURRENCY,
+                  timeout: float = DEFAULT_TIMEOUT):
+    import httpx
+    return httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=httpx.Timeout(timeout),
+        limits=httpx.Limits(max_connections=concurrency,
+                            max_keepalive_connections=concurrency),
+    )
+
+
+class BackgroundFetcher:
+    '''
+    Fetch URLs on an event loop in a background thread, so synchronous code
+    can submit all URLs up front and consume the results in its own order.
+    '''
+    def __init__(self,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 per_host: int = DEFAULT_PER_HOST,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 retries: int = DEFAULT_RETRIES):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='paipe-fetch', daemon=True)
+        self._thread.start()
+        self._client = create_client(concurrency, timeout)
+        self._futures = []
+        self._fetcher = self._call(self._create_fetcher(concurrency, per_host, retries)).result()
+
+    async def _create_fetcher(self, concurrency, per_host, retries):
+        # Semaphores have to be created on the loop they are used on
+        return Fetcher(self._client, concurrency, per_host, retries)
+
+    def _call(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def submit(self, url: str, headers: dict | None = None) -> concurrent.futures.Future:
+        future = self._call(self._fetcher.fetch(url, headers=headers))
+        self._futures.append(future)
+        return future
+
+    def close(self):
+        # Fetches not consumed, e.g. when the reader stopped early
+        for future in self._futures:
+            future.cancel()
+        try:
+            self._call(self._client.aclose()).result()
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,50 @@
+'''
+HTTP conditional-request cache of converted pages.
+
+A page is stored with its ETag and Last-Modified headers and the result of
+converting it, so fetching an unchanged page again costs one request
+answered by 304 Not Modified, and no conversion.
+'''
+import json
+import hashlib
+from ..cache import DiskCache
+from ..util import get_cache_dir
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+
+class HttpCache(DiskCache):
+    def __init__(self, directory=None, max_size: int = DEFAULT_MAX_SIZE):
+        super().__init__(directory or get_cache_dir('http'), ttl=None, max_size=max_size)
+
+    @staticmethod
+    def key(url: str, variant: str = '') -> str:
+        '''
+        The key of a page, variant tells apart the ways a page is converted.
+        '''
+        return hashlib.sha256(json.dumps([url, variant]).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def conditional_headers(entry: dict | None) -> dict:
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, key: str, response, data):
+        '''
+        Store the converted data of a response, if the response can be revalidated.
+        '''
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if not etag and not last_modified:
+            return
+        self.put(key, {
+            'url': str(response.url),
+            'etag': etag,
+            'last_modified': last_modified,
+            'data': data,
+        })
@@ -0,0 +1,398 @@
+'''
+A local BM25 index of the chunks of files, to send only the relevant ones with a call.
+
+Files are split into chunks of lines, and the chunks are indexed by their
+terms: words, lowercased, with identifiers also split into their parts. The
+index is kept in a directory:
+
+- meta.json: the indexed files, with their mtime, size, hash and chunk ids
+- chunks.bin: for each chunk, its file id, first and last line, length in
+  terms, and the offset and size of its text in texts.bin
+- vocab.json: for each term, the offset and count of its postings
+- postings.bin: the chunk ids of the postings of every term, then their
+  term frequencies, as arrays of 32-bit integers
+
+Indexing again only reads the files whose mtime or size changed, and only
+re-indexes the ones whose content changed. Searching memory-maps the arrays,
+and only reads the postings of the terms of the query.
+'''
+import os
+import re
+import json
+import math
+import heapq
+import mmap
+import array
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+from .archive import (
+    DEFAULT_READ_WORKERS,
+    expand_paths,
+    iter_prefetched,
+    iter_text_file,
+    read_local_file
+)
+
+logger = logging.getLogger('paipe')
+
+DEFAULT_INDEX_DIR = '.paipe-index'
+DEFAULT_CHUNK_LINES = 60
+DEFAULT_TOP_K = 8
+# Lines longer than this are split into several lines of a chunk
+MAX_LINE_CHARS = 1000
+INDEX_VERSION = 1
+CHUNK_FIELDS = 6
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+WORD = re.compile(r'[^\W_]+(?:_+[^\W_]+)*', re.UNICODE)
+SUBWORD = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+|[^\W\d_A-Za-z]+')
+STOPWORDS = frozenset('''
+a an and are as at be by for from has have in is it its of on or that the
+this to was were will with what which who how why when where do does
+'''.split())
+
+
+def iter_terms(text: str) -> Iterator[str]:
+    '''
+    Yield the terms of a text: its words lowercased, and the parts of the
+    snake_case and camelCase words.
+    '''
+    for match in WORD.finditer(text):
+        word = match.group()
+        lower = word.lower()
+        if len(lower) > 1 and lower not in STOPWORDS:
+            yield lower
+        parts = SUBWORD.findall(word)
+        if len(parts) > 1:
+            for part in parts:
+                part = part.lower()
+                if len(part) > 1 and part not in STOPWORDS:
+                    yield part
+
+
+def count_terms(text: str) -> Dict[str, int]:
+    counts = {}
+    for term in iter_terms(text):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+def split_chunks(text: str, chunk_lines: int) -> List[Tuple[int, int, str]]:
+    '''
+    Split a text into chunks of chunk_lines lines, as (first line, last line, text).
+    '''
+    lines = []
+    for (number, line) in enumerate(text.splitlines(keepends=True), 1):
+        for start in range(0, max(len(line), 1), MAX_LINE_CHARS):
+            lines.append((number, line[start:start + MAX_LINE_CHARS]))
+    chunks = []
+    for start in range(0, len(lines), chunk_lines):
+        part = lines[start:start + chunk_lines]
+        chunks.append((part[0][0], part[-1][0], ''.join(line for (__, line) in part)))
+    return chunks
+
+
+def read_file_chunks(filename: str, max_size: int | None, chunk_lines: int):
+    '''
+    Return the hash of a text file and its chunks with their term counts,
+    None for a file left out.
+    '''
+    blocks = read_local_file(filename, max_size)
+    if blocks is None:
+        blocks = list(iter_text_file(filename))
+    if not blocks:
+        return None
+    text = ''.join(blocks)
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return digest, [(first, last, chunk, count_terms(chunk))
+                    for (first, last, chunk) in split_chunks(text, chunk_lines)]
+
+
+def load_array(path: Path, typecode: str) -> array.array:
+    values = array.array(typecode)
+    if path.exists():
+        values.frombytes(path.read_bytes())
+    return values
+
+
+def write_atomic(path: Path, data: bytes):
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def is_under(path: str, roots: List[str]) -> bool:
+    path = os.path.normpath(path)
+    for root in roots:
+        root = os.path.normpath(root)
+        if (root == '.' and not os.path.isabs(path)) or path == root or path.startswith(os.path.join(root, '')):
+            return True
+    return False
+
+
+class IndexWriter:
+    '''
+    Update the index of a directory with the files of paths.
+    '''
+    def __init__(self, directory: str, chunk_lines: int = DEFAULT_CHUNK_LINES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.meta = {'version': INDEX_VERSION, 'chunk_lines': chunk_lines,
+                     'paths': [], 'files': {}, 'postings': 0}
+        meta_path = self.directory / 'meta.json'
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            if meta.get('version') == INDEX_VERSION and meta.get('chunk_lines') == chunk_lines:
+                self.meta = meta
+            else:
+                logger.info(f'Rebuild the index {directory}, its version or chunk lines changed')
+        self.chunks = load_array(self.directory / 'chunks.bin', 'Q') if self.meta['files'] else array.array('Q')
+        self.vocab = json.loads((self.directory / 'vocab.json').read_text(encoding='utf-8')) \
+            if self.meta['files'] else {}
+        self.postings = load_array(self.directory / 'postings.bin', 'I') if self.meta['files'] else array.array('I')
+        self.texts_path = self.directory / 'texts.bin'
+        if not self.meta['files']:
+            self.texts_path.write_bytes(b'')
+
+    def read_text(self, chunk_id: int) -> str:
+        offset, size = self.chunks[chunk_id * CHUNK_FIELDS + 4:chunk_id * CHUNK_FIELDS + 6]
+        with open(self.texts_path, 'rb') as fd:
+            fd.seek(offset)
+            return fd.read(size).decode('utf-8')
+
+    def update(self, paths: List[str],
+               walk_options: dict | None = None,
+               read_workers: int = DEFAULT_READ_WORKERS) -> dict:
+        '''
+        Index the files of paths, and remove the files under paths gone
+        since, return the counts of the update.
+        '''
+        files = self.meta['files']
+        candidates = []
+        seen = set()
+        unchanged = 0
+        for (filename, max_size, __) in expand_paths(paths, walk_options):
+            if filename.startswith(('http://', 'https://')) or filename in seen:
+                continue
+            seen.add(filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            record = files.get(filename)
+            if record and record['mtime_ns'] == stat.st_mtime_ns and record['size'] == stat.st_size:
+                unchanged += 1
+                continue
+            candidates.append((filename, max_size, stat))
+        removed = [filename for filename in files if filename not in seen and is_under(filename, paths)]
+
+        dead = set()
+        added = []
+        for filename in removed:
+            dead.update(files.pop(filename)['chunks'])
+
+        def read(filename: str, max_size: int | None, __):
+            return read_file_chunks(filename, max_size, self.meta['chunk_lines'])
+
+        changed = 0
+        for ((filename, __, stat), result) in iter_prefetched(candidates, read, read_workers):
+            record = files.get(filename)
+            if result is None:
+                if record:
+                    dead.update(files.pop(filename)['chunks'])
+                    removed.append(filename)
+                continue
+            digest, chunks = result
+            if record and record['sha256'] == digest:
+                record.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                unchanged += 1
+                continue
+            changed += 1
+            if record:
+                dead.update(record['chunks'])
+                file_id = record['id']
+            else:
+                file_id = len(self.meta['paths'])
+                self.meta['paths'].append(filename)
+            files[filename] = {'id': file_id, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                               'sha256': digest, 'chunks': []}
+            added.append((filename, file_id, chunks))
+
+        # Compact once the dead chunks outnumber the live ones
+        live = self.meta.get('live_chunks', 0) - len(dead)
+        if dead and len(self.chunks) // CHUNK_FIELDS - live > max(live, 1000):
+            self.compact(dead, added)
+        else:
+            self.apply(dead, added)
+        self.save()
+        return {'files': len(files), 'changed': changed, 'unchanged': unchanged, 'removed': len(removed),
+                'chunks': sum(len(record['chunks']) for record in files.values()), 'terms': len(self.vocab)}
+
+    def apply(self, dead: set, added: list):
+        '''
+        Remove the dead chunks from the postings, and add the chunks of the
+        added files with new ids.
+        '''
+        affected = set()
+        for chunk_id in dead:
+            affected.update(count_terms(self.read_text(chunk_id)))
+            self.chunks[chunk_id * CHUNK_FIELDS + 3] = 0
+        new_postings = {}
+        with open(self.texts_path, 'ab') as texts:
+            offset = texts.tell()
+            for (filename, file_id, chunks) in added:
+                record = self.meta['files'][filename]
+                for (first, last, text, counts) in chunks:
+                    chunk_id = len(self.chunks) // CHUNK_FIELDS
+                    data = text.encode('utf-8')
+                    texts.write(data)
+                    self.chunks.extend((file_id, first, last, sum(counts.values()), offset, len(data)))
+                    offset += len(data)
+                    record['chunks'].append(chunk_id)
+                    for (term, tf) in counts.items():
+                        new_postings.setdefault(term, []).append((chunk_id, tf))
+        count = self.meta['postings']
+        ids = self.postings[:count]
+        tfs = self.postings[count:]
+        new_ids = array.array('I')
+        new_tfs = array.array('I')
+        vocab = {}
+        for term in sorted(set(self.vocab) | set(new_postings)):
+            term_ids = array.array('I')
+            term_tfs = array.array('I')
+            if term in self.vocab:
+                (start, n) = self.vocab[term]
+                if term in affected:
+                    for i in range(start, start + n):
+                        if ids[i] not in dead:
+                            term_ids.append(ids[i])
+                            term_tfs.append(tfs[i])
+                else:
+                    term_ids = ids[start:start + n]
+                    term_tfs = tfs[start:start + n]
+            for (chunk_id, tf) in new_postings.get(term, ()):
+                term_ids.append(chunk_id)
+                term_tfs.append(min(tf, 0xffffffff))
+            if term_ids:
+                vocab[term] = [len(new_ids), len(term_ids)]
+                new_ids.extend(term_ids)
+                new_tfs.extend(term_tfs)
+        self.vocab = vocab
+        self.meta['postings'] = len(new_ids)
+        self.postings = new_ids + new_tfs
+
+    def compact(self, dead: set, added: list):
+        '''
+        Rebuild the index from the live chunks and the added files, dropping the dead chunks.
+        '''
+        logger.debug(f'[index] compact, {len(dead)} dead chunks')
+        added_files = {filename for (filename, __, __) in added}
+        kept = []
+        for (filename, record) in self.meta['files'].items():
+            if filename in added_files:
+                continue
+            chunks = []
+            for chunk_id in record['chunks']:
+                (__, first, last) = self.chunks[chunk_id * CHUNK_FIELDS:chunk_id * CHUNK_FIELDS + 3]
+                text = self.read_text(chunk_id)
+                chunks.append((first, last, text, count_terms(text)))
+            kept.append((filename, chunks))
+        kept.extend((filename, chunks) for (filename, __, chunks) in added)
+        for (file_id, (filename, __)) in enumerate(kept):
+            self.meta['files'][filename].update(id=file_id, chunks=[])
+        self.meta['paths'] = [filename for (filename, __) in kept]
+        self.meta['postings'] = 0
+        self.chunks = array.array('Q')
+        self.vocab = {}
+        self.postings = array.array('I')
+        # The texts are rewritten aside, and replace texts.bin when saved
+        self.texts_path = self.directory / f'.texts.bin.{os.getpid()}.tmp'
+        self.texts_path.write_bytes(b'')
+        self.apply(set(), [(filename, file_id, chunks) for (file_id, (filename, chunks)) in enumerate(kept)])
+
+    def save(self):
+        lengths = self.chunks[3::CHUNK_FIELDS]
+        self.meta['live_chunks'] = sum(1 for length in lengths if length)
+        self.meta['total_length'] = sum(lengths)
+        write_atomic(self.directory / 'chunks.bin', self.chunks.tobytes())
+        write_atomic(self.directory / 'postings.bin', self.postings.tobytes())
+        write_atomic(self.directory / 'vocab.json', json.dumps(self.vocab, ensure_ascii=False).encode('utf-8'))
+        if self.texts_path.name != 'texts.bin':
+            os.replace(self.texts_path, self.directory / 'texts.bin')
+            self.texts_path = self.directory / 'texts.bin'
+        # The meta last, as the mark of a complete index
+        write_atomic(self.directory / 'meta.json', json.dumps(self.meta, ensure_ascii=False).encode('utf-8'))
+
+
+class Index:
+    '''
+    Search the index of a directory, reading only the postings of the query terms.
+    '''
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        meta_path = self.directory / 'meta.json'
+        if not meta_path.exists():
+            raise FileNotFoundError(f'No index in {directory}, build it with `paipe op index`')
+        self.meta = json.loads(meta_path.read_text(encoding='utf-8'))
+        self.vocab = json.loads((self.directory / 'vocab.json').read_text(encoding='utf-8'))
+        self.chunks = self.map_array('chunks.bin', 'Q')
+        self.postings = self.map_array('postings.bin', 'I')
+
+    def map_array(self, name: str, typecode: str) -> memoryview:
+        with open(self.directory / name, 'rb') as fd:
+            if os.fstat(fd.fileno()).st_size == 0:
+                return memoryview(array.array(typecode))
+            return memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K) -> List[Tuple[float, int]]:
+        '''
+        Return the (score, chunk id) of the top_k chunks matching the query best.
+        '''
+        n = self.meta.get('live_chunks', 0)
+        if not n:
+            return []
+        average_length = self.meta['total_length'] / n
+        count = self.meta['postings']
+        scores = {}
+        for (term, query_tf) in count_terms(query).items():
+            if term not in self.vocab:
+                continue
+            (start, df) = self.vocab[term]
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5)) * query_tf
+            ids = self.postings[start:start + df]
+            tfs = self.postings[count + start:count + start + df]
+            for (chunk_id, tf) in zip(ids, tfs):
+                length = self.chunks[chunk_id * CHUNK_FIELDS + 3]
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return heapq.nlargest(top_k, ((score, chunk_id) for (chunk_id, score) in scores.items()))
+
+    def chunk(self, chunk_id: int) -> Tuple[str, int, int, str]:
+        '''
+        Return the filename, first and last line, and text of a chunk.
+        '''
+        (file_id, first, last, __, offset, size) = \
+            self.chunks[chunk_id * CHUNK_FIELDS:(chunk_id + 1) * CHUNK_FIELDS]
+        with open(self.directory / 'texts.bin', 'rb') as fd:
+            fd.seek(offset)
+            text = fd.read(size).decode('utf-8')
+        return self.meta['paths'][file_id], first, last, text
+
+
+def retrieve_context(directory: str, query: str, top_k: int = DEFAULT_TOP_K, wrap_method=None) -> str:
+    '''
+    Return the top_k chunks of the index matching the query, wrapped with
+    their filename and lines, the best first.
+    '''
+    from .archive import wrap_html_comment
+    wrap_method = wrap_method or wrap_html_comment
+    index = Index(directory)
+    parts = []
+    for (score, chunk_id) in index.search(query, top_k):
+        (filename, first, last, text) = index.chunk(chunk_id)
+        logger.debug(f'[index] {score:.3f} {filename}:{first}-{last}')
+        parts.append(wrap_method(f'{filename}:{first}-{last}', text.rstrip('\n')))
+    return ''.join(parts)
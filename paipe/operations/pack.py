@@ -0,0 +1,280 @@
+'''
+Pack an archive into a token budget.
+
+The files are measured first, on the thread pool reading them, without
+keeping their text. Files of identical content are collapsed into the one
+of highest priority, the others being listed as aliases of it. The files are
+then packed in priority order: the files listed explicitly first, then the
+ones matching the earliest `--prefer` glob, the smallest first. Globs match
+the paths of walked files relative to their directory, as `--include` does. The first
+file that does not fit is truncated to the rest of the budget if enough is
+left, the files after it are omitted and listed at the end of the archive.
+Packed files are read again to be written, in the order of the list.
+'''
+import sys
+import hashlib
+import logging
+import functools
+from typing import IO, Callable, Generator, List, Tuple
+from ..util import estimate_tokens
+from .archive import (
+    DEFAULT_READ_WORKERS,
+    iter_sources,
+    iter_prefetched,
+    iter_text_file,
+    iter_wrapped,
+    read_local_file,
+    split_wrap
+)
+from .walk import Rule
+
+logger = logging.getLogger('paipe')
+
+# Files truncated to less than this are omitted instead
+MIN_TRUNCATED_TOKENS = 256
+OMITTED_FILENAME = 'omitted files'
+TIKTOKEN_ENCODING = 'o200k_base'
+
+
+def get_token_counter() -> Tuple[Callable[[str], int], str]:
+    '''
+    Return a function counting the tokens of a text and its name, tiktoken
+    if installed, otherwise the byte heuristic.
+    '''
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        return (lambda text: len(encoding.encode(text, disallowed_special=()))), TIKTOKEN_ENCODING
+    except Exception as e:
+        logger.debug(f"Estimate tokens from bytes, tiktoken is not available: {e!r}")
+        return estimate_tokens, 'bytes/4'
+
+
+def measure_local_file(filename: str, max_size: int | None, count: Callable[[str], int]):
+    '''
+    Return the content hash and tokens of a local text file, None for a file
+    left out. Large files are measured block by block, never held whole.
+    '''
+    blocks = read_local_file(filename, max_size)
+    if blocks is None:
+        blocks = iter_text_file(filename)
+    digest = hashlib.sha256()
+    tokens = 0
+    empty = True
+    for block in blocks:
+        digest.update(block.encode('utf-8'))
+        tokens += count(block)
+        empty = False
+    if empty:
+        return None
+    return digest.hexdigest(), tokens
+
+
+class Entry:
+    '''
+    A file of a packed archive.
+    '''
+    def __init__(self, filename: str, position: int, explicit: bool, is_local: bool,
+                 digest: str, tokens: int, text: str | None = None, relative: str | None = None):
+        self.filename = filename
+        # The path matched by --prefer, relative to the walked directory
+        self.relative = relative or filename
+        self.position = position
+        self.explicit = explicit
+        self.is_local = is_local
+        self.digest = digest
+        self.tokens = tokens
+        self.text = text
+        self.status = 'omitted'
+        self.kept_tokens = 0
+        self.listed = False
+        self.primary = None
+        self.aliases = []
+
+
+def truncate_text(text: str, tokens: int, kept_tokens: int, text_tokens: int | None = None) -> str:
+    '''
+    Cut text to about kept_tokens of its tokens, at a line end if any.
+    text_tokens are the tokens of text when it is only the start of a file
+    of tokens.
+    '''
+    end = len(text) * kept_tokens // max(text_tokens or tokens, 1)
+    if (newline := text.rfind('\n', 0, end)) > end // 2:
+        end = newline + 1
+    return text[:end] + f'\n[... truncated, {kept_tokens} of {tokens} tokens]\n'
+
+
+def truncate_blocks(blocks, tokens: int, kept_tokens: int, count: Callable[[str], int]) -> str:
+    '''
+    Cut the text of blocks to about kept_tokens of its tokens, reading only
+    the blocks holding them.
+    '''
+    prefix = []
+    prefix_tokens = 0
+    try:
+        for block in blocks:
+            prefix.append(block)
+            prefix_tokens += count(block)
+            if prefix_tokens >= kept_tokens:
+                break
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
+    return truncate_text(''.join(prefix), tokens, kept_tokens, max(prefix_tokens, kept_tokens))
+
+
+def alias_text(entry: Entry) -> str:
+    return f'(identical to {entry.primary.filename})'
+
+
+def more_omitted_text(n: int) -> str:
+    return f'... and {n} more files'
+
+
+def pack_entries(entries: List[Entry],
+                 max_tokens: int,
+                 overhead: Callable[[str], int],
+                 count: Callable[[str], int],
+                 prefer: List[str] | None = None):
+    '''
+    Set the status of the entries packed into max_tokens: full, truncated,
+    duplicate or omitted, and which omitted entries fit in their list.
+    '''
+    prefer_rules = [Rule(pattern) for pattern in prefer or []]
+
+    def priority(entry: Entry):
+        rank = next((i for (i, rule) in enumerate(prefer_rules) if rule.match(entry.relative, False)),
+                    len(prefer_rules))
+        return (not entry.explicit, rank, entry.tokens, entry.position)
+
+    primaries = {}
+    packed = []
+    for entry in sorted(entries, key=priority):
+        primary = primaries.get(entry.digest)
+        # A file is only collapsed if it is larger than the mention of its alias
+        if primary and entry.tokens > count(f'(identical to {primary.filename})'):
+            entry.primary = primary
+            primary.aliases.append(entry)
+        else:
+            primaries.setdefault(entry.digest, entry)
+            packed.append(entry)
+    remaining = max_tokens
+    if sum(entry.tokens + overhead(entry.filename) for entry in entries) > max_tokens:
+        # Not all the files fit, keep room for the list of omitted ones
+        remaining -= overhead(OMITTED_FILENAME) + count(more_omitted_text(len(entries)))
+    for entry in packed:
+        alias_cost = sum(overhead(alias.filename) + count(alias_text(alias)) for alias in entry.aliases)
+        fixed_cost = overhead(entry.filename) + alias_cost
+        if fixed_cost + entry.tokens <= remaining:
+            entry.status = 'full'
+            entry.kept_tokens = entry.tokens
+        elif remaining - fixed_cost >= MIN_TRUNCATED_TOKENS:
+            entry.status = 'truncated'
+            entry.kept_tokens = remaining - fixed_cost - count(truncate_text('', entry.tokens, 0))
+        else:
+            # The omitted files are listed while there is room for their line
+            for omitted in (entry, *entry.aliases):
+                if (cost := count(omitted.filename + '\n')) <= remaining:
+                    omitted.listed = True
+                    remaining -= cost
+            continue
+        remaining -= fixed_cost + entry.kept_tokens
+        for alias in entry.aliases:
+            alias.status = 'duplicate'
+            alias.kept_tokens = count(alias_text(alias))
+
+
+def show_stats(entries: List[Entry], max_tokens: int, total: int, tokenizer: str, file: IO):
+    print('Archive tokens:', file=file)
+    counts = {}
+    for entry in entries:
+        counts[entry.status] = counts.get(entry.status, 0) + 1
+        if entry.status == 'duplicate':
+            detail = f' = {entry.primary.filename}'
+        elif entry.status == 'truncated':
+            detail = f' (of {entry.tokens})'
+        else:
+            detail = ''
+        tokens = entry.tokens if entry.status == 'omitted' else entry.kept_tokens
+        print(f'{tokens:>10}  {entry.status:<9}  {entry.filename}{detail}', file=file)
+    summary = ', '.join(f'{n} {status}' for (status, n) in counts.items())
+    print(f'{total:>10}  total of {len(entries)} files, {summary}, '
+          f'max {max_tokens}, tokenizer {tokenizer}', file=file)
+
+
+def iter_packed_archive(files: List[Tuple[str, int | None, str | None]],
+                        content_list: List[Tuple[str, str | IO]],
+                        wrap_method,
+                        max_tokens: int,
+                        prefer: List[str] | None = None,
+                        stats_file: IO | None = None,
+                        fetch_options: dict | None = None,
+                        use_http_cache: bool = True,
+                        read_workers: int = DEFAULT_READ_WORKERS,
+                        convert_options: dict | None = None
+    ) -> Generator[str, None, None]:
+    '''
+    Yield the archive of files packed into max_tokens, and write the tokens
+    of each file to stats_file, stderr by default.
+    '''
+    (count, tokenizer) = get_token_counter()
+    walked = {filename: relative for (filename, __, relative) in files if relative}
+    entries = []
+    sources = iter_sources(files, content_list,
+                           read_local=functools.partial(measure_local_file, count=count),
+                           fetch_options=fetch_options,
+                           use_http_cache=use_http_cache,
+                           read_workers=read_workers,
+                           convert_options=convert_options)
+    for (position, (filename, data, is_local)) in enumerate(sources):
+        if is_local:
+            if data is None:
+                continue
+            (digest, tokens) = data
+            text = None
+        else:
+            text = ''.join(data)
+            digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            tokens = count(text)
+        entries.append(Entry(filename, position, filename not in walked, is_local, digest, tokens, text,
+                             walked.get(filename)))
+
+    @functools.lru_cache(maxsize=None)
+    def overhead(filename: str) -> int:
+        return count(''.join(split_wrap(wrap_method, filename)))
+
+    pack_entries(entries, max_tokens, overhead, count, prefer)
+
+    packed_files = iter_prefetched(((entry.filename, None) for entry in entries
+                                    if entry.is_local and entry.status in ('full', 'truncated')),
+                                   read_local_file, read_workers)
+    total = 0
+    try:
+        for entry in entries:
+            if entry.status == 'omitted':
+                continue
+            total += overhead(entry.filename)
+            if entry.status == 'duplicate':
+                total += entry.kept_tokens
+                yield from iter_wrapped(wrap_method, entry.filename, [alias_text(entry)])
+                continue
+            total += entry.kept_tokens
+            blocks = [entry.text] if not entry.is_local else next(packed_files)[1]
+            if entry.status == 'full':
+                yield from iter_wrapped(wrap_method, entry.filename,
+                                        blocks if blocks is not None else iter_text_file(entry.filename))
+            else:
+                text = truncate_blocks(blocks if blocks is not None else iter_text_file(entry.filename),
+                                       entry.tokens, entry.kept_tokens, count)
+                yield from iter_wrapped(wrap_method, entry.filename, [text])
+    finally:
+        packed_files.close()
+    omitted = [entry for entry in entries if entry.status == 'omitted']
+    if omitted:
+        lines = [entry.filename for entry in omitted if entry.listed]
+        if len(lines) < len(omitted):
+            lines.append(more_omitted_text(len(omitted) - len(lines)))
+        text = '\n'.join(lines)
+        total += overhead(OMITTED_FILENAME) + count(text)
+        yield from iter_wrapped(wrap_method, OMITTED_FILENAME, [text])
+    show_stats(entries, max_tokens, total, tokenizer, stats_file or sys.stderr)
@@ -1,4 +1,70 @@
 import argparse
+from .walk import parse_size
+
+
+def add_fetch_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--concurrency',
+        type=int, default=16,
+        help='Max number of URLs to fetch at once')
+    parser.add_argument(
+        '--per-host',
+        type=int, default=4,
+        help='Max number of URLs to fetch at once from the same host')
+    parser.add_argument(
+        '--timeout',
+        type=float, default=30.0,
+        help='Timeout in seconds of fetching a URL')
+    parser.add_argument(
+        '--retries',
+        type=int, default=2,
+        help='Times to retry fetching a URL on connection errors, 429 and 5xx responses')
+    parser.add_argument(
+        '--no-http-cache',
+        dest='http_cache', action='store_false',
+        help='Fetch URLs in full, without revalidating the converted pages in the HTTP cache')
+
+
+def add_convert_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--parser',
+        type=str, default=None, choices=['lxml', 'html.parser', 'html5lib'],
+        help='The HTML parser, lxml if installed by default')
+    parser.add_argument(
+        '--extract',
+        action='store_true',
+        help='Convert the main content of HTML pages only, leaving out navigation, sidebars and footers')
+    parser.add_argument(
+        '--convert-workers',
+        type=int, default=None, metavar='N',
+        help='Number of processes converting HTML pages(default the CPUs, up to 4), 0 to convert on a thread')
+    parser.add_argument(
+        '--convert-stats',
+        action='store_true',
+        help='Show the conversion time and the tokens of each HTML page before and after in stderr')
+
+
+def add_walk_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--include',
+        type=str, action='append', default=None, metavar='GLOB',
+        help='Only take the files of directories matching a glob, can be repeated')
+    parser.add_argument(
+        '--exclude',
+        type=str, action='append', default=None, metavar='GLOB',
+        help='Leave out the files and directories of directories matching a glob, can be repeated')
+    parser.add_argument(
+        '--no-gitignore',
+        dest='gitignore', action='store_false',
+        help='Take the files of directories ignored by .gitignore too')
+    parser.add_argument(
+        '--max-file-size',
+        type=parse_size, default='1M', metavar='SIZE',
+        help='Leave out the files of directories larger than SIZE, like 512K or 4M, 0 for no limit(default 1M)')
+    parser.add_argument(
+        '--read-workers',
+        type=int, default=8,
+        help='Number of threads reading local files ahead')
 
 
 def build_command_parser(commond_parser: argparse.ArgumentParser):
@@ -19,7 +85,60 @@ html: use <!-- -->
 markdown: use []: #
 none: do nothing
 ''')
+    add_walk_arguments(cmd_archive)
+    cmd_archive.add_argument(
+        '--max-tokens',
+        type=int, default=None, metavar='N',
+        help='Pack the archive into N tokens, truncating or omitting the files of lowest priority, '
+             'with the tokens of each file shown in stderr')
+    cmd_archive.add_argument(
+        '--prefer',
+        type=str, action='append', default=None, metavar='GLOB',
+        help='With --max-tokens, pack the files of directories matching a glob first, can be repeated')
+    add_fetch_arguments(cmd_archive)
+    add_convert_arguments(cmd_archive)
     cmd_archive.add_argument(
         'filelist',
         type=str, nargs='*', metavar='FILENAME',
-        help='List of filenames to archvie')
+        help='List of filenames, directories and URLs to archvie')
+    cmd_index = \
+        sub_parsers.add_parser('index',
+                               help='Index the chunks of files for `paipe --context-index`')
+    cmd_index.add_argument(
+        '--index',
+        type=str, default='.paipe-index', metavar='DIR',
+        help='The directory of the index(default .paipe-index)')
+    cmd_index.add_argument(
+        '--chunk-lines',
+        type=int, default=60,
+        help='Lines of a chunk, changing it rebuilds the index(default 60)')
+    cmd_index.add_argument(
+        '--embed',
+        action='store_true',
+        help='Also embed the chunks not embedded yet, for `paipe --semantic-context`')
+    cmd_index.add_argument(
+        '-P', '--profile',
+        type=str, default='default',
+        help='The profile of the embeddings API, with --embed')
+    add_walk_arguments(cmd_index)
+    cmd_index.add_argument(
+        'paths',
+        type=str, nargs='+', metavar='PATH',
+        help='Files and directories to index')
+    cmd_crawl = \
+        sub_parsers.add_parser('crawl',
+                               help='Crawl the pages under a URL into a Markdown archive')
+    cmd_crawl.add_argument(
+        '--max-pages',
+        type=int, default=10,
+        help='Max number of pages to crawl')
+    cmd_crawl.add_argument(
+        '--root',
+        type=str, default='', metavar='SELECTOR',
+        help='CSS selector of the element to convert in each page, the whole page if not found')
+    add_fetch_arguments(cmd_crawl)
+    add_convert_arguments(cmd_crawl)
+    cmd_crawl.add_argument(
+        'url',
+        type=str,
+        help='The URL to start crawling from, only pages under its path are crawled')
@@ -0,0 +1,202 @@
+'''
+Vectors of the chunks of an index, for semantic retrieval.
+
+The vectors are normalized and stored as the rows of a float32 matrix,
+memory-mapped when searched, and looked up by the hash of the embedding
+model and the chunk text, so an unchanged chunk is never embedded again. In
+the directory of the index:
+
+- vectors.f32: the matrix
+- vectors.json: the embedding model, dimensions, and the row of each hash
+- chunk_rows.bin: the row of each chunk id, -1 for none, as int32
+'''
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from typing import List, Tuple
+import numpy as np
+from .index import CHUNK_FIELDS, DEFAULT_TOP_K, Index
+
+logger = logging.getLogger('paipe')
+
+# Rows scored at once in a search, to bound the memory of the scores
+SEARCH_BLOCK_ROWS = 65536
+
+
+def text_hash(key: str, text: str) -> str:
+    return hashlib.sha256(f'{key}\0{text}'.encode('utf-8')).hexdigest()
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class VectorStore:
+    '''
+    The vectors of the chunks of an index directory.
+    '''
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.matrix_path = self.directory / 'vectors.f32'
+        self.meta = {'key': None, 'dim': 0, 'rows': 0, 'hashes': {}}
+        meta_path = self.directory / 'vectors.json'
+        if meta_path.exists():
+            self.meta = json.loads(meta_path.read_text(encoding='utf-8'))
+
+    def matrix(self) -> np.ndarray:
+        if not self.meta['rows']:
+            return np.zeros((0, self.meta['dim']), dtype=np.float32)
+        return np.memmap(self.matrix_path, dtype=np.float32, mode='r',
+                         shape=(self.meta['rows'], self.meta['dim']))
+
+    def chunk_rows(self) -> np.ndarray:
+        path = self.directory / 'chunk_rows.bin'
+        if not path.exists() or path.stat().st_size == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(path, dtype=np.int32, mode='r')
+
+    def reset(self, key: str):
+        logger.info(f'Embed all the chunks again with {key}')
+        self.meta = {'key': key, 'dim': 0, 'rows': 0, 'hashes': {}}
+        self.matrix_path.write_bytes(b'')
+
+    def add(self, hashes: List[str], vectors: List[List[float]]):
+        '''
+        Append the vectors of hashes to the matrix, after the rows of the
+        saved meta: the rows of a run killed before saving are overwritten.
+        '''
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+        if not self.meta['dim']:
+            self.meta['dim'] = vectors.shape[1]
+        elif vectors.shape[1] != self.meta['dim']:
+            raise ValueError(f"Embeddings of {vectors.shape[1]} dimensions, {self.meta['dim']} expected")
+        with open(self.matrix_path, 'r+b' if self.matrix_path.exists() else 'wb') as fd:
+            fd.seek(self.meta['rows'] * self.meta['dim'] * vectors.itemsize)
+            fd.write(vectors.tobytes())
+            fd.truncate()
+        for digest in hashes:
+            self.meta['hashes'][digest] = self.meta['rows']
+            self.meta['rows'] += 1
+
+    def compact(self, live: set):
+        '''
+        Rewrite the matrix with the rows of the live hashes only.
+        '''
+        hashes = {digest: row for (digest, row) in self.meta['hashes'].items() if digest in live}
+        if len(hashes) == self.meta['rows']:
+            return
+        logger.debug(f"[vectors] compact {self.meta['rows']} rows into {len(hashes)}")
+        rows = np.array(list(hashes.values()), dtype=np.int64)
+        kept = np.array(self.matrix()[rows]) if len(rows) else np.zeros((0, self.meta['dim']), np.float32)
+        tmp_path = self.matrix_path.with_name(f'.vectors.{os.getpid()}.tmp')
+        tmp_path.write_bytes(kept.tobytes())
+        os.replace(tmp_path, self.matrix_path)
+        self.meta['hashes'] = {digest: i for (i, digest) in enumerate(hashes)}
+        self.meta['rows'] = len(hashes)
+
+    def save(self, chunk_rows: np.ndarray):
+        path = self.directory / 'chunk_rows.bin'
+        tmp_path = path.with_name(f'.chunk_rows.{os.getpid()}.tmp')
+        tmp_path.write_bytes(chunk_rows.astype(np.int32).tobytes())
+        os.replace(tmp_path, path)
+        meta_path = self.directory / 'vectors.json'
+        tmp_path = meta_path.with_name(f'.vectors.json.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(self.meta), encoding='utf-8')
+        os.replace(tmp_path, meta_path)
+
+    def search(self, query: List[float], top_k: int = DEFAULT_TOP_K) -> List[Tuple[float, int]]:
+        '''
+        Return the (cosine similarity, chunk id) of the top_k chunks closest to the query vector.
+        '''
+        chunk_rows = self.chunk_rows()
+        chunk_ids = np.nonzero(chunk_rows >= 0)[0]
+        if not len(chunk_ids):
+            return []
+        matrix = self.matrix()
+        query = normalize(np.asarray(query, dtype=np.float32))
+        best_scores = np.zeros(0, dtype=np.float32)
+        best_ids = np.zeros(0, dtype=np.int64)
+        for start in range(0, len(chunk_ids), SEARCH_BLOCK_ROWS):
+            ids = chunk_ids[start:start + SEARCH_BLOCK_ROWS]
+            scores = matrix[chunk_rows[ids]] @ query
+            best_scores = np.concatenate([best_scores, scores])
+            best_ids = np.concatenate([best_ids, ids])
+            if len(best_scores) > top_k:
+                top = np.argpartition(-best_scores, top_k)[:top_k]
+                best_scores, best_ids = best_scores[top], best_ids[top]
+        order = np.argsort(-best_scores)
+        return [(float(best_scores[i]), int(best_ids[i])) for i in order]
+
+
+def update_vectors(directory: str, embedder=None) -> dict:
+    '''
+    Embed the chunks of the index of directory without a vector yet, return
+    the counts of the update. Without embedder, only map the chunks of the
+    index, as renumbered by an update, to the vectors already there.
+    '''
+    index = Index(directory)
+    store = VectorStore(directory)
+    if embedder and store.meta['key'] != embedder.key:
+        store.reset(embedder.key)
+    key = store.meta['key']
+    chunk_count = len(index.chunks) // CHUNK_FIELDS
+    chunk_rows = np.full(chunk_count, -1, dtype=np.int32)
+    chunk_hashes = {}
+    missing = {}
+    for record in index.meta['files'].values():
+        for chunk_id in record['chunks']:
+            text = index.chunk(chunk_id)[3]
+            digest = text_hash(key, text)
+            chunk_hashes[chunk_id] = digest
+            if digest not in store.meta['hashes']:
+                missing.setdefault(digest, text)
+    hashes = list(missing)
+
+    def on_batch(start: int, vectors: List[List[float]]):
+        store.add(hashes[start:start + len(vectors)], vectors)
+
+    async def embed_missing():
+        async with embedder:
+            await embedder.embed([missing[digest] for digest in hashes], on_batch)
+
+    try:
+        if hashes and embedder:
+            asyncio.run(embed_missing())
+    finally:
+        # Keep the vectors of the batches done, even if others failed
+        live = set(chunk_hashes.values())
+        if store.meta['rows'] > 2 * max(len(live), 1000):
+            store.compact(live)
+        for (chunk_id, digest) in chunk_hashes.items():
+            chunk_rows[chunk_id] = store.meta['hashes'].get(digest, -1)
+        store.save(chunk_rows)
+    return {'chunks': len(chunk_hashes), 'embedded': len(hashes) if embedder else 0,
+            'missing': 0 if embedder else len(hashes), 'rows': store.meta['rows']}
+
+
+async def retrieve_semantic_context(directory: str, embedder, query: str,
+                                    top_k: int = DEFAULT_TOP_K, wrap_method=None) -> str:
+    '''
+    Return the top_k chunks of the index closest to the query, wrapped with
+    their filename and lines, the closest first.
+    '''
+    from .archive import wrap_html_comment
+    wrap_method = wrap_method or wrap_html_comment
+    store = VectorStore(directory)
+    if store.meta['key'] is None:
+        raise FileNotFoundError(f'No vectors in {directory}, build them with `paipe op index --embed`')
+    if store.meta['key'] != embedder.key:
+        raise ValueError(f"The vectors of {directory} are of {store.meta['key']}, not {embedder.key}")
+    async with embedder:
+        (query_vector,) = await embedder.embed([query])
+    index = Index(directory)
+    parts = []
+    for (score, chunk_id) in store.search(query_vector, top_k):
+        (filename, first, last, text) = index.chunk(chunk_id)
+        logger.debug(f'[vectors] {score:.3f} {filename}:{first}-{last}')
+        parts.append(wrap_method(f'{filename}:{first}-{last}', text.rstrip('\n')))
+    return ''.join(parts)
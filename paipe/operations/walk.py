@@ -0,0 +1,170 @@
+'''
+Walk directories into file lists, with .gitignore and include/exclude globs.
+'''
+import os
+import re
+import logging
+from typing import Iterator, List
+
+logger = logging.getLogger('paipe')
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(value: str) -> int:
+    '''
+    Parse a size like `512`, `64K` or `1M` into bytes.
+    '''
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)[bB]?\s*', value)
+    if not match:
+        raise ValueError(f'Invalid size {value!r}')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def glob_to_regex(pattern: str) -> str:
+    '''
+    Translate a glob of .gitignore syntax into a regex, `*` and `?` not
+    matching `/`, and `**` matching any number of directories.
+    '''
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and (end := pattern.find(']', i + 2)) != -1:
+            chars = pattern[i + 1:end]
+            if chars[0] in '!^':
+                chars = '^' + chars[1:]
+            regex += '[' + chars.replace('\\', '\\\\') + ']'
+            i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+class Rule:
+    '''
+    A glob of .gitignore syntax, matching paths relative to base, or with
+    prefix, paths under a directory above the walked one.
+    '''
+    def __init__(self, pattern: str, base: str = '', prefix: str = ''):
+        self.negate = pattern.startswith('!')
+        if self.negate or pattern.startswith('\\'):
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # A pattern with a slash is relative to base, otherwise it matches at any depth
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        self.base = base
+        self.prefix = prefix
+        self.regex = re.compile(('' if anchored else '(?:.*/)?') + glob_to_regex(pattern) + '$', re.DOTALL)
+
+    def match(self, path: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        path = self.prefix + path
+        if self.base:
+            if not path.startswith(self.base + '/'):
+                return False
+            path = path[len(self.base) + 1:]
+        return bool(self.regex.match(path))
+
+
+def read_ignore_rules(filename: str, base: str = '', prefix: str = '') -> List[Rule]:
+    rules = []
+    try:
+        with open(filename, 'r', encoding='utf-8', errors='replace') as fd:
+            for line in fd:
+                line = line.rstrip('\n').rstrip('\r')
+                if not line.endswith('\\ '):
+                    line = line.rstrip()
+                if line and not line.startswith('#'):
+                    rules.append(Rule(line, base, prefix))
+    except OSError:
+        pass
+    return rules
+
+
+def parent_ignore_rules(root: str) -> List[Rule]:
+    '''
+    Return the rules of the .gitignore files above root, up to the root of its git repository.
+    '''
+    root = os.path.abspath(root)
+    directory = root
+    parents = []
+    while True:
+        parent = os.path.dirname(directory)
+        if os.path.exists(os.path.join(directory, '.git')) or parent == directory:
+            break
+        directory = parent
+        parents.append(directory)
+    if not os.path.exists(os.path.join(directory, '.git')):
+        return []
+    rules = []
+    for parent in reversed(parents):
+        prefix = os.path.relpath(root, parent).replace(os.sep, '/') + '/'
+        rules.extend(read_ignore_rules(os.path.join(parent, '.gitignore'), prefix=prefix))
+    return rules
+
+
+def is_ignored(rules: List[Rule], path: str, is_dir: bool) -> bool:
+    '''
+    Whether the last rule matching path ignores it.
+    '''
+    for rule in reversed(rules):
+        if rule.match(path, is_dir):
+            return not rule.negate
+    return False
+
+
+def walk_files(root: str,
+               includes: List[str] | None = None,
+               excludes: List[str] | None = None,
+               use_gitignore: bool = True) -> Iterator[str]:
+    '''
+    Yield the files under root in a deterministic order, sorted by name in
+    each directory. Files ignored by the .gitignore files under root or by
+    an exclude glob are left out, and with include globs, files matching
+    none of them. Globs match paths relative to root.
+    '''
+    include_rules = [Rule(pattern) for pattern in includes or []]
+    exclude_rules = [Rule(pattern) for pattern in excludes or []]
+
+    def walk(directory: str, relative: str, ignore_rules: List[Rule]):
+        if use_gitignore:
+            ignore_rules = ignore_rules + read_ignore_rules(os.path.join(directory, '.gitignore'), relative)
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning(f"Failed to list {directory}: {e}")
+            return
+        for entry in entries:
+            path = f'{relative}/{entry.name}' if relative else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if is_dir and entry.name == '.git':
+                continue
+            if is_ignored(ignore_rules, path, is_dir) or is_ignored(exclude_rules, path, is_dir):
+                continue
+            if is_dir:
+                yield from walk(entry.path, path, ignore_rules)
+            elif entry.is_file() and (not include_rules or is_ignored(include_rules, path, False)):
+                yield path if root in ('.', './') else os.path.join(root, path)
+
+    yield from walk(root, '', parent_ignore_rules(root) if use_gitignore else [])
@@ -1,79 +1,166 @@
 '''
 Crawl HTML pages under a URL path, convert to Markdown, and archive into a single string.
 '''
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import AsyncGenerator
+from urllib.parse import urlparse, urldefrag
+from .fetch import (
+    Fetcher,
+    create_client,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PER_HOST,
+    DEFAULT_TIMEOUT,
+    DEFAULT_RETRIES
+)
+from .convert import HTML_CONTENT_TYPES, Converter, convert_html
 
-import httpx
-from markdownify import markdownify
-from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup
+logger = logging.getLogger('paipe')
 
 
-def md(html):
+@dataclass
+class Page:
+    url: str
+    title: str
+    markdown: str
+    links: list[str]
+
+
+def parse_page(url: str, html: str, root_element_selector: str = "", parser: str = 'html.parser',
+               extract: bool = False) -> Page:
+    '''
+    Extract the title, links and Markdown of a page with a single parse.
+    '''
+    conversion = convert_html(url, html, root_element_selector, parser, extract)
+    return Page(url=url, title=conversion.title, markdown=conversion.markdown, links=conversion.links)
+
+
+def format_page(page: Page) -> str:
+    return f'```` {page.url}\n# {page.title}\n\n{page.markdown}\n````\n\n'
+
+
+async def crawl(start_url: str,
+                max_pages: int = 10,
+                root_element_selector: str = "",
+                concurrency: int = DEFAULT_CONCURRENCY,
+                per_host: int = DEFAULT_PER_HOST,
+                timeout: float = DEFAULT_TIMEOUT,
+                retries: int = DEFAULT_RETRIES,
+                parser: str | None = None,
+                use_http_cache: bool = True,
+                convert_options: dict | None = None) -> AsyncGenerator[Page, None]:
+    '''
+    Crawl the pages under the host and path of start_url concurrently, and
+    convert them on a process pool, see convert.Converter. Unchanged pages
+    are served from the HTTP cache unless use_http_cache is False.
+
+    Pages are yielded in a stable breadth-first order regardless of which
+    fetch finishes first: the links of a page are only queued once every
+    page queued before it has been yielded.
+    '''
     try:
-        return markdownify(html)
-    except RecursiveError:
-        return ''
+        import bs4
+    except ImportError:
+        # Without it pages are converted without their links, and the crawl would stop at the first one
+        raise ImportError('Crawling requires beautifulsoup4, install the web extra with `pip install paipe[web]`')
+    converter = Converter(**{'parser': parser, **(convert_options or {})})
+    start_url = urldefrag(start_url).url
+    base = urlparse(start_url)
+    seen = {start_url}
+    frontier = deque([start_url])
+    tasks = deque()
+    crawled = 0
+
+    def in_scope(url: str) -> bool:
+        parsed = urlparse(url)
+        return parsed.netloc == base.netloc and parsed.path.startswith(base.path)
+
+    http_cache = None
+    if use_http_cache:
+        from .httpcache import HttpCache
+        http_cache = HttpCache()
+
+    async def fetch_page(fetcher: Fetcher, url: str) -> Page | None:
+        key = entry = None
+        if http_cache:
+            key = http_cache.key(url, f'crawl:{converter.options_key}:{root_element_selector}')
+            entry = await asyncio.to_thread(http_cache.get, key)
+        try:
+            headers = http_cache.conditional_headers(entry) if http_cache else None
+            response = await fetcher.fetch(url, headers=headers)
+        except Exception as e:
+            logger.warning(f"Failed to fetch {url}: {e!r}")
+            return None
+        if response.status_code == 304:
+            logger.debug(f"Not modified {url}")
+            return Page(**entry['data']) if entry['data'] else None
+        content_type = response.headers.get('content-type', '').split(';')[0]
+        if content_type not in HTML_CONTENT_TYPES:
+            logger.debug(f"Skip {url} of content type {content_type}")
+            page = None
+        else:
+            # Parsing is CPU bound, keep the loop free to drive the other fetches
+            conversion = await converter.convert(str(response.url), response.text, root_element_selector)
+            page = Page(url=conversion.url, title=conversion.title,
+                        markdown=conversion.markdown, links=conversion.links)
+        if http_cache:
+            await asyncio.to_thread(http_cache.store, key, response, asdict(page) if page else None)
+        return page
+
+    async with create_client(concurrency, timeout) as client:
+        fetcher = Fetcher(client, concurrency, per_host, retries)
+        try:
+            while frontier or tasks:
+                while frontier and crawled + len(tasks) < max_pages:
+                    url = frontier.popleft()
+                    tasks.append(asyncio.create_task(fetch_page(fetcher, url)))
+                page = await tasks.popleft()
+                if page is None:
+                    continue
+                crawled += 1
+                for link in page.links:
+                    link = urldefrag(link).url
+                    if link not in seen and in_scope(link):
+                        seen.add(link)
+                        frontier.append(link)
+                yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Waits for the workers to exit, off the event loop
+            await asyncio.to_thread(converter.close)
+
 
+async def iter_crawl_archive(start_url: str, max_pages: int = 10, root_element_selector: str = "",
+                             **crawl_options) -> AsyncGenerator[str, None]:
+    '''
+    Yield the archive of the crawled pages in chunks, as crawl_and_archive
+    would return it joined.
+    '''
+    first = True
+    async for page in crawl(start_url, max_pages, root_element_selector, **crawl_options):
+        block = format_page(page).rstrip('\n')
+        yield block if first else f'\n\n\n{block}'
+        first = False
 
-def crawl_and_archive(start_url: str, max_pages: int = 10, root_element_selector: str = "") -> str:
+
+def crawl_and_archive(start_url: str, max_pages: int = 10, root_element_selector: str = "",
+                      **crawl_options) -> str:
     """
     Crawl HTML pages starting from start_url, convert each to Markdown, and archive them.
-    
+
     Args:
         start_url: The URL to start crawling from.
         max_pages: Maximum number of pages to crawl.
-        
+        root_element_selector: CSS selector of the element to convert, the whole page if not found.
+
     Returns:
         A string containing all archived Markdown content.
     """
-    visited = set()
-    to_visit = [start_url]
-    archive = []
-    
-    base_path = urlparse(start_url).path
-    
-    while to_visit and len(visited) < max_pages:
-        url = to_visit.pop(0)
-        if url in visited:
-            continue
-        try:
-            response = httpx.get(url)
-            response.raise_for_status()
-        except httpx.HTTPError:
-            continue
-        
-        html = response.text
-        soup = BeautifulSoup(html, 'html.parser')
-        
-        # Extract title
-        title_tag = soup.find('title')
-        title = title_tag.text.strip() if title_tag else url
-        
-        # Convert HTML to Markdown
-        if root_element_selector:
-            soup = BeautifulSoup(html, 'html.parser')
-            root_element = soup.select_one(root_element_selector)
-            if root_element:
-                markdown_content = md(str(root_element))
-            else:
-                markdown_content = md(html)
-        else:
-            markdown_content = md(html)
-        
-        # Format the archive block
-        archive_block = f'```` {url}\n# {title}\n\n{markdown_content}\n````\n\n'
-        archive.append(archive_block)
-        
-        # Extract and queue links
-        for link in soup.find_all('a', href=True):
-            href = link['href']
-            absolute_url = urljoin(url, href)
-            parsed_url = urlparse(absolute_url)
-            # Check if same base path and not already visited/queued
-            if parsed_url.path.startswith(base_path):
-                if absolute_url not in visited and absolute_url not in to_visit:
-                    to_visit.append(absolute_url)
-        
-        visited.add(url)
-    
-    return '\n'.join(archive).strip()
\ No newline at end of file
+    async def collect():
+        return [chunk async for chunk in
+                iter_crawl_archive(start_url, max_pages, root_element_selector, **crawl_options)]
+    return ''.join(asyncio.run(collect()))
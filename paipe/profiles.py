@@ -1,8 +1,15 @@
+import os
+import copy
+import json
+import hashlib
 import platform
 from pathlib import Path
 import yaml
 from .util import logger
 
+# Resolved profiles by config path, with the (path, mtime, size) they were resolved from
+_compiled_profiles = {}
+
 
 def get_config_locations():
     """
@@ -22,6 +29,11 @@ def get_config_locations():
         ]
 
 
+def load_config_file(config_path: Path):
+    with open(config_path, 'r', encoding='utf-8') as f:
+        return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
 def load_paipe_config():
     """
     Load paipe.yaml config file with priority:
@@ -32,8 +44,7 @@ def load_paipe_config():
         if config_path.exists():
             try:
                 logger.debug(f"Loading config from {config_path}")
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    return yaml.safe_load(f)
+                return load_config_file(config_path)
             except yaml.YAMLError as e:
                 logger.error(f"Error parsing YAML in {config_path}: {e}")
                 continue
@@ -44,18 +55,19 @@ def load_paipe_config():
     return None
 
 
-def get_profile(profile_name: str):
+def resolve_profile(configs: dict, profile_name: str):
     """
-    Get a profile by name.
+    Flatten the `_from` chain of a profile, without modifying configs.
+    Raise ValueError if the chain is circular.
     """
-    configs = load_paipe_config()
-    if configs is None:
-        return None
     profile_dep_list = []
     curr = profile_name
     while True:
+        if curr in profile_dep_list:
+            chain = ' -> '.join(profile_dep_list + [curr])
+            raise ValueError(f"Circular _from in profile {profile_name}: {chain}")
         profile = configs.get(curr)
-        if profile is None:
+        if not isinstance(profile, dict):
             return None
         profile_dep_list.append(curr)
         _from = profile.get('_from')
@@ -64,29 +76,146 @@ def get_profile(profile_name: str):
         curr = _from
     profile_result = {}
     model_settings_result = {}
-    for profile_name in reversed(profile_dep_list):
-        profile = configs[profile_name]
-        model_settings = profile.pop('model_settings', {})
+    for name in reversed(profile_dep_list):
+        profile = copy.deepcopy(configs[name])
+        model_settings = profile.pop('model_settings', None) or {}
         model_settings_result.update(model_settings)
         profile_result.update(profile)
     profile_result.pop('_from', None)
     if model_settings_result:
         profile_result['model_settings'] = model_settings_result
-    logger.debug(f"profile: {profile_result}")
     return profile_result
 
 
+def compile_profiles(configs: dict) -> dict:
+    """
+    Resolve every profile of a config, keep the errors to report on use.
+    """
+    profiles = {}
+    errors = {}
+    for name in configs:
+        try:
+            profiles[name] = resolve_profile(configs, name)
+        except ValueError as e:
+            profiles[name] = None
+            errors[name] = str(e)
+    return {
+        'names': list(configs),
+        'profiles': profiles,
+        'errors': errors,
+    }
+
+
+def get_profile_cache_path(config_path: Path) -> Path:
+    """
+    Return the compiled profile cache of a config file, next to the user config.
+    """
+    user_config_dir = get_config_locations()[1].parent
+    digest = hashlib.sha1(str(config_path).encode('utf-8')).hexdigest()[:16]
+    return user_config_dir / f'.profiles-{digest}.json'
+
+
+def read_profile_cache(cache_path: Path, signature: list):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('signature') != signature:
+        return None
+    return cached.get('compiled')
+
+
+def write_profile_cache(cache_path: Path, signature: list, compiled: dict):
+    try:
+        data = json.dumps({'signature': signature, 'compiled': compiled})
+    except (TypeError, ValueError) as e:
+        logger.debug(f"Profiles are not cacheable: {e}")
+        return
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # The profiles hold API keys, keep the cache private as the config should be
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.debug(f"Failed to write profile cache {cache_path}: {e}")
+
+
+def load_compiled_profiles():
+    """
+    Load the resolved profiles of the paipe.yaml in use.
+
+    The profiles are resolved once per config file, and reused while its
+    path, mtime and size are unchanged, from memory within a process and
+    from the profile cache across processes.
+    """
+    for config_path in get_config_locations():
+        try:
+            stat = config_path.stat()
+        except OSError:
+            continue
+        config_path = config_path.resolve()
+        signature = [str(config_path), stat.st_mtime_ns, stat.st_size]
+        memo = _compiled_profiles.get(signature[0])
+        if memo and memo[0] == signature:
+            return memo[1]
+        cache_path = get_profile_cache_path(config_path)
+        compiled = read_profile_cache(cache_path, signature)
+        if compiled is not None:
+            logger.debug(f"Loading profiles from cache {cache_path}")
+        else:
+            try:
+                logger.debug(f"Loading config from {config_path}")
+                configs = load_config_file(config_path)
+            except yaml.YAMLError as e:
+                logger.error(f"Error parsing YAML in {config_path}: {e}")
+                continue
+            except Exception as e:
+                logger.error(f"Error reading {config_path}: {e}")
+                continue
+            if not isinstance(configs, dict):
+                logger.error(f"No profiles defined in {config_path}")
+                continue
+            compiled = compile_profiles(configs)
+            write_profile_cache(cache_path, signature, compiled)
+        _compiled_profiles[signature[0]] = (signature, compiled)
+        return compiled
+    logger.error("No valid paipe.yaml configuration found")
+    return None
+
+
+def get_profile(profile_name: str):
+    """
+    Get a profile by name.
+    """
+    compiled = load_compiled_profiles()
+    if compiled is None:
+        return None
+    profile = compiled['profiles'].get(profile_name)
+    if profile is None:
+        if error := compiled['errors'].get(profile_name):
+            logger.error(error)
+        return None
+    # Callers pop keys from the profile, never hand out the cached one
+    profile = copy.deepcopy(profile)
+    logger.debug(f"profile: {profile}")
+    return profile
+
+
 def list_profiles(prefix: str | bool = ''):
     '''
     List all profiles.
     '''
-    configs = load_paipe_config()
-    if configs is None:
+    compiled = load_compiled_profiles()
+    if compiled is None:
         logger.error("No profiles found")
         return
     if prefix is True:
         prefix = ''
-    for profile_name in configs:
+    for profile_name in compiled['names']:
         if prefix and not profile_name.startswith(prefix):
             continue
         print(profile_name)
@@ -1,4 +1,9 @@
+import json
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager
 from typing import Any, Literal
+from openai import APIConnectionError
 import pydantic_ai.models.openai
 from pydantic_ai.models.openai import (
     ModelMessage,
@@ -12,13 +17,70 @@ from pydantic_ai.models.openai import (
     APIStatusError,
     ModelHTTPError
 )
-from ..util import kwargs_by_func_def
+from ..util import logger, kwargs_by_func_def, estimate_tokens
+from ..ratelimit import RateLimiter, DEFAULT_OUTPUT_TOKENS, DEFAULT_RETRIES, RETRY_STATUS_CODES, retry_delay
+
+# The tokens counted for the stream opened in the current task, settled once it is consumed
+stream_tokens = contextvars.ContextVar('stream_tokens', default=None)
+
+
+def estimate_messages_tokens(messages: list) -> int:
+    '''
+    Estimate the tokens of the text of chat messages.
+    '''
+    texts = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get('text', '') for part in content if isinstance(part, dict))
+        if message.get('tool_calls'):
+            texts.append(json.dumps(message['tool_calls'], default=str))
+    return estimate_tokens(''.join(texts))
+
+
+CACHE_CONTROL = {'type': 'ephemeral'}
+
+
+def mark_cache_control(messages: list) -> list:
+    '''
+    Mark the system prompt, and the stable prefix of the last user message
+    ahead of its instruction, as breakpoints of explicit prompt caching.
+    '''
+    messages = [dict(message) for message in messages]
+    for message in messages:
+        if message.get('role') == 'system' and isinstance(message.get('content'), str):
+            message['content'] = [{'type': 'text', 'text': message['content'], 'cache_control': CACHE_CONTROL}]
+            break
+    for message in reversed(messages):
+        if message.get('role') != 'user':
+            continue
+        content = message.get('content')
+        # Only with the instruction last, as laid out with a stable prefix
+        if isinstance(content, list) and len(content) >= 2 and content[-1].get('type') == 'text':
+            content = [dict(part) for part in content]
+            content[-2]['cache_control'] = CACHE_CONTROL
+            message['content'] = content
+        break
+    return messages
 
 
 class OpenAIModel(pydantic_ai.models.openai.OpenAIModel):
     '''
-    Subclass of OpenAIModel to allow for custom model settings.
+    Subclass of OpenAIModel to allow for custom model settings, with rate
+    limits and retries.
     '''
+    rate_limiter: RateLimiter | None = None
+    retries: int = DEFAULT_RETRIES
+
+    def set_rate_limit(self, settings: dict, *identity):
+        '''
+        Apply the rate_limit section of a profile, the buckets are shared by identity.
+        '''
+        self.rate_limiter = RateLimiter.from_settings(settings, *identity)
+        self.retries = settings.get('retries', DEFAULT_RETRIES)
+
     async def _completions_create(
         self,
         messages: list[ModelMessage],
@@ -43,20 +105,56 @@ class OpenAIModel(pydantic_ai.models.openai.OpenAIModel):
             for m in messages:
                 async for msg in self._map_message(m):
                     openai_messages.append(msg)
-        try:
-            return await self.client.chat.completions.create(
-                model=self._model_name,
-                messages=openai_messages,
-                n=1,
-                parallel_tool_calls=model_settings.get('parallel_tool_calls', NOT_GIVEN),
-                tools=tools or NOT_GIVEN,
-                tool_choice=tool_choice or NOT_GIVEN,
-                stream=stream,
-                stream_options={'include_usage': True} if stream else NOT_GIVEN,
-                reasoning_effort=model_settings.get('openai_reasoning_effort', NOT_GIVEN),
-                **kwargs_by_func_def(self.client.chat.completions.create, model_settings),
-            )
-        except APIStatusError as e:
-            if (status_code := e.status_code) >= 400:
-                raise ModelHTTPError(status_code=status_code, model_name=self.model_name, body=e.body) from e
-            raise
\ No newline at end of file
+        if model_settings.get('cache_control'):
+            openai_messages = mark_cache_control(openai_messages)
+        # Output tokens count towards the limit too, as many as max_tokens may be generated
+        tokens = estimate_messages_tokens(openai_messages) + (model_settings.get('max_tokens') or DEFAULT_OUTPUT_TOKENS)
+        # The retries are ours, through the shared buckets, not the ones of the client
+        client = self.client.with_options(max_retries=0)
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire(tokens)
+            try:
+                response = await client.chat.completions.create(
+                    model=self._model_name,
+                    messages=openai_messages,
+                    n=1,
+                    parallel_tool_calls=model_settings.get('parallel_tool_calls', NOT_GIVEN),
+                    tools=tools or NOT_GIVEN,
+                    tool_choice=tool_choice or NOT_GIVEN,
+                    stream=stream,
+                    stream_options={'include_usage': True} if stream else NOT_GIVEN,
+                    reasoning_effort=model_settings.get('openai_reasoning_effort', NOT_GIVEN),
+                    **kwargs_by_func_def(self.client.chat.completions.create, model_settings),
+                )
+            except (APIStatusError, APIConnectionError) as e:
+                status_code = getattr(e, 'status_code', None)
+                if attempt < self.retries and (status_code is None or status_code in RETRY_STATUS_CODES):
+                    response = getattr(e, 'response', None)
+                    delay = retry_delay(response.headers if response is not None else None, attempt)
+                    if status_code == 429 and self.rate_limiter:
+                        await asyncio.to_thread(self.rate_limiter.block, delay)
+                    logger.warning(f'Retry in {delay:.1f}s after {status_code or type(e).__name__}'
+                                   f' ({attempt + 1}/{self.retries})')
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                if status_code is not None and status_code >= 400:
+                    raise ModelHTTPError(status_code=status_code, model_name=self.model_name, body=e.body) from e
+                raise
+            if stream:
+                stream_tokens.set(tokens)
+            elif self.rate_limiter and response.usage:
+                await asyncio.to_thread(self.rate_limiter.settle, tokens, response.usage.total_tokens)
+            return response
+
+    @asynccontextmanager
+    async def request_stream(self, *args, **kwargs):
+        async with super().request_stream(*args, **kwargs) as response:
+            yield response
+        # The usage of a stream is known once it is consumed
+        tokens = stream_tokens.get()
+        total_tokens = response.usage().total_tokens
+        if self.rate_limiter and tokens and total_tokens:
+            await asyncio.to_thread(self.rate_limiter.settle, tokens, total_tokens)
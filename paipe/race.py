@@ -0,0 +1,121 @@
+'''
+Race a call over several profiles to cut the tail latency.
+
+The call is started on the first profile, and hedged on the next one each
+time no output has arrived within `--hedge-after` milliseconds, or at once
+with `--race`, or as soon as a started profile fails. The first profile to
+write output wins: its output is streamed, and the others are cancelled.
+'''
+import sys
+import time
+import asyncio
+from .models import PaipeContext
+from .main import AgentPool, run_agent
+from .metrics import Metrics, report_metrics
+from .util import drain_output, logger, show_json_usage, usage_to_dict
+
+
+class CandidateWriter:
+    '''
+    A text stream passing the output of a candidate through once it has won,
+    the first write of a candidate claims the win.
+    '''
+    def __init__(self, claim, name: str, file):
+        self.claim = claim
+        self.name = name
+        self.file = file
+
+    def write(self, text: str) -> int:
+        if text and self.claim(self.name):
+            return self.file.write(text)
+        return len(text)
+
+    def flush(self):
+        self.file.flush()
+
+    async def drain(self):
+        await drain_output(self.file)
+
+
+async def run_race(context: PaipeContext,
+                   pool: AgentPool | None = None,
+                   stdout=None,
+                   stderr=None):
+    pool = pool or AgentPool()
+    names = [context.profile, *context.fallback_profiles]
+    for name in names:
+        if pool.get_profile(name) is None:
+            raise ValueError(f"Profile {name} is not available in the profile.")
+    hedge_after = 0 if context.race else (context.hedge_after or 0) / 1000
+    candidates = {name: context.model_copy(update={'profile': name, 'usage': False, 'metrics': False})
+                  for name in names}
+    # Build the agents before the clock, a cold build blocks the loop for the hedge window
+    agents = {name: pool.get_agent(candidate) for (name, candidate) in candidates.items()}
+    start = time.perf_counter()
+    tasks = {}
+    started = {}
+    metrics = {}
+    winner = None
+    first_output = None
+    output = asyncio.Event()
+
+    def claim(name: str) -> bool:
+        nonlocal winner, first_output
+        if winner is None:
+            winner = name
+            first_output = time.perf_counter() - start
+            output.set()
+            logger.debug(f'[race] {name} won in {first_output * 1000:.0f} ms')
+            for (other, task) in tasks.items():
+                if other != name:
+                    task.cancel()
+        return winner == name
+
+    async def run_candidate(name: str):
+        return await run_agent(candidates[name],
+                               agent=agents[name],
+                               profile=pool.get_profile(name),
+                               stdout=CandidateWriter(claim, name, stdout or sys.stdout),
+                               stderr=stderr,
+                               metrics=metrics[name])
+
+    for (i, name) in enumerate(names):
+        if winner is not None:
+            break
+        logger.debug(f'[race] start {name}')
+        started[name] = time.perf_counter() - start
+        metrics[name] = Metrics()
+        tasks[name] = asyncio.create_task(run_candidate(name))
+        if i + 1 < len(names):
+            # Hedge with the next profile, unless output or a failure comes first
+            waiter = asyncio.create_task(output.wait())
+            running = [task for task in tasks.values() if not task.done()]
+            await asyncio.wait([waiter, *running], timeout=hedge_after,
+                               return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+
+    results = dict(zip(tasks, await asyncio.gather(*tasks.values(), return_exceptions=True)))
+    for name in started:
+        # From the request sent, unless the candidate ended before it
+        if metrics[name].request_start is not None:
+            started[name] = metrics[name].request_start - start
+    for (name, result) in results.items():
+        if isinstance(result, Exception):
+            logger.warning(f'Profile {name} failed: {type(result).__name__}: {result}')
+    if winner is None:
+        # All failed before any output, raise the failure of the first profile
+        raise results[names[0]]
+    usage = results[winner]
+    if isinstance(usage, BaseException):
+        raise usage
+    timing = {
+        'winner': winner,
+        'first_output_ms': round(first_output * 1000, 3),
+        'started_ms': {name: round(offset * 1000, 3) for (name, offset) in started.items()},
+    }
+    if context.usage:
+        show_json_usage(usage_to_dict(usage), file=stderr, **timing)
+    if context.metrics:
+        report_metrics(metrics[winner].summary(usage, profile=winner, stream=context.stream, **timing),
+                       context.metrics_file, stderr)
+    return usage
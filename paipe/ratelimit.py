@@ -0,0 +1,221 @@
+'''
+Rate limits shared by the paipe processes of a host, and retry delays.
+
+The `rate_limit` section of a profile sets the requests and tokens per minute
+of its API. Each limit is a token bucket kept in a state file under the cache
+directory, updated under a file lock, so concurrent processes (as with
+`xargs -P 32`) share the quota instead of each one spending it on retries:
+
+    rate_limit:
+        rpm: 500
+        tpm: 200000
+        retries: 4
+
+A 429 response blocks the bucket for every process until the delay the
+provider asked for has passed.
+'''
+import json
+import time
+import random
+import asyncio
+import hashlib
+import email.utils
+from pathlib import Path
+from contextlib import contextmanager
+from .util import logger, get_cache_dir
+
+DEFAULT_RETRIES = 3
+MAX_RETRY_DELAY = 60.0
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+# The output tokens counted for a request without max_tokens, until its usage is known
+DEFAULT_OUTPUT_TOKENS = 1024
+
+try:
+    import fcntl
+
+    def lock_file(fd):
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+
+    def unlock_file(fd):
+        fcntl.flock(fd.fileno(), fcntl.LOCK_UN)
+except ImportError:
+    import msvcrt
+
+    def lock_file(fd):
+        fd.seek(0)
+        while True:
+            try:
+                msvcrt.locking(fd.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def unlock_file(fd):
+        fd.seek(0)
+        msvcrt.locking(fd.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def locked_state(path: Path):
+    '''
+    Yield the JSON state stored at path under an exclusive lock, and store it back.
+    '''
+    with open(path, 'a+', encoding='utf-8') as fd:
+        lock_file(fd)
+        try:
+            fd.seek(0)
+            try:
+                state = json.loads(fd.read() or '{}')
+            except ValueError:
+                state = {}
+            yield state
+            fd.seek(0)
+            fd.truncate()
+            fd.write(json.dumps(state))
+            fd.flush()
+        finally:
+            unlock_file(fd)
+
+
+def parse_duration(value: str) -> float | None:
+    '''
+    Parse a duration like `1.5`, `20ms`, `1s` or `6m0s` into seconds.
+    '''
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    number = ''
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c.isdigit() or c == '.':
+            number += c
+        elif number:
+            if value.startswith('ms', i):
+                total += float(number) / 1000
+                i += 1
+            elif c in 'hms':
+                total += float(number) * {'h': 3600, 'm': 60, 's': 1}[c]
+            else:
+                return None
+            number = ''
+        else:
+            return None
+        i += 1
+    return None if number or not value else total
+
+
+def retry_delay(headers, attempt: int) -> float:
+    '''
+    Seconds to wait before the next attempt, from the Retry-After and
+    rate-limit headers if any, otherwise a jittered exponential backoff.
+    '''
+    delays = []
+    if headers is not None:
+        if value := headers.get('retry-after-ms'):
+            # A bare number is in milliseconds, a duration with a unit is parsed as such
+            try:
+                delays.append(float(value) / 1000)
+            except ValueError:
+                if (delay := parse_duration(value)) is not None:
+                    delays.append(delay)
+        if not delays and (value := headers.get('retry-after')):
+            delay = parse_duration(value)
+            if delay is None:
+                try:
+                    delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                delays.append(delay)
+        if not delays:
+            for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+                if (value := headers.get(name)) and (delay := parse_duration(value)) is not None:
+                    delays.append(delay)
+    if delays:
+        # A little jitter, so the processes told the same delay do not retry at once
+        delay = max(delays) * (1 + 0.1 * random.random())
+    else:
+        delay = 0.5 * (2 ** attempt) * (1 + random.random())
+    return min(max(delay, 0.0), MAX_RETRY_DELAY)
+
+
+class RateLimiter:
+    '''
+    Requests and tokens per minute buckets, shared across processes by key.
+    The buckets are updated under a blocking file lock, the async methods do
+    it on a thread, off the event loop.
+    '''
+    def __init__(self, key: str, rpm: float | None = None, tpm: float | None = None):
+        self.key = key
+        self.limits = {name: limit for (name, limit) in (('requests', rpm), ('tokens', tpm)) if limit}
+        # The key comes from the profile, it is hashed to be a safe filename
+        filename = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        self.path = get_cache_dir('ratelimit') / f'{filename}.json'
+
+    @classmethod
+    def from_settings(cls, settings: dict, *identity) -> 'RateLimiter | None':
+        '''
+        Return the limiter of the rate_limit section of a profile, None if it sets no limit.
+        The bucket is keyed by `key` of the section, or by identity.
+        '''
+        if not settings.get('rpm') and not settings.get('tpm'):
+            return None
+        key = settings.get('key') or \
+            hashlib.sha256(json.dumps(identity, default=str).encode('utf-8')).hexdigest()[:16]
+        return cls(str(key), settings.get('rpm'), settings.get('tpm'))
+
+    def refill(self, state: dict, now: float):
+        elapsed = max(0.0, now - state.get('updated', now))
+        for (name, limit) in self.limits.items():
+            level = state.get(name, limit)
+            state[name] = min(limit, level + elapsed * limit / 60)
+        state['updated'] = now
+
+    def try_acquire(self, tokens: int) -> float:
+        '''
+        Take a request and tokens from the buckets, return 0 if taken,
+        otherwise the seconds to wait before trying again.
+        '''
+        cost = {'requests': 1, 'tokens': tokens}
+        with locked_state(self.path) as state:
+            now = time.time()
+            self.refill(state, now)
+            if (blocked := state.get('blocked_until', 0) - now) > 0:
+                return blocked
+            wait = 0.0
+            for (name, limit) in self.limits.items():
+                # A request larger than the bucket only waits for a full one
+                needed = min(cost[name], limit)
+                if state[name] < needed:
+                    wait = max(wait, (needed - state[name]) * 60 / limit)
+            if wait:
+                return wait
+            for name in self.limits:
+                state[name] -= cost[name]
+            return 0.0
+
+    async def acquire(self, tokens: int = 0):
+        while (wait := await asyncio.to_thread(self.try_acquire, tokens)) > 0:
+            logger.debug(f'[ratelimit] {self.key} wait {wait:.2f}s')
+            await asyncio.sleep(wait + 0.05 * random.random())
+
+    def settle(self, estimated: int, actual: int):
+        '''
+        Give back the tokens estimated over the actual usage of a request.
+        '''
+        if 'tokens' not in self.limits or estimated == actual:
+            return
+        with locked_state(self.path) as state:
+            self.refill(state, time.time())
+            state['tokens'] = min(self.limits['tokens'], state['tokens'] + estimated - actual)
+
+    def block(self, seconds: float):
+        '''
+        Hold back every process using the buckets for seconds.
+        '''
+        with locked_state(self.path) as state:
+            state['blocked_until'] = max(state.get('blocked_until', 0), time.time() + seconds)
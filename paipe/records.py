@@ -0,0 +1,115 @@
+'''
+Run the same prompt over each record of an input stream.
+
+Records are lines, NUL-delimited records(as from `find -print0`) or JSONL
+objects. They are read incrementally and run with bounded concurrency on one
+shared agent, so an unbounded input like `tail -f` runs in constant memory.
+'''
+import json
+import asyncio
+from typing import IO, AsyncIterator
+import pydantic
+import pydantic_ai.result
+from .models import PaipeContext
+from .main import AgentPool, run_context, format_result_data, prepare_attachments
+from .batch import map_bounded
+from .util import logger, show_json_usage
+
+READ_SIZE = 64 * 1024
+
+RECORD_SEPARATORS = {
+    'line': b'\n',
+    'nul': b'\0',
+    'jsonl': b'\n',
+}
+
+
+async def read_records(stream: IO[bytes], mode: str) -> AsyncIterator[tuple[int, str]]:
+    '''
+    Yield (index, record) as soon as each record is complete.
+    '''
+    separator = RECORD_SEPARATORS[mode]
+    read = getattr(stream, 'read1', stream.read)
+    # The blocks of the pending record, only new blocks are searched for the separator
+    pending = []
+    index = 0
+    while True:
+        block = await asyncio.to_thread(read, READ_SIZE)
+        if not block:
+            records = [b''.join(pending)]
+        elif separator in block:
+            (first, *records, last) = block.split(separator)
+            records.insert(0, b''.join(pending) + first)
+            pending = [last]
+        else:
+            pending.append(block)
+            continue
+        for record in records:
+            record = record.decode('utf-8', errors='replace')
+            if mode != 'nul':
+                record = record.rstrip('\r')
+            if record.strip():
+                yield (index, record)
+                index += 1
+        if not block:
+            break
+
+
+def format_output(mode: str, record: str, output, error: str | None) -> str:
+    if mode == 'jsonl':
+        try:
+            record = json.loads(record)
+        except json.JSONDecodeError:
+            pass
+        return json.dumps({'input': record, 'output': output, 'error': error},
+                          ensure_ascii=False) + '\n'
+    # Failed records still take their place, to keep the output aligned with the input
+    text = '' if output is None else output if isinstance(output, str) else json.dumps(output)
+    return text + RECORD_SEPARATORS[mode].decode()
+
+
+async def run_records(context: PaipeContext, input_stream: IO[bytes], output_stream: IO[str]):
+    '''
+    Run the prompt of context over each record of input_stream, with the
+    record as the input text, and write the outputs to output_stream.
+    '''
+    mode = context.each_record
+    pool = AgentPool()
+    if pool.get_profile(context.profile) is None:
+        raise ValueError(f"Profile {context.profile} is not available in the profile.")
+    agent = pool.get_agent(context)
+    # The attachments are sent along with every record, process them once
+    context = context.model_copy(update={
+        'attachments': prepare_attachments(context, pool.get_profile(context.profile)),
+    })
+    total_usage = pydantic_ai.result.Usage()
+
+    async def run(item):
+        nonlocal total_usage
+        index, record = item
+        output = error = None
+        try:
+            if mode == 'jsonl':
+                json.loads(record)
+            result = await run_context(context.model_copy(update={'input_text': record}), agent)
+            if isinstance(result.data, pydantic.BaseModel):
+                output = result.data.model_dump(mode='json')
+            else:
+                output = format_result_data(context, result.data)
+            total_usage = total_usage + result.usage()
+        except Exception as e:
+            logger.debug(f'[records] record {index} failed', exc_info=True)
+            error = f'{type(e).__name__}: {e}'
+            logger.warning(f'Record {index} failed: {error}')
+        return format_output(mode, record, output, error)
+
+    def write(text: str):
+        output_stream.write(text)
+        output_stream.flush()
+
+    await map_bounded(read_records(input_stream, mode), run, write,
+                      concurrency=context.concurrency,
+                      ordered=context.keep_order)
+    if context.usage:
+        show_json_usage(total_usage)
+    return total_usage
@@ -0,0 +1,148 @@
+'''
+A warm daemon serving calls over a Unix socket.
+
+`paipe serve` imports the LLM stack once, and keeps the resolved profiles,
+the agents and the HTTP connection pools of their models alive between
+calls, so a forwarded call skips the startup cost of the CLI. See
+`paipe.client` for the protocol.
+'''
+import os
+import sys
+import json
+import signal
+import asyncio
+from pathlib import Path
+from .models import PaipeContext
+from .main import AgentPool, run_agent
+from .client import get_socket_path, encode_message, decode_context, connect
+from .util import logger, patch_video_mimetype
+
+
+class MessageWriter:
+    '''
+    A text stream writing its output to the client as messages.
+    '''
+    def __init__(self, writer: asyncio.StreamWriter, stream: str):
+        self.writer = writer
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        if text and not self.writer.is_closing():
+            self.writer.write(encode_message({self.stream: text}))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    async def drain(self):
+        if not self.writer.is_closing():
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                # The client is gone, the call is cancelled by handle_client
+                pass
+
+
+async def run_call(pool: AgentPool, context: PaipeContext, stdout: MessageWriter, stderr: MessageWriter) -> int:
+    for name in [context.profile, *context.fallback_profiles]:
+        if pool.get_profile(name) is None:
+            print(f"Profile {name} is not available in the profile.", file=stderr)
+            return 1
+    try:
+        if context.fallback_profiles:
+            from .race import run_race
+            await run_race(context, pool, stdout=stdout, stderr=stderr)
+        elif context.map_reduce:
+            from .mapreduce import run_map_reduce
+            await run_map_reduce(context, pool, stdout=stdout, stderr=stderr)
+        else:
+            await run_agent(context, agent=pool.get_agent(context),
+                            profile=pool.get_profile(context.profile),
+                            stdout=stdout, stderr=stderr)
+    except SystemExit as e:
+        # asyncio re-raises SystemExit out of the loop, which would stop the daemon
+        raise RuntimeError(f'The call exited with code {e.code}') from e
+    return 0
+
+
+async def handle_client(pool: AgentPool, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    stdout = MessageWriter(writer, 'stdout')
+    stderr = MessageWriter(writer, 'stderr')
+    try:
+        line = await reader.readline()
+        if not line:
+            return
+        context = PaipeContext.model_validate(decode_context(json.loads(line)['context']))
+        call = asyncio.create_task(run_call(pool, context, stdout, stderr))
+        # The client closes the connection when interrupted, cancel the call then
+        hangup = asyncio.create_task(reader.read())
+        await asyncio.wait([call, hangup], return_when=asyncio.FIRST_COMPLETED)
+        if not call.done():
+            logger.debug('[serve] client gone, cancel the call')
+            call.cancel()
+            return
+        hangup.cancel()
+        try:
+            code = call.result()
+        except Exception as e:
+            logger.debug('[serve] call failed', exc_info=True)
+            print(f'Error: {type(e).__name__}: {e}', file=stderr)
+            code = 1
+        writer.write(encode_message({'exit': code}))
+        await writer.drain()
+    except (ConnectionError, ValueError, KeyError) as e:
+        logger.warning(f'Dropped a client: {e!r}')
+    finally:
+        writer.close()
+
+
+async def serve(path: Path | None = None, profiles: list[str] | None = None):
+    '''
+    Serve calls on the socket at path until interrupted.
+    '''
+    path = path or get_socket_path()
+    if path.exists():
+        sock = connect(path)
+        if sock is not None:
+            sock.close()
+            raise RuntimeError(f'A daemon is already serving at {path}')
+        # Left over by a daemon which did not exit cleanly
+        path.unlink()
+    patch_video_mimetype()
+    pool = AgentPool(revalidate=True)
+    for profile_name in profiles or []:
+        pool.get_agent(PaipeContext(profile=profile_name))
+
+    async def handle(reader, writer):
+        await handle_client(pool, reader, writer)
+
+    # Only the user may connect, the daemon spends the API keys of the profiles
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle, path=str(path))
+    finally:
+        os.umask(umask)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    print(f'Serving at {path}', file=sys.stderr)
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def handle_serve(args):
+    if not hasattr(asyncio, 'start_unix_server'):
+        print('paipe serve requires Unix sockets, not available on this platform')
+        sys.exit(1)
+    path = Path(args.socket).resolve() if args.socket else None
+    # Resolve profiles from the user and system configs only, as clients may run anywhere
+    os.chdir('/')
+    try:
+        asyncio.run(serve(path, args.profile))
+    except (RuntimeError, ValueError) as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,272 @@
+'''
+Persistent conversation sessions.
+
+A session is an append-only JSONL file of turns, each one the messages of a
+call. Texts larger than BLOB_MIN_SIZE are stored once, by hash, next to it,
+and attachments are replaced by a reference, so the file stays small.
+
+A session is loaded from its end, turn by turn, until the token budget is
+spent, so loading costs the recent turns only. Once the budget is passed,
+older turns are first kept with their blobs replaced by a reference, then
+dropped, or with summarize compaction, summarized into a summary record
+covering them.
+'''
+import os
+import re
+import json
+import hashlib
+import dataclasses
+from pathlib import Path
+from typing import Iterator
+from pydantic_ai import Agent
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    SystemPromptPart,
+    UserPromptPart,
+    BinaryContent
+)
+from .util import logger, estimate_tokens, get_data_dir
+
+DEFAULT_BUDGET = 16000
+BLOB_MIN_SIZE = 4096
+READ_BLOCK = 64 * 1024
+BLOB_PART_KINDS = ('user-prompt', 'tool-return')
+# Estimated tokens of the reference replacing a blob
+REFERENCE_TOKENS = 24
+
+SUMMARY_PROMPT = '''\
+Summarize the conversation so far for your own later reference. Keep the \
+facts, decisions, names and open questions, drop the pleasantries. Reply \
+with the summary only.'''
+
+SUMMARY_PREFIX = 'A summary of the earlier conversation:\n\n'
+
+
+def iter_lines_backwards(path: Path) -> Iterator[bytes]:
+    '''
+    Yield the non-empty lines of a file from the last one, reading blocks from the end.
+    '''
+    with open(path, 'rb') as fd:
+        position = fd.seek(0, os.SEEK_END)
+        rest = b''
+        while position > 0:
+            size = min(READ_BLOCK, position)
+            position -= size
+            fd.seek(position)
+            lines = (fd.read(size) + rest).split(b'\n')
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if rest.strip():
+            yield rest
+
+
+class Session:
+    '''
+    The message history of a named session, bounded by a token budget.
+    '''
+    def __init__(self, name: str, budget: int = DEFAULT_BUDGET, compaction: str = 'drop'):
+        if not re.fullmatch(r'[\w.-]+', name) or name.startswith('.'):
+            raise ValueError(f'Invalid session name {name!r}, use letters, digits, ".", "_" and "-"')
+        directory = get_data_dir('sessions')
+        self.name = name
+        self.budget = budget
+        self.compaction = compaction
+        self.path = directory / f'{name}.jsonl'
+        self.blob_dir = directory / f'{name}.blobs'
+
+    def put_blob(self, text: str) -> dict:
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        path = self.blob_dir / digest
+        if not path.exists():
+            self.blob_dir.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+            tmp_path.write_text(text, encoding='utf-8')
+            os.replace(tmp_path, path)
+        return {'$blob': digest, 'size': len(text)}
+
+    def get_blob(self, digest: str) -> str:
+        try:
+            return (self.blob_dir / digest).read_text(encoding='utf-8')
+        except OSError:
+            logger.warning(f'Missing blob {digest[:12]} of session {self.name}')
+            return f'[missing text, sha256 {digest[:12]}]'
+
+    def iter_records(self) -> Iterator[dict]:
+        '''
+        Yield the records of the session, from the latest one.
+        '''
+        if not self.path.exists():
+            return
+        for line in iter_lines_backwards(self.path):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.debug(f'[session] skip a broken record of {self.name}')
+
+    def recent(self) -> tuple[dict | None, list[dict], list[dict], int]:
+        '''
+        Return the latest summary, the turns within the budget, the turns
+        past it not summarized yet, and the last sequence number. The recent
+        turns are kept whole while they fit, the older ones are kept with
+        their blobs replaced by a reference, set as `reduced`, while those fit.
+        '''
+        summary = None
+        window = []
+        overflow = []
+        tokens = 0
+        last_seq = 0
+        seen = set()
+        reducing = False
+        for record in self.iter_records():
+            if record['type'] == 'summary':
+                summary = summary or record
+                continue
+            last_seq = max(last_seq, record['seq'])
+            if summary and record['seq'] <= summary['upto']:
+                break
+            blobs = record.get('blobs', {})
+            base = record['tokens'] - sum(blobs.values()) + REFERENCE_TOKENS * len(blobs)
+            # A blob sent again in a later turn is only sent there
+            full = base + sum(size - REFERENCE_TOKENS for (digest, size) in blobs.items() if digest not in seen)
+            if not overflow and not reducing and (not window or tokens + full <= self.budget):
+                window.append(record)
+                tokens += full
+                seen.update(blobs)
+                continue
+            if not overflow and tokens + base <= self.budget:
+                reducing = True
+                record['reduced'] = True
+                window.append(record)
+                tokens += base
+                continue
+            if self.compaction != 'summarize':
+                break
+            overflow.append(record)
+        return summary, window[::-1], overflow[::-1], last_seq
+
+    def decode(self, records: list[dict]) -> list[ModelMessage]:
+        '''
+        Rebuild the messages of turns, resolving blobs. A text sent again in
+        a later turn is only kept there, earlier ones refer to it, and the
+        blobs of reduced turns are referred to.
+        '''
+        seen = set()
+        turns = []
+        for record in reversed(records):
+            messages = json.loads(json.dumps(record['messages']))
+            for message in reversed(messages):
+                for part in reversed(message.get('parts', [])):
+                    if part.get('part_kind') not in BLOB_PART_KINDS:
+                        continue
+                    content = part['content']
+                    items = content if isinstance(content, list) else [content]
+                    for (i, item) in enumerate(items):
+                        if not isinstance(item, dict) or '$blob' not in item:
+                            continue
+                        digest = item['$blob']
+                        if digest in seen:
+                            items[i] = f'[the same {item["size"]} characters as sent later, sha256 {digest[:12]}]'
+                        elif record.get('reduced'):
+                            items[i] = (f'[{item["size"]} characters left out of the session budget, '
+                                        f'sha256 {digest[:12]}]')
+                        else:
+                            seen.add(digest)
+                            items[i] = self.get_blob(digest)
+                    part['content'] = items if isinstance(content, list) else items[0]
+            turns.append(messages)
+        return [message for messages in reversed(turns)
+                for message in ModelMessagesTypeAdapter.validate_python(messages)]
+
+    def load(self, system_prompt: str | None = None) -> list[ModelMessage]:
+        '''
+        Return the message history to continue the session with.
+        '''
+        summary, window, __, __ = self.recent()
+        messages = []
+        if system_prompt:
+            messages.append(ModelRequest(parts=[SystemPromptPart(content=system_prompt)]))
+        if summary:
+            messages.append(ModelRequest(parts=[UserPromptPart(content=SUMMARY_PREFIX + summary['text'])]))
+        messages.extend(self.decode(window))
+        logger.debug(f'[session] {self.name} loaded {len(window)} turns')
+        return messages
+
+    def encode(self, messages: list[ModelMessage]) -> tuple[list[dict], int]:
+        '''
+        Return the messages as JSON, without the system prompt, with
+        attachments replaced by a reference and large texts by blobs, their
+        estimated tokens, and the estimated tokens of each blob.
+        '''
+        kept = []
+        for message in messages:
+            if isinstance(message, ModelRequest):
+                parts = []
+                for part in message.parts:
+                    if isinstance(part, SystemPromptPart):
+                        continue
+                    if isinstance(part, UserPromptPart) and not isinstance(part.content, str):
+                        part = dataclasses.replace(part, content=[
+                            f'[attachment {item.media_type}, {len(item.data)} bytes, '
+                            f'sha256 {hashlib.sha256(item.data).hexdigest()[:12]}]'
+                            if isinstance(item, BinaryContent) else item
+                            for item in part.content
+                        ])
+                    parts.append(part)
+                if not parts:
+                    continue
+                message = dataclasses.replace(message, parts=parts)
+            kept.append(message)
+        encoded = ModelMessagesTypeAdapter.dump_python(kept, mode='json')
+        tokens = estimate_tokens(json.dumps(encoded, ensure_ascii=False))
+        blobs = {}
+
+        def to_blob(text):
+            if not isinstance(text, str) or len(text) < BLOB_MIN_SIZE:
+                return text
+            blob = self.put_blob(text)
+            blobs[blob['$blob']] = estimate_tokens(text)
+            return blob
+
+        for message in encoded:
+            for part in message.get('parts', []):
+                if part.get('part_kind') not in BLOB_PART_KINDS:
+                    continue
+                content = part['content']
+                if isinstance(content, list):
+                    part['content'] = [to_blob(item) for item in content]
+                else:
+                    part['content'] = to_blob(content)
+        return (encoded, tokens, blobs)
+
+    def append(self, record: dict):
+        with open(self.path, 'a', encoding='utf-8') as fd:
+            fd.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    async def save(self, messages: list[ModelMessage], agent: Agent | None = None):
+        '''
+        Append the messages of a call as a turn, and compact the session if needed.
+        '''
+        __, __, __, last_seq = self.recent()
+        (encoded, tokens, blobs) = self.encode(messages)
+        self.append({'type': 'turn', 'seq': last_seq + 1, 'tokens': tokens, 'blobs': blobs,
+                     'messages': encoded})
+        if self.compaction == 'summarize' and agent is not None:
+            summary, __, overflow, __ = self.recent()
+            if overflow:
+                await self.summarize(summary, overflow, agent)
+
+    async def summarize(self, summary: dict | None, turns: list[dict], agent: Agent):
+        '''
+        Summarize the turns past the budget, with the previous summary, into a new summary record.
+        '''
+        history = []
+        if summary:
+            history.append(ModelRequest(parts=[UserPromptPart(content=SUMMARY_PREFIX + summary['text'])]))
+        history.extend(self.decode(turns))
+        logger.debug(f'[session] {self.name} summarize {len(turns)} turns')
+        result = await Agent(agent.model).run(SUMMARY_PROMPT, message_history=history)
+        self.append({'type': 'summary', 'upto': turns[-1]['seq'], 'text': str(result.data)})
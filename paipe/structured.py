@@ -0,0 +1,324 @@
+'''
+Structured results: schema models, and streaming them as NDJSON.
+
+The JSON of a structured result is parsed incrementally as the model writes
+it, to output either snapshots of the partial object, or each element of an
+array field as soon as it is complete:
+
+    paipe --json "$SCHEMA" --json-stream items "Extract every person in the text"
+'''
+import re
+import json
+import typing
+import hashlib
+import pydantic
+import dydantic
+from .util import drain_output, logger
+
+_schema_models = {}
+
+
+def schema_hash(json_schema: str) -> str:
+    canonical = json.dumps(json.loads(json_schema), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_schema_model(json_schema: str) -> type[pydantic.BaseModel]:
+    '''
+    Return the model of a JSON schema, compiled once per schema in a process.
+    '''
+    key = schema_hash(json_schema)
+    if key not in _schema_models:
+        _schema_models[key] = dydantic.create_model_from_schema(json.loads(json_schema))
+    return _schema_models[key]
+
+
+def find_items_field(json_schema: str) -> str | None:
+    '''
+    Return the first top level array field of a schema.
+    '''
+    properties = json.loads(json_schema).get('properties') or {}
+    for (name, prop) in properties.items():
+        if prop.get('type') == 'array':
+            return name
+    return None
+
+
+def item_type_of(annotation):
+    '''
+    Return the item type of a list annotation, unwrapping Optional, Any if not a list.
+    '''
+    if typing.get_origin(annotation) in (list, tuple, set):
+        args = typing.get_args(annotation)
+        return args[0] if args else typing.Any
+    for arg in typing.get_args(annotation):
+        if (item_type := item_type_of(arg)) is not typing.Any:
+            return item_type
+    return typing.Any
+
+
+class Frame:
+    def __init__(self, kind: str, start: int):
+        self.kind = kind
+        self.start = start
+        self.expect = 'key' if kind == '{' else 'value'
+        self.key = None
+        self.key_start = None
+        self.count = 0
+        # The values completed in the container so far
+        self.value = {} if kind == '{' else []
+
+
+class JsonStream:
+    '''
+    Parse a JSON text incrementally as it grows.
+
+    on_value(path, text) is called as soon as each value is complete, with
+    the keys and indexes leading to it. `partial` returns the value parsed so
+    far, with incomplete keys, numbers and literals left out. Each value is
+    parsed once, as it completes, into the container being written, so a
+    partial value only parses the string being written, if any.
+    '''
+    PARTIAL_UNICODE_ESCAPE = re.compile(r'(\\+)u[0-9a-fA-F]{0,3}$')
+
+    def __init__(self, on_value: typing.Callable[[tuple, str], None] | None = None):
+        self.on_value = on_value
+        self.text = ''
+        self.stack = []
+        self.in_string = False
+        self.is_key = False
+        self.escape = False
+        self.string_start = None
+        self.scalar_start = None
+        self.done = False
+        self.value = None
+
+    def path(self) -> tuple:
+        return tuple(frame.key if frame.kind == '{' else frame.count for frame in self.stack)
+
+    def complete(self, start: int, end: int, value):
+        if self.stack:
+            top = self.stack[-1]
+            if top.kind == '{':
+                top.value[top.key] = value
+            else:
+                top.value.append(value)
+        else:
+            self.value = value
+        if self.on_value:
+            self.on_value(self.path(), self.text[start:end])
+        if not self.stack:
+            self.done = True
+            return
+        top = self.stack[-1]
+        top.expect = 'comma'
+        if top.kind == '[':
+            top.count += 1
+
+    def feed(self, delta: str):
+        start = len(self.text)
+        self.text += delta
+        text = self.text
+        for i in range(start, len(text)):
+            if self.done:
+                break
+            c = text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.is_key:
+                        top = self.stack[-1]
+                        top.key = json.loads(text[self.string_start:i + 1])
+                        top.expect = 'colon'
+                    else:
+                        self.complete(self.string_start, i + 1, json.loads(text[self.string_start:i + 1]))
+                continue
+            if self.scalar_start is not None:
+                if c not in ' \t\r\n,]}':
+                    continue
+                self.complete(self.scalar_start, i, json.loads(text[self.scalar_start:i]))
+                self.scalar_start = None
+            if c in ' \t\r\n':
+                continue
+            top = self.stack[-1] if self.stack else None
+            if c == '"':
+                self.in_string = True
+                self.string_start = i
+                self.is_key = top is not None and top.kind == '{' and top.expect == 'key'
+                if self.is_key:
+                    top.key_start = i
+            elif c in '{[':
+                self.stack.append(Frame(c, i))
+            elif c in '}]':
+                frame = self.stack.pop()
+                self.complete(frame.start, i + 1, frame.value)
+            elif c == ':':
+                top.expect = 'value'
+            elif c == ',':
+                top.expect = 'key' if top.kind == '{' else 'value'
+            else:
+                self.scalar_start = i
+
+    def partial(self):
+        '''
+        Return the value parsed so far. The open containers are copied, the
+        completed values are shared, they do not change once complete.
+        '''
+        if self.done:
+            return self.value
+        if not self.stack:
+            return None
+        child = None
+        has_child = False
+        if self.in_string and not self.is_key:
+            body = self.text[self.string_start:]
+            if self.escape:
+                body = body[:-1]
+            match = self.PARTIAL_UNICODE_ESCAPE.search(body)
+            if match and len(match.group(1)) % 2:
+                body = body[:match.end(1) - 1]
+            child = json.loads(body + '"')
+            has_child = True
+        # Incomplete keys, numbers and literals are left out
+        for frame in reversed(self.stack):
+            if frame.kind == '{':
+                value = dict(frame.value)
+                if has_child:
+                    value[frame.key] = child
+            else:
+                value = list(frame.value)
+                if has_child:
+                    value.append(child)
+            (child, has_child) = (value, True)
+        return child
+
+
+class StructuredStream:
+    '''
+    Write the JSON text of a structured result as NDJSON while it grows.
+
+    In snapshot mode, a snapshot of the partial object is written each time a
+    value in it is complete and it is valid against the model so far, and the
+    validated result last, unless it is the last snapshot. In items mode,
+    each element of the items field is written once complete and validated
+    against the item type of the field.
+    '''
+    def __init__(self,
+                 model: type[pydantic.BaseModel],
+                 mode: str,
+                 items_field: str | None = None,
+                 stdout=None):
+        self.model = model
+        self.mode = mode
+        self.items_field = items_field
+        self.stdout = stdout
+        self.parser = JsonStream(self.on_value)
+        self.last_snapshot = None
+        self.item_adapter = None
+        if mode == 'items':
+            if items_field not in model.model_fields:
+                raise ValueError(f'No array field {items_field} in the JSON schema to stream the items of')
+            self.item_adapter = pydantic.TypeAdapter(item_type_of(model.model_fields[items_field].annotation))
+
+    def write(self, value):
+        print(json.dumps(value, ensure_ascii=False), flush=True, file=self.stdout)
+
+    def is_valid_snapshot(self, snapshot) -> bool:
+        '''
+        Validate a partial object against the model. Errors of the containers
+        still open, and of fields missing from them, are expected so far.
+        '''
+        try:
+            self.model.model_validate(snapshot)
+        except pydantic.ValidationError as e:
+            # The locations of the open containers, the root first
+            path = self.parser.path()
+            open_locations = {path[:depth] for depth in range(len(self.parser.stack))}
+            for error in e.errors():
+                location = tuple(error['loc'])
+                if location in open_locations:
+                    continue
+                if error['type'] == 'missing' and location[:-1] in open_locations:
+                    continue
+                logger.debug(f'Skip the invalid snapshot: {e}')
+                return False
+        return True
+
+    def on_value(self, path: tuple, text: str):
+        if self.mode == 'items':
+            if len(path) == 2 and path[0] == self.items_field and isinstance(path[1], int):
+                try:
+                    item = self.item_adapter.validate_json(text)
+                except pydantic.ValidationError as e:
+                    logger.warning(f'Skip the invalid item {path[1]} of {self.items_field}: {e}')
+                    return
+                self.write(self.item_adapter.dump_python(item, mode='json'))
+        elif self.parser.stack:
+            snapshot = self.parser.partial()
+            if snapshot != self.last_snapshot and self.is_valid_snapshot(snapshot):
+                self.write(snapshot)
+                self.last_snapshot = snapshot
+
+    def feed(self, text: str):
+        '''
+        Feed the JSON text of the result so far.
+        '''
+        if not text.startswith(self.parser.text):
+            # Not an extension of what was parsed, parse it again
+            self.parser = JsonStream(self.on_value)
+        self.parser.feed(text[len(self.parser.text):])
+
+    def close(self, data: pydantic.BaseModel):
+        '''
+        Finish with the validated result.
+        '''
+        if self.mode == 'snapshot':
+            result = data.model_dump(mode='json')
+            if result != self.last_snapshot:
+                self.write(result)
+
+
+def result_args_text(message) -> str | None:
+    '''
+    Return the JSON text of the result tool call of a model response so far.
+    '''
+    for part in message.parts:
+        if part.part_kind != 'tool-call':
+            continue
+        args = part.args
+        # ArgsJson and ArgsDict of older pydantic_ai versions
+        if hasattr(args, 'args_json'):
+            return args.args_json
+        if hasattr(args, 'args_dict'):
+            return json.dumps(args.args_dict)
+        return args if isinstance(args, str) else json.dumps(args)
+    return None
+
+
+def new_structured_stream(context, stdout=None) -> StructuredStream:
+    items_field = None
+    if context.json_stream == 'items':
+        items_field = context.json_items or find_items_field(context.json_schema)
+    return StructuredStream(get_schema_model(context.json_schema),
+                            context.json_stream, items_field, stdout)
+
+
+async def stream_structured_result(response, stream: StructuredStream, metrics=None):
+    '''
+    Feed the result of a streamed run to stream as it arrives, and return the validated result.
+    '''
+    message = None
+    async for (message, __) in response.stream_structured(debounce_by=None):
+        text = result_args_text(message)
+        if text:
+            if metrics:
+                metrics.add_delta(text[len(stream.parser.text):])
+            stream.feed(text)
+            await drain_output(stream.stdout)
+    data = await response.validate_structured_result(message)
+    stream.close(data)
+    return data
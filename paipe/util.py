@@ -2,14 +2,16 @@ import sys
 import os
 import json
 import base64
-import mimetypes
 import logging
 import importlib
-import inspect
 import re
 import argparse
-from typing import Callable, Generator, Dict, Any
-import pydantic_ai.result
+import platform
+from pathlib import Path
+from typing import Callable, Generator, Dict, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pydantic_ai.result
 
 logger = logging.getLogger('paipe')
 handler = logging.StreamHandler()
@@ -42,6 +44,7 @@ class DeprecatedAction(argparse.Action):
 
 
 def file_as_data_url(file_path: str) -> str:
+    import mimetypes
     with open(file_path, 'rb') as f:
         data = f.read()
     mime_type, _ = mimetypes.guess_type(file_path)
@@ -56,8 +59,10 @@ def file_as_data_url(file_path: str) -> str:
 
 
 def to_attachment_pairs(file_path_list: list[str]) -> Generator[tuple[bytes, str], None, None]:
+    import mimetypes
     for file_path in file_path_list:
-        data = open(file_path, 'rb').read()
+        with open(file_path, 'rb') as f:
+            data = f.read()
         mime_type, _ = mimetypes.guess_type(file_path)
         if mime_type is None:
             mime_type = 'application/octet-stream'
@@ -132,6 +137,93 @@ def extract_markdown_code_blocks(markdown: str, language: str = '') -> list:
         return [code for _, code in matches]
 
 
+CODE_FENCE_LANGUAGE = re.compile(r'[\w+-]*')
+
+
+class CodeBlockStream:
+    """
+    Extract code blocks from a markdown stream as its deltas arrive, finding
+    the same blocks as `extract_markdown_code_blocks` on the whole text.
+
+    Only the content of the current block is buffered. With first, `feed`
+    returns the content of the first matching block as soon as it can no
+    longer be part of a closing fence, and feeding stops once it is closed,
+    setting `done`. Otherwise the last matching block wins, `feed` returns
+    nothing and `close` returns the block.
+    """
+    def __init__(self, language: str = '', first: bool = False):
+        self.language = language.lower()
+        self.first = first
+        self.buffer = ''
+        self.inside = False
+        self.matching = False
+        self.current = []
+        self.last = None
+        self.done = False
+
+    def feed(self, delta: str) -> str:
+        if self.done:
+            return ''
+        self.buffer += delta
+        output = []
+        while True:
+            if not self.inside:
+                start = self.buffer.find('```')
+                if start < 0:
+                    # Keep what may be the start of a fence
+                    self.buffer = self.buffer[-2:]
+                    break
+                end = CODE_FENCE_LANGUAGE.match(self.buffer, start + 3).end()
+                if end == len(self.buffer):
+                    self.buffer = self.buffer[start:]
+                    break
+                if self.buffer[end] != '\n':
+                    self.buffer = self.buffer[start + 1:]
+                    continue
+                language = self.buffer[start + 3:end].lower()
+                self.inside = True
+                self.matching = not self.language or language == self.language
+                self.buffer = self.buffer[end + 1:]
+            else:
+                end = self.buffer.find('\n```')
+                if end < 0:
+                    # Hold back what may be the start of the closing fence
+                    safe = len(self.buffer) - 3
+                    if safe > 0:
+                        if self.matching:
+                            self.current.append(self.buffer[:safe])
+                            if self.first:
+                                output.append(self.buffer[:safe])
+                        self.buffer = self.buffer[safe:]
+                    break
+                if self.matching:
+                    self.current.append(self.buffer[:end])
+                    if self.first:
+                        output.append(self.buffer[:end])
+                    self.last = ''.join(self.current)
+                self.current = []
+                self.inside = False
+                self.buffer = self.buffer[end + 4:]
+                if self.first and self.last is not None:
+                    self.done = True
+                    break
+        return ''.join(output)
+
+    def close(self) -> str:
+        """
+        Return the rest to output once the stream ends: the last matching
+        block, or with first, the rest of an unclosed first block.
+        """
+        if self.first and not self.done and self.inside and self.matching:
+            self.done = True
+            return self.buffer
+        if self.last is None and not (self.first and self.current):
+            logger.warning(f"No {self.language} code block detected.")
+        if self.first:
+            return ''
+        return self.last or ''
+
+
 def patch_video_mimetype():
     @property
     def is_image(self) -> bool:
@@ -142,11 +234,65 @@ def patch_video_mimetype():
     logger.debug("Patched pydantic_ai.messages.BinaryContent.is_image")
 
 
-def show_json_usage(usage: pydantic_ai.result.Usage,
-                    file=None):
+def usage_to_dict(usage: 'pydantic_ai.result.Usage | dict') -> dict:
+    return dict(usage) if isinstance(usage, dict) else dict(usage.__dict__)
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    Estimate the tokens of a text, about 4 bytes of UTF-8 per token.
+    '''
+    return (len(text.encode('utf-8')) + 3) // 4
+
+
+async def drain_output(file):
+    '''
+    Wait until the output written to file is sent, for the streams of the
+    daemon whose client reads slowly, so a response is not buffered whole.
+    '''
+    drain = getattr(file, 'drain', None)
+    if drain is not None:
+        await drain()
+
+
+def show_json_usage(usage: 'pydantic_ai.result.Usage | dict',
+                    file=None,
+                    **extra):
     if file is None:
         file = sys.stderr
-    print("Usage:", json.dumps(usage.__dict__), file=file)
+    data = usage_to_dict(usage)
+    cached_tokens = (data.get('details') or {}).get('cached_tokens')
+    if cached_tokens is not None and data.get('request_tokens') is not None:
+        # Reported by providers with prompt prefix caching
+        data['cached_input_tokens'] = cached_tokens
+        data['uncached_input_tokens'] = data['request_tokens'] - cached_tokens
+    print("Usage:", json.dumps({**data, **extra}), file=file)
+
+
+def get_cache_dir(*parts: str) -> Path:
+    '''
+    Return a directory under the paipe cache directory, created if missing.
+    '''
+    if platform.system() == 'Windows':
+        base = Path.home() / '.paipe' / 'cache'
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'paipe'
+    path = base.joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def get_data_dir(*parts: str) -> Path:
+    '''
+    Return a directory under the paipe data directory, created if missing.
+    '''
+    if platform.system() == 'Windows':
+        base = Path.home() / '.paipe'
+    else:
+        base = Path(os.environ.get('XDG_DATA_HOME') or Path.home() / '.local' / 'share') / 'paipe'
+    path = base.joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
 
 
 def init_via_annotations(cls: type, params: Dict[str, Any]):
@@ -166,5 +312,6 @@ def kwargs_by_func_def(func: Callable, kwargs: Dict[str, Any]) -> Dict[str, Any]
     '''
     Filter kwargs by function definition.
     '''
+    import inspect
     func_def = inspect.signature(func)
     return {k: v for k, v in kwargs.items() if k in func_def.parameters}
\ No newline at end of file